@@ -1,63 +1,107 @@
 import logging
-from typing import List, Dict, Optional
-import aiohttp
+from typing import List, Dict, Optional, Tuple
 import asyncio
-import json
+import os
+from collections import OrderedDict
 
-from utils import setup_logging
+from config import (
+  COVER_ART_DIR,
+  COVER_ART_ENABLED,
+  COVER_ART_SIZE,
+  COVER_ART_URL,
+  MUSICBRAINZ_API_URL,
+)
+from utils import log_payload, setup_logging
+from database import cache
+from http_client import request, close_session
+from mb_index import get_index
+from metrics import metrics
+from upstreams import get_upstream
 
-logger = setup_logging()
+logger = setup_logging(__name__)
 
-MUSICBRAINZ_API_URL = "https://musicbrainz.org/ws/2"
 HEADERS = {
   "User-Agent": "MyMusicDownloader/1.0.0 ( https://github.com/yourusername/your-repo )"
 }
 
+# Cover art fetches by release id, shared by every track of the release.
+# Only the most recently used releases stay in memory; the disk cache has the rest
+COVERS_IN_MEMORY = 32
+_covers: "OrderedDict[str, asyncio.Future]" = OrderedDict()
 
-async def query_album_tracks(album: str, artist: str = "") -> Optional[List[str]]:
+
+async def query_album(album: str, artist: str = "") -> Optional[List[Dict]]:
   """
-  Query MusicBrainz API for album tracks.
+  Query MusicBrainz for an album's tracks with their release info.
+
+  :return: Track dictionaries as built by parse_album_tracks, or None if the album wasn't found
   """
+  index = get_index()
+  if index is not None and index.available:
+    release = index.lookup(album, artist)
+    if release:
+      metrics.inc("index_hits")
+      logger.info(f"Found album in offline index: {release['title']}")
+      return parse_album_tracks(release)
+
   query = f"release:{album}"
   if artist:
     query += f" AND artist:{artist}"
 
+  cached = cache.get("musicbrainz", f"{query}|tracks")
+  if cached:
+    logger.info(f"Using cached tracks for query: {query}")
+    return cached
+
   params = {"query": query, "fmt": "json"}
 
-  async with aiohttp.ClientSession() as session:
-    try:
-      async with session.get(
-        f"{MUSICBRAINZ_API_URL}/release", params=params, headers=HEADERS
-      ) as response:
-        if response.status == 200:
-          data = await response.json()
-          logger.debug(
-            f"MusicBrainz API response: {json.dumps(data, indent=2)}"
-          )
-          if data.get("releases"):
-            # Sort releases by score and prefer official releases
-            sorted_releases = sorted(
-              data["releases"],
-              key=lambda x: (
-                x.get("score", 0),
-                x.get("status") == "Official",
-              ),
-              reverse=True,
-            )
-            release_id = sorted_releases[0]["id"]
-            return await get_tracks(release_id, session)
-          else:
-            logger.warning(f"No album found for query: {query}")
-            return None
-        else:
-          logger.error(f"Error querying MusicBrainz API: {response.status}")
-          return None
-    except Exception as e:
-      logger.error(f"Error querying MusicBrainz API: {str(e)}")
-      return None
-
-
-async def get_tracks(release_id: str, session: aiohttp.ClientSession) -> List[str]:
+  try:
+    metrics.inc("api_calls", service="musicbrainz", endpoint="release_search")
+    # Only the search itself holds a MusicBrainz slot and connection; get_tracks takes its own
+    async with get_upstream("musicbrainz").slot(), await request(
+      "GET", f"{MUSICBRAINZ_API_URL}/release", params=params, headers=HEADERS, upstream="musicbrainz"
+    ) as response:
+      status = response.status
+      data = await response.json() if status == 200 else None
+  except Exception as e:
+    logger.error(f"Error querying MusicBrainz API: {str(e)}")
+    return None
+
+  if status != 200:
+    logger.error(f"Error querying MusicBrainz API: {status}")
+    return None
+  log_payload(logger, data, "MusicBrainz search response for %s", query)
+  if not data.get("releases"):
+    logger.warning(f"No album found for query: {query}")
+    return None
+
+  # Sort releases by score and prefer official releases
+  sorted_releases = sorted(
+    data["releases"],
+    key=lambda x: (
+      x.get("score", 0),
+      x.get("status") == "Official",
+    ),
+    reverse=True,
+  )
+  release_id = sorted_releases[0]["id"]
+  tracks = await get_tracks(release_id)
+  if tracks:
+    cache.set("musicbrainz", f"{query}|tracks", tracks)
+  return tracks
+
+
+async def query_album_tracks(album: str, artist: str = "") -> Optional[List[str]]:
+  """
+  Query MusicBrainz API for album tracks.
+
+  :return: "Artist - Title" strings, or None if the album wasn't found
+  """
+  tracks = await query_album(album, artist)
+  return [track["song"] for track in tracks] if tracks is not None else None
+
+
+async def get_tracks(release_id: str) -> List[Dict]:
   """
   Get tracks for a specific release ID.
   """
@@ -67,19 +111,22 @@ async def get_tracks(release_id: str, session: aiohttp.ClientSession) -> List[st
   }
 
   try:
-    async with session.get(
+    metrics.inc("api_calls", service="musicbrainz", endpoint="release")
+    async with get_upstream("musicbrainz").slot(), await request(
+      "GET",
       f"{MUSICBRAINZ_API_URL}/release/{release_id}",
       params=params,
       headers=HEADERS,
+      upstream="musicbrainz",
     ) as response:
       if response.status == 200:
         data = await response.json()
-        logger.debug(
-          f"Track data response for release {release_id}: {json.dumps(data, indent=2)}"
-        )
-        tracks = parse_album_info(data)
+        log_payload(logger, data, "Track data response for release %s", release_id)
+        tracks = parse_album_tracks(data)
         if not tracks:
           logger.error(f"No tracks found for release ID: {release_id}")
+        elif get_index() is not None:
+          get_index().add(data)
         return tracks
       else:
         logger.error(f"Error fetching tracks: {response.status}")
@@ -90,34 +137,64 @@ async def get_tracks(release_id: str, session: aiohttp.ClientSession) -> List[st
     return []
 
 
-def parse_album_info(album_data: Dict) -> List[str]:
+def _credit(artist_credit, default: str = "", default_id: str = "") -> Tuple[str, str]:
   """
-  Parse album information and return a list of tracks.
+  Name and MusicBrainz id of the first credited artist.
+  """
+  if isinstance(artist_credit, list) and len(artist_credit) > 0:
+    artist_credit = artist_credit[0]
+  if not isinstance(artist_credit, dict):
+    return default, default_id
+  return (
+    artist_credit.get("name", default),
+    (artist_credit.get("artist") or {}).get("id", default_id),
+  )
+
+
+def parse_album_tracks(album_data: Dict) -> List[Dict]:
+  """
+  Parse a release into one dictionary per track.
+
+  Each has "song" ("Artist - Title"), title, artist, album, album_artist,
+  date, track/tracks and disc/discs numbers, length (seconds, for the
+  duration check), and whichever MusicBrainz ids
+  the release carries (musicbrainz_albumid, musicbrainz_trackid for the
+  recording, musicbrainz_releasetrackid, musicbrainz_artistid,
+  musicbrainz_albumartistid). Empty fields are left out.
   """
   tracks = []
   try:
-    # Log the entire album_data for debugging
-    logger.debug(f"Full album data: {json.dumps(album_data, indent=2)}")
-
-    # Try to extract artist name from different possible locations
-    artist = "Unknown Artist"
-    if "artist-credit" in album_data:
-      artist_credit = album_data["artist-credit"]
-      logger.debug(f"Artist credit data: {artist_credit}")
-      if isinstance(artist_credit, list) and len(artist_credit) > 0:
-        artist = artist_credit[0].get("name", artist)
-      elif isinstance(artist_credit, dict):
-        artist = artist_credit.get("name", artist)
+    artist, artist_id = _credit(album_data.get("artist-credit"), "Unknown Artist")
     logger.info(f"Extracted artist: {artist}")
 
-    for medium in album_data.get("media", []):
-      logger.debug(f"Processing medium: {medium}")
-      for track in medium.get("tracks", []):
-        logger.debug(f"Processing track: {track}")
+    media = album_data.get("media", [])
+    for disc, medium in enumerate(media, 1):
+      medium_tracks = medium.get("tracks", [])
+      for number, track in enumerate(medium_tracks, 1):
         title = track.get("title", "Unknown Title")
-        track_artist = track.get("artist-credit", [{}])[0].get("name", artist)
-        tracks.append(f"{track_artist} - {title}")
-        logger.debug(f"Added track: {track_artist} - {title}")
+        track_artist, track_artist_id = _credit(track.get("artist-credit"), artist, artist_id)
+        recording = track.get("recording") or {}
+        # Milliseconds; the track's own length, else the recording's
+        length = track.get("length") or recording.get("length") or 0
+        info = {
+          "song": f"{track_artist} - {title}",
+          "title": title,
+          "artist": track_artist,
+          "album": album_data.get("title", ""),
+          "album_artist": artist,
+          "date": album_data.get("date", ""),
+          "track": track.get("position") or number,
+          "tracks": medium.get("track-count") or len(medium_tracks),
+          "disc": medium.get("position") or disc,
+          "discs": len(media),
+          "length": round(length / 1000),
+          "musicbrainz_albumid": album_data.get("id"),
+          "musicbrainz_trackid": recording.get("id"),
+          "musicbrainz_releasetrackid": track.get("id"),
+          "musicbrainz_artistid": track_artist_id,
+          "musicbrainz_albumartistid": artist_id,
+        }
+        tracks.append({key: value for key, value in info.items() if value})
 
     if not tracks:
       logger.warning("No tracks found in the album data")
@@ -129,9 +206,86 @@ def parse_album_info(album_data: Dict) -> List[str]:
   return tracks
 
 
+def parse_album_info(album_data: Dict) -> List[str]:
+  """
+  Parse album information and return a list of tracks.
+  """
+  return [track["song"] for track in parse_album_tracks(album_data)]
+
+
+async def _fetch_cover_art(release_id: str) -> Optional[bytes]:
+  # An empty file records a release the Cover Art Archive has no front cover for
+  path = os.path.join(COVER_ART_DIR, f"{release_id}.img")
+  if os.path.exists(path):
+    with open(path, "rb") as f:
+      return f.read() or None
+
+  try:
+    metrics.inc("api_calls", service="coverartarchive", endpoint="front")
+    async with await request(
+      "GET", f"{COVER_ART_URL}/release/{release_id}/front-{COVER_ART_SIZE}", headers=HEADERS
+    ) as response:
+      if response.status == 404:
+        logger.info(f"No cover art for release {release_id}")
+        data = b""
+      else:
+        response.raise_for_status()
+        data = await response.read()
+  except Exception as e:
+    # Raised so the release is forgotten and the next track tries again
+    logger.warning(f"Error fetching cover art for release {release_id}: {e}")
+    raise
+
+  os.makedirs(COVER_ART_DIR, exist_ok=True)
+  with open(path, "wb") as f:
+    f.write(data)
+  return data or None
+
+
+async def fetch_cover_art(release_id: str) -> Optional[bytes]:
+  """
+  Front cover image for a release from the Cover Art Archive.
+
+  Fetched once per release: concurrent tracks share one request, the image
+  (or the fact that there is none) is kept in memory for the next tracks of
+  the release and on disk for later runs. Only a failed fetch is retried.
+
+  :return: Image bytes (JPEG or PNG), or None if the release has no cover or it couldn't be fetched
+  """
+  if not COVER_ART_ENABLED or not release_id:
+    return None
+  future = _covers.get(release_id)
+  if future is None:
+    future = asyncio.ensure_future(_fetch_cover_art(release_id))
+    future.add_done_callback(lambda done: _forget_failed_cover(release_id, done))
+    _covers[release_id] = future
+    # Fetches still in flight stay, so their tracks keep sharing them
+    finished = [key for key, cover in _covers.items() if cover.done()]
+    for key in finished[:len(_covers) - COVERS_IN_MEMORY]:
+      del _covers[key]
+  else:
+    _covers.move_to_end(release_id)
+  try:
+    return await asyncio.shield(future)
+  except asyncio.CancelledError:
+    raise
+  except Exception:
+    # Already logged; the track is tagged without a cover
+    return None
+
+
+def _forget_failed_cover(release_id: str, future: "asyncio.Future") -> None:
+  if future.cancelled() or future.exception() is not None:
+    if _covers.get(release_id) is future:
+      del _covers[release_id]
+
+
 # Example usage
 async def main():
-  tracks = await query_album_tracks("The Dark Side of the Moon", "Pink Floyd")
+  try:
+    tracks = await query_album_tracks("The Dark Side of the Moon", "Pink Floyd")
+  finally:
+    await close_session()
   if tracks:
     print("Tracks:")
     for track in tracks:
@@ -141,8 +295,6 @@ async def main():
 
 
 if __name__ == "__main__":
-  # logging.getLogger().setLevel(logging.DEBUG)  # Set to DEBUG for more detailed logging
-  logging.getLogger().setLevel(
-    logging.WARNING
-  )  # Set to DEBUG for more detailed logging
+  # Set to DEBUG to see the (size-capped) MusicBrainz responses
+  logging.getLogger().setLevel(logging.WARNING)
   asyncio.run(main())
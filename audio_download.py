@@ -2,16 +2,35 @@
 import asyncio
 import os
 import logging
+import shutil
 import subprocess
-from typing import Dict, Optional
-from pytube import YouTube
-from tqdm import tqdm
+import time
+from contextlib import AsyncExitStack
+from typing import Callable, Dict, List, Optional
 
-from config import FFMPEG_PATH, MAX_RETRIES
-from utils import setup_logging
+from config import FFMPEG_PATH, MAX_RETRIES, STREAMING_DOWNLOADS
+from utils import setup_logging, no_limit
 from metadata import set_metadata, clean_filename
+from album_query import fetch_cover_art
+from transcode import transcoder
+from downloader import SIDECAR_SUFFIX, download_ranges
+from http_client import request
+from metrics import metrics
+from upstreams import get_upstream
+from verification import DurationMismatch, verify_duration
 
-logger = setup_logging()
+logger = setup_logging(__name__)
+
+# Output formats that can take the YouTube audio stream as-is, mapped to the
+# source container they need
+COPY_FORMATS = {"m4a": "mp4", "opus": "webm"}
+# Container a "native" download is remuxed into, by source container
+NATIVE_FORMATS = {"mp4": "m4a", "webm": "opus"}
+ENCODERS = {"mp3": "libmp3lame", "m4a": "aac", "opus": "libopus"}
+
+# Same range size pytube uses; larger unranged requests get throttled by the CDN
+STREAM_RANGE_SIZE = 9 * 1024 * 1024
+STREAM_READ_SIZE = 64 * 1024
 
 
 def check_ffmpeg():
@@ -25,92 +44,515 @@ def check_ffmpeg():
         return False
 
 
-async def download_audio(
+def _bitrate(stream) -> int:
+    try:
+        return int((stream.abr or "0").rstrip("kbps"))
+    except ValueError:
+        return 0
+
+
+def _select_stream(streams, format: str):
+    """
+    Pick the highest-bitrate audio-only stream, preferring the container the
+    requested format can be copied from.
+    """
+    audio_streams = list(streams.filter(only_audio=True))
+    if format in COPY_FORMATS:
+        matching = [s for s in audio_streams if s.subtype == COPY_FORMATS[format]]
+        audio_streams = matching or audio_streams
+    if not audio_streams:
+        raise ValueError("No audio-only stream available")
+    return max(audio_streams, key=_bitrate)
+
+
+def _resolve_format(format: str, source_subtype: str) -> str:
+    if format == "native":
+        return NATIVE_FORMATS.get(source_subtype, "m4a")
+    return format
+
+
+def _resolve_stream(url: str, format: str = "mp3"):
+    """
+    Blocking pytube lookup of the audio stream for a video.
+
+    :return: (stream, video length in seconds, 0 if unknown)
+    """
+    from pytube import YouTube
+
+    yt = YouTube(url)
+    return _select_stream(yt.streams, format), yt.length or 0
+
+
+async def _open_stream(song: str, video_info: Dict, format: str):
+    """
+    Resolve the audio stream and check the video's length before any audio is fetched.
+
+    Catches wrong picks the search-time check couldn't see: selections
+    resumed from a manifest, cached results without a duration. Skipped for
+    videos requested directly and when the search stage waived the check
+    because no result passed it.
+    """
+    loop = asyncio.get_event_loop()
+    async with get_upstream("stream").slot():
+        audio_stream, length = await loop.run_in_executor(
+            None, _resolve_stream, video_info["url"], format
+        )
+    if not video_info.get("duration_waived"):
+        expected = (video_info.get("track_info") or {}).get("length", 0)
+        verify_duration(song, length, expected)
+    return audio_stream
+
+
+async def fetch_audio(
     song: str,
     video_info: Dict,
     output_path: str,
+    position: Optional[int] = None,
     format: str = "mp3",
-    quality: str = "high",
-) -> Optional[str]:
+) -> str:
     """
-    Download audio from a YouTube video, convert it to MP3, and set metadata.
+    Download the raw audio stream for a video without converting it.
 
     :param song: Original song query
     :param video_info: Dictionary containing video information
     :param output_path: Directory to save the downloaded file
-    :return: Path to the downloaded MP3 file, or None if download failed
+    :param position: Progress bar line to draw on when several downloads run at once
+    :param format: Requested output format, used to pick the source stream
+    :return: Path to the downloaded source file
     """
-    url = video_info["url"]
-    logger.info(f"[{song}] Downloading from URL: {url}")
+    from tqdm import tqdm
 
-    for attempt in range(MAX_RETRIES):
+    audio_stream = await _open_stream(song, video_info, format)
+    # Named after the video so a retry or a re-run resumes the same partial file
+    output_file = os.path.join(
+        output_path, f"{video_info['videoId']}.{audio_stream.subtype}"
+    )
+
+    progress_bar = tqdm(
+        total=audio_stream.filesize,
+        unit="B",
+        unit_scale=True,
+        desc=song,
+        ncols=70,
+        position=position,
+        leave=position is None,
+    )
+    try:
+        with metrics.timer("download"):
+            await download_ranges(
+                audio_stream.url,
+                output_file,
+                audio_stream.filesize,
+                on_progress=progress_bar.update,
+            )
+    finally:
+        progress_bar.close()
+
+    logger.info(f"[{song}] Downloaded audio file: {output_file}")
+    return output_file
+
+
+def _codec_args(format: str, quality: str, source_subtype: str = "") -> List[str]:
+    """
+    ffmpeg audio arguments: a plain remux when the source codec already suits
+    the container, otherwise an encode at the requested quality.
+    """
+    if COPY_FORMATS.get(format) == source_subtype:
+        return ["-vn", "-acodec", "copy"]
+    return [
+        "-vn",
+        "-acodec",
+        ENCODERS.get(format, "aac"),
+        "-b:a",
+        "320k" if quality == "high" else "192k" if quality == "medium" else "128k",
+    ]
+
+
+def _output_file(video_info: Dict, output_path: str, format: str) -> str:
+    artist, title = video_info["correct_title"].split(" - ", 1)
+    clean_name = clean_filename(f"{artist} - {title}")
+    return os.path.join(output_path, f"{clean_name}.{format}")
+
+
+async def duplicate_output(
+    song: str, source_file: str, video_info: Dict, output_path: str, source_info: Dict
+) -> str:
+    """
+    Give another request for an already-downloaded video its own file.
+
+    The file is hard-linked when only the directory differs and both
+    requests carry the same title and album info (a link shares its tags),
+    and copied then re-tagged otherwise. Falls back to a copy across
+    filesystems.
+
+    :param source_file: File produced for the first request
+    :param video_info: The other request's best match, including its correct_title
+    :param source_info: The first request's best match, whose tags source_file carries
+    :return: Path to the other request's file
+    """
+    format = os.path.splitext(source_file)[1].lstrip(".")
+    new_file = _output_file(video_info, output_path, format)
+    if os.path.abspath(new_file) == os.path.abspath(source_file):
+        return source_file
+    os.makedirs(output_path, exist_ok=True)
+    if os.path.exists(new_file):
+        os.remove(new_file)
+
+    same_tags = all(
+        video_info.get(field) == source_info.get(field)
+        for field in ("correct_title", "track_info")
+    )
+    if same_tags and os.path.basename(new_file) == os.path.basename(source_file):
         try:
-            yt = YouTube(url)
-            audio_stream = yt.streams.filter(only_audio=True).first()
+            os.link(source_file, new_file)
+            logger.info(f"[{song}] Linked shared download: {new_file}")
+            return new_file
+        except OSError:
+            pass
+        shutil.copy2(source_file, new_file)
+    else:
+        shutil.copy2(source_file, new_file)
+        await _tag(song, new_file, video_info)
+    logger.info(f"[{song}] Copied shared download: {new_file}")
+    return new_file
+
+
+def _report(on_stage: Optional[Callable[[str], None]], stage: str) -> None:
+    if on_stage is not None:
+        on_stage(stage)
 
-            # Create a progress bar
+
+async def _tag(song: str, new_file: str, video_info: Dict) -> None:
+    artist, title = video_info["correct_title"].split(" - ", 1)
+    # Album tracks carry MusicBrainz's names, numbering and ids
+    track_info = video_info.get("track_info") or {}
+    cover = await fetch_cover_art(track_info.get("musicbrainz_albumid"))
+    logger.info(f"[{song}] Setting metadata for: {new_file}")
+    set_metadata(
+        new_file,
+        track_info.get("title", title),
+        track_info.get("artist", artist),
+        track_info.get("album", ""),
+        track_info.get("date", ""),
+        url=video_info["url"],
+        track_info=track_info,
+        cover=cover,
+    )
+
+
+async def convert_audio(
+    song: str,
+    input_file: str,
+    video_info: Dict,
+    output_path: str,
+    format: str = "mp3",
+    quality: str = "high",
+    on_stage: Optional[Callable[[str], None]] = None,
+) -> Optional[str]:
+    """
+    Convert a downloaded audio stream to the desired format and set metadata.
+
+    :param song: Original song query
+    :param input_file: Path to the downloaded source file
+    :param video_info: Dictionary containing video information
+    :param output_path: Directory to save the converted file
+    :return: Path to the converted file, or None if conversion failed
+    """
+    source_subtype = os.path.splitext(input_file)[1].lstrip(".").lower()
+    format = _resolve_format(format, source_subtype)
+    new_file = _output_file(video_info, output_path, format)
+
+    # Convert to desired format using the ffmpeg worker pool
+    try:
+        await transcoder.transcode(
+            song,
+            [
+                "-y",
+                "-i",
+                input_file,
+                *_codec_args(format, quality, source_subtype),
+                new_file,
+            ],
+        )
+        logger.info(f"[{song}] Converted to {format}: {new_file}")
+    except subprocess.CalledProcessError as e:
+        logger.error(f"[{song}] Error converting to {format}: {e}")
+        return None
+    _report(on_stage, "transcoded")
+
+    await _tag(song, new_file, video_info)
+    _report(on_stage, "tagged")
+
+    logger.info(f"[{song}] Removing original file: {input_file}")
+    os.remove(input_file)
+
+    return new_file
+
+
+def _downloaded_source(video_info: Dict, output_path: str) -> Optional[str]:
+    # fetch_audio's {videoId}.{subtype} file, once its progress sidecar is gone
+    if not os.path.isdir(output_path):
+        return None
+    for entry in os.scandir(output_path):
+        stem, extension = os.path.splitext(entry.name)
+        if (
+            stem == video_info["videoId"]
+            and extension
+            and entry.is_file()
+            and not os.path.exists(entry.path + SIDECAR_SUFFIX)
+        ):
+            return entry.path
+    return None
+
+
+def _converted_output(video_info: Dict, output_path: str, format: str) -> Optional[str]:
+    formats = NATIVE_FORMATS.values() if format == "native" else [format]
+    for candidate in formats:
+        new_file = _output_file(video_info, output_path, candidate)
+        if os.path.exists(new_file):
+            return new_file
+    return None
+
+
+async def resume_audio(
+    song: str,
+    video_info: Dict,
+    output_path: str,
+    state: str,
+    format: str = "mp3",
+    quality: str = "high",
+    on_stage: Optional[Callable[[str], None]] = None,
+) -> Optional[str]:
+    """
+    Finish a track an interrupted run left downloaded or transcoded, without fetching it again.
+
+    :param state: Manifest state the track reached, "downloaded" or "transcoded"
+    :return: Path to the finished file, or None when the files to pick up from
+        are gone and the track has to be downloaded again
+    """
+    source = _downloaded_source(video_info, output_path)
+    if state == "transcoded":
+        new_file = _converted_output(video_info, output_path, format)
+        if new_file:
+            logger.info(f"[{song}] Resuming at tagging: {new_file}")
+            await _tag(song, new_file, video_info)
+            _report(on_stage, "tagged")
+            if source:
+                os.remove(source)
+            return new_file
+    if source:
+        logger.info(f"[{song}] Resuming at conversion of {source}")
+        return await convert_audio(
+            song, source, video_info, output_path, format, quality, on_stage
+        )
+    return None
+
+
+async def stream_audio(
+    song: str,
+    video_info: Dict,
+    output_path: str,
+    format: str = "mp3",
+    quality: str = "high",
+    position: Optional[int] = None,
+    on_stage: Optional[Callable[[str], None]] = None,
+    download_limit: Optional[asyncio.Semaphore] = None,
+    transcode_limit: Optional[asyncio.Semaphore] = None,
+) -> Optional[str]:
+    """
+    Download the audio stream and pipe it straight into ffmpeg.
+
+    Encoding overlaps the download and the source file never touches disk,
+    so peak disk usage per track is just the output file. The download slot
+    is held only until the last byte is read and the transcode slot until
+    ffmpeg exits; tagging holds neither.
+
+    :param song: Original song query
+    :param video_info: Dictionary containing video information
+    :param output_path: Directory to save the converted file
+    :param position: Progress bar line to draw on when several downloads run at once
+    :param download_limit: Semaphore bounding concurrent downloads
+    :param transcode_limit: Semaphore bounding concurrent streaming ffmpeg processes
+    :return: Path to the converted file, or None if ffmpeg failed
+    """
+    from aiohttp import ClientError, ClientPayloadError
+    from tqdm import tqdm
+
+    started = time.monotonic()
+    # Always taken download first, then transcode, like every other caller
+    async with AsyncExitStack() as download_slot:
+        await download_slot.enter_async_context(download_limit or no_limit())
+        async with transcode_limit or no_limit():
+            audio_stream = await _open_stream(song, video_info, format)
+            filesize = audio_stream.filesize
+            format = _resolve_format(format, audio_stream.subtype)
+            new_file = _output_file(video_info, output_path, format)
+            os.makedirs(output_path, exist_ok=True)
+
+            process = await asyncio.create_subprocess_exec(
+                FFMPEG_PATH,
+                "-y",
+                "-loglevel",
+                "error",
+                "-i",
+                "pipe:0",
+                *_codec_args(format, quality, audio_stream.subtype),
+                new_file,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            # Drain stderr alongside the writes so a chatty ffmpeg can't fill the pipe and stall
+            stderr_task = asyncio.ensure_future(process.stderr.read())
+
+            streamed = 0
             progress_bar = tqdm(
-                total=audio_stream.filesize,
+                total=filesize,
                 unit="B",
                 unit_scale=True,
                 desc=song,
                 ncols=70,
+                position=position,
+                leave=position is None,
             )
+            try:
+                for start in range(0, filesize, STREAM_RANGE_SIZE):
+                    end = min(start + STREAM_RANGE_SIZE, filesize) - 1
+                    # A failed range is retried from the first byte ffmpeg hasn't had
+                    # yet, so the encode carries on instead of starting over
+                    offset = start
+                    for attempt in range(MAX_RETRIES):
+                        try:
+                            async with get_upstream("stream").slot(), await request(
+                                "GET",
+                                audio_stream.url,
+                                headers={"Range": f"bytes={offset}-{end}"},
+                                upstream="stream",
+                            ) as response:
+                                response.raise_for_status()
+                                async for chunk in response.content.iter_chunked(STREAM_READ_SIZE):
+                                    process.stdin.write(chunk)
+                                    await process.stdin.drain()
+                                    progress_bar.update(len(chunk))
+                                    streamed += len(chunk)
+                                    offset += len(chunk)
+                                if offset <= end:
+                                    raise ClientPayloadError(f"short read, stopped at byte {offset}")
+                            break
+                        except (ClientError, asyncio.TimeoutError) as e:
+                            if attempt == MAX_RETRIES - 1:
+                                raise
+                            logger.warning(
+                                f"[{song}] Range {offset}-{end} failed (attempt {attempt + 1}): {e}"
+                            )
+                            metrics.inc("retries", stage="stream")
+                            await get_upstream("stream").backoff(attempt)
+                # Every byte is read: the next track can start downloading while
+                # ffmpeg finishes the encode
+                await download_slot.aclose()
+                process.stdin.close()
+                await process.wait()
+            except BaseException:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                if os.path.exists(new_file):
+                    os.remove(new_file)
+                raise
+            finally:
+                progress_bar.close()
+                metrics.inc("bytes_downloaded", streamed)
+                metrics.observe("stage_seconds", time.monotonic() - started, stage="stream")
 
-            def progress_callback(stream, chunk, bytes_remaining):
-                current = audio_stream.filesize - bytes_remaining
-                progress_bar.update(current - progress_bar.n)
+            stderr = (await stderr_task).decode(errors="replace").strip()
 
-            yt.register_on_progress_callback(progress_callback)
+    if process.returncode != 0:
+        logger.error(f"[{song}] Error converting to {format}: {stderr}")
+        if os.path.exists(new_file):
+            os.remove(new_file)
+        return None
 
-            output_file = audio_stream.download(output_path=output_path)
-            progress_bar.close()
+    logger.info(
+        f"[{song}] Streamed and converted to {format} in {time.monotonic() - started:.2f}s: {new_file}"
+    )
+    _report(on_stage, "downloaded")
+    _report(on_stage, "transcoded")
+    await _tag(song, new_file, video_info)
+    _report(on_stage, "tagged")
+    return new_file
 
-            logger.info(f"[{song}] Downloaded audio file: {output_file}")
 
-            artist, title = video_info["correct_title"].split(" - ", 1)
-            clean_name = clean_filename(f"{artist} - {title}")
-            new_file = os.path.join(output_path, f"{clean_name}.{format}")
+async def download_audio(
+    song: str,
+    video_info: Dict,
+    output_path: str,
+    format: str = "mp3",
+    quality: str = "high",
+    download_limit: Optional[asyncio.Semaphore] = None,
+    transcode_limit: Optional[asyncio.Semaphore] = None,
+    position: Optional[int] = None,
+    streaming: bool = STREAMING_DOWNLOADS,
+    on_stage: Optional[Callable[[str], None]] = None,
+) -> Optional[str]:
+    """
+    Download audio from a YouTube video, convert it to MP3, and set metadata.
 
-            # Convert to desired format using ffmpeg
-            try:
-                subprocess.run(
-                    [
-                        FFMPEG_PATH,
-                        "-i",
-                        output_file,
-                        "-acodec",
-                        "libmp3lame" if format == "mp3" else "aac",
-                        "-b:a",
-                        (
-                            "320k"
-                            if quality == "high"
-                            else "192k" if quality == "medium" else "128k"
-                        ),
-                        new_file,
-                    ],
-                    check=True,
-                    capture_output=True,
-                )
-                logger.info(f"[{song}] Converted to {format}: {new_file}")
-            except subprocess.CalledProcessError as e:
-                logger.error(f"[{song}] Error converting to {format}: {e}")
-                return None
+    :param song: Original song query
+    :param video_info: Dictionary containing video information
+    :param output_path: Directory to save the downloaded file
+    :param format: mp3 (re-encoded), m4a or opus (remuxed without re-encoding
+        when the source stream allows), or native (whichever of m4a/opus the
+        best stream copies into)
+    :param download_limit: Semaphore bounding concurrent downloads
+    :param transcode_limit: Semaphore bounding concurrent streaming ffmpeg processes;
+        file conversions are bounded by the transcode worker pool instead
+    :param position: Progress bar line to draw on when several downloads run at once
+    :param streaming: Pipe the download straight into ffmpeg instead of going through a temporary file
+    :param on_stage: Called with "downloaded", "transcoded" and "tagged" as each stage completes
+    :return: Path to the downloaded MP3 file, or None if download failed
+    """
+    url = video_info["url"]
+    logger.info(f"[{song}] Downloading from URL: {url}")
 
-            logger.info(f"[{song}] Setting metadata for: {new_file}")
-            set_metadata(new_file, title, artist, video_info["channelTitle"], url=url)
+    for attempt in range(MAX_RETRIES):
+        try:
+            if streaming:
+                # Download and encode run together; stream_audio holds both stage slots
+                return await stream_audio(
+                    song,
+                    video_info,
+                    output_path,
+                    format,
+                    quality,
+                    position,
+                    on_stage,
+                    download_limit,
+                    transcode_limit,
+                )
 
-            logger.info(f"[{song}] Removing original file: {output_file}")
-            os.remove(output_file)
+            async with download_limit or no_limit():
+                output_file = await fetch_audio(
+                    song, video_info, output_path, position, format
+                )
+            _report(on_stage, "downloaded")
 
-            return new_file
+            # Releasing the download slot first lets the next track start
+            # fetching while this one waits in the transcode queue
+            return await convert_audio(
+                song, output_file, video_info, output_path, format, quality, on_stage
+            )
+        except DurationMismatch as e:
+            # The same video would fail again; retrying only costs bandwidth
+            logger.error(f"[{song}] Skipping '{url}': {e}")
+            return None
         except Exception as e:
             logger.warning(
                 f"[{song}] Attempt {attempt + 1} failed for URL '{url}': {str(e)}"
             )
+            metrics.inc("retries", stage="download")
             if attempt == MAX_RETRIES - 1:
                 logger.error(
                     f"[{song}] All download attempts failed for URL '{url}': {str(e)}"
                 )
                 return None
-            await asyncio.sleep(2**attempt)  # Exponential backoff
+            await get_upstream("stream").backoff(attempt)
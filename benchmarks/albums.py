@@ -0,0 +1,75 @@
+# albums.py
+"""
+Concurrent album expansion check.
+
+Runs several query_album calls at once against the fake services with a
+single MusicBrainz slot (what the adaptive limit drops to after one 503)
+and fails if they don't all return their tracks in time, so a lookup that
+holds its slot while waiting on another one shows up as a failure rather
+than a hung run.
+
+  python -m benchmarks.albums
+  python -m benchmarks.albums --albums 8 --concurrency 2
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+from benchmarks.run import start_services
+
+TIMEOUT = 30.0
+
+
+async def expand(albums: int) -> list:
+  # Imported late so config picks up the environment set by main
+  from album_query import query_album
+  from database import cache
+  from http_client import close_session
+
+  try:
+    return await asyncio.gather(
+      *(query_album(f"Benchmark Album {i}", f"Benchmark Artist {i}") for i in range(albums))
+    )
+  finally:
+    await close_session()
+    cache.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Check that concurrent album lookups complete")
+  parser.add_argument("--albums", type=int, default=4, help="Albums looked up at once")
+  parser.add_argument("--tracks", type=int, default=12, help="Tracks on every fake release")
+  parser.add_argument("--concurrency", type=int, default=1, help="MUSICBRAINZ_CONCURRENCY for the run")
+  parser.add_argument("--timeout", type=float, default=TIMEOUT, help="Seconds allowed for every lookup to return")
+  args = parser.parse_args()
+
+  server, port = start_services({"latency": 0.05, "album_tracks": args.tracks})
+  base_url = f"http://127.0.0.1:{port}"
+  try:
+    with tempfile.TemporaryDirectory(prefix="music-downloader-albums-") as directory:
+      os.environ.update({
+        "MUSICBRAINZ_API_URL": f"{base_url}/ws/2",
+        "MUSICBRAINZ_CONCURRENCY": str(args.concurrency),
+        "CACHE_ENABLED": "0",
+        "MB_INDEX_DIR": "",
+        "COVER_ART_DIR": os.path.join(directory, "covers"),
+      })
+      try:
+        results = asyncio.run(asyncio.wait_for(expand(args.albums), args.timeout))
+      except asyncio.TimeoutError:
+        print(f"FAILED: {args.albums} concurrent album lookups didn't return within {args.timeout:.0f}s")
+        sys.exit(1)
+  finally:
+    server.terminate()
+    server.wait()
+
+  counts = [len(tracks or []) for tracks in results]
+  ok = all(count == args.tracks for count in counts)
+  print(f"{'ok' if ok else 'FAILED'}: tracks per album {counts}")
+  sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,357 @@
+# fake_services.py
+"""
+Local stand-ins for the services the downloader talks to, for offline benchmarks.
+
+One aiohttp app serves all of them under different path prefixes:
+  /youtube/v3/search, /youtube/v3/videos  YouTube Data API search and videos.list
+  /v1/chat/completions                    OpenAI chat completions answering with a tool call
+  /ws/2/release                           MusicBrainz release search and lookup
+  /coverart/release/{id}/front-{size}     Cover Art Archive front covers
+  /stream/{video_id}                      Audio bytes honouring Range requests
+
+Payloads are generated deterministically from the query, so two runs of a
+scenario see the same results. Latency, bandwidth and failure rate are
+configurable to model slow or flaky upstreams.
+
+Run as `python -m benchmarks.fake_services --port 8765`; prints the bound
+port on stdout once listening.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+from typing import Dict, List
+
+from aiohttp import web
+
+ID_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r"bytes=(\d+)-(\d*)")
+QUERY_RE = re.compile(r"^Query(?: (\d+))?: (.*)$", re.MULTILINE)
+
+# Uploads that surround the real track on a typical results page, with
+# their length given the studio track's
+DECOYS = [
+  ("{artist} - {title} (Live)", "{artist}", lambda length: length + 45),
+  ("{title} - Karaoke Version", "Sing King", lambda length: length + 5),
+  ("{artist} - {title} (Cover)", "Random Covers", lambda length: length + 12),
+  ("{title} (Sped Up)", "nightcore tunes", lambda length: int(length * 0.8)),
+  ("{artist} - {title} [1 Hour Loop]", "Loops Forever", lambda length: 3600),
+  ("{title} Piano Tutorial", "Piano Lessons", lambda length: 720),
+  ("{artist} - {title} (Instrumental)", "Instrumentals", lambda length: length),
+  ("{artist} {title} reaction", "Reacts Daily", lambda length: length + 420),
+]
+
+
+def _digest(text: str) -> bytes:
+  return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+def video_id_for(text: str) -> str:
+  return "".join(ID_ALPHABET[byte % len(ID_ALPHABET)] for byte in _digest(text)[:11])
+
+
+def track_length(artist: str, title: str) -> int:
+  """
+  Studio length of a track in seconds, shared by the release lookup and the videos it finds.
+  """
+  return 150 + _digest(f"{artist} - {title}".lower())[0] % 150
+
+
+def _split_query(query: str):
+  if " - " in query:
+    artist, title = query.split(" - ", 1)
+    return artist.strip(), title.strip()
+  return "Unknown Artist", query.strip()
+
+
+class FakeServices:
+  """
+  State and handlers for the fake upstreams.
+
+  :param latency: Seconds added before every API response
+  :param stream_latency: Seconds added before every stream response
+  :param bandwidth: Stream throughput per request in bytes/second (0 for unlimited)
+  :param failure_rate: Fraction of stream requests answered with a 500
+  :param track_size: Size in bytes of every audio stream
+  :param album_tracks: Number of tracks on every MusicBrainz release
+  :param ambiguous_rate: Fraction of queries whose results the local ranker
+    can't settle, so they go to the LLM stand-in
+  :param seed: Seed for the failure injection
+  """
+
+  def __init__(
+    self,
+    latency: float = 0.05,
+    stream_latency: float = 0.05,
+    bandwidth: int = 0,
+    failure_rate: float = 0.0,
+    track_size: int = 512 * 1024,
+    album_tracks: int = 12,
+    ambiguous_rate: float = 0.5,
+    seed: int = 0,
+  ):
+    self.latency = latency
+    self.stream_latency = stream_latency
+    self.bandwidth = bandwidth
+    self.failure_rate = failure_rate
+    self.track_size = track_size
+    self.album_tracks = album_tracks
+    self.ambiguous_rate = ambiguous_rate
+    self.random = random.Random(seed)
+    self.videos: Dict[str, Dict] = {}
+    self.requests: Dict[str, int] = {}
+    self.payload = bytes(range(256)) * (CHUNK_SIZE // 256)
+
+  def app(self) -> web.Application:
+    app = web.Application()
+    app.router.add_get("/youtube/v3/search", self.youtube_search)
+    app.router.add_get("/youtube/v3/videos", self.youtube_videos)
+    app.router.add_post("/v1/chat/completions", self.chat_completions)
+    app.router.add_get("/ws/2/release", self.musicbrainz_search)
+    app.router.add_get("/ws/2/release/{release_id}", self.musicbrainz_release)
+    app.router.add_get("/coverart/release/{release_id}/{image}", self.cover_art)
+    app.router.add_get("/stream/{video_id}", self.stream)
+    app.router.add_get("/stats", self.stats)
+    return app
+
+  async def _delay(self, endpoint: str, seconds: float) -> None:
+    self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+    if seconds:
+      await asyncio.sleep(seconds)
+
+  def _is_ambiguous(self, query: str) -> bool:
+    return _digest(query)[-1] / 256 < self.ambiguous_rate
+
+  def _results_for(self, query: str, count: int) -> List[Dict]:
+    artist, title = _split_query(query)
+    length = track_length(artist, title)
+    if self._is_ambiguous(query):
+      # Re-uploads that never name the artist; the ranker can't vouch for them, so the LLM decides
+      uploads = [
+        (title, "Music Uploads", length),
+        (f"{title} (Lyrics)", "Lyrics Hub", length + 2),
+      ]
+    else:
+      uploads = [(title, f"{artist} - Topic", length)]
+    uploads += [
+      (name.format(artist=artist, title=title), channel.format(artist=artist), decoy_length(length))
+      for name, channel, decoy_length in DECOYS
+    ]
+
+    results = []
+    for rank, (name, channel, seconds) in enumerate(uploads[:count]):
+      video_id = video_id_for(f"{query}|{rank}")
+      snippet = {
+        "title": name,
+        "description": f"{name} uploaded by {channel}",
+        "channelTitle": channel,
+        "publishedAt": f"20{10 + rank % 14:02d}-01-01T00:00:00Z",
+      }
+      views = int.from_bytes(_digest(video_id)[:3], "big") * (count - rank)
+      self.videos[video_id] = {
+        "snippet": snippet,
+        "statistics": {
+          "viewCount": str(views),
+          "likeCount": str(views // 50),
+          "dislikeCount": str(views // 2000),
+        },
+        "contentDetails": {"duration": f"PT{seconds // 60}M{seconds % 60}S"},
+      }
+      results.append({"id": {"kind": "youtube#video", "videoId": video_id}, "snippet": snippet})
+    return results
+
+  async def youtube_search(self, request: web.Request) -> web.Response:
+    await self._delay("youtube_search", self.latency)
+    query = request.query.get("q", "")
+    count = int(request.query.get("maxResults", 10))
+    return web.json_response({"items": self._results_for(query, count)})
+
+  async def youtube_videos(self, request: web.Request) -> web.Response:
+    await self._delay("youtube_videos", self.latency)
+    parts = request.query.get("part", "").split(",")
+    items = []
+    for video_id in filter(None, request.query.get("id", "").split(",")):
+      video = self.videos.get(video_id)
+      if video is None:
+        # Direct links to videos we never returned from a search
+        self._results_for(f"Linked Artist - Video {video_id}", 1)
+        video = self.videos[video_id_for(f"Linked Artist - Video {video_id}|0")]
+      item = {"id": video_id}
+      for part in parts:
+        if part in video:
+          item[part] = video[part]
+      items.append(item)
+    return web.json_response({"items": items})
+
+  async def chat_completions(self, request: web.Request) -> web.Response:
+    await self._delay("openai", self.latency)
+    body = await request.json()
+    prompt = body["messages"][-1]["content"]
+    function = body["tool_choice"]["function"]["name"]
+
+    def selection(query: str) -> Dict:
+      artist, title = _split_query(query)
+      return {
+        "best_match_index": 1,
+        "correct_title": f"{artist} - {title}",
+        "explanation": "Canned benchmark selection",
+      }
+
+    queries = QUERY_RE.findall(prompt)
+    if function == "select_best_matches":
+      arguments = {
+        "selections": [
+          {"query_index": int(index or 0), **selection(query)} for index, query in queries
+        ]
+      }
+    else:
+      arguments = selection(queries[0][1] if queries else "")
+
+    prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 4
+    completion_tokens = len(json.dumps(arguments)) // 4
+    return web.json_response({
+      "id": "chatcmpl-bench",
+      "object": "chat.completion",
+      "created": 0,
+      "model": body.get("model", "gpt-4o"),
+      "choices": [{
+        "index": 0,
+        "finish_reason": "tool_calls",
+        "message": {
+          "role": "assistant",
+          "content": None,
+          "tool_calls": [{
+            "id": "call_bench",
+            "type": "function",
+            "function": {"name": function, "arguments": json.dumps(arguments)},
+          }],
+        },
+      }],
+      "usage": {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+      },
+    })
+
+  async def musicbrainz_search(self, request: web.Request) -> web.Response:
+    await self._delay("musicbrainz", self.latency)
+    query = request.query.get("query", "")
+    return web.json_response({
+      "releases": [{"id": f"release-{video_id_for(query)}", "score": 100, "status": "Official"}]
+    })
+
+  async def musicbrainz_release(self, request: web.Request) -> web.Response:
+    await self._delay("musicbrainz", self.latency)
+    release_id = request.match_info["release_id"]
+    artist = f"Artist {release_id[-4:]}"
+    credit = [{"name": artist, "artist": {"id": f"artist-{release_id}", "name": artist}}]
+    return web.json_response({
+      "id": release_id,
+      "title": f"Album {release_id[-4:]}",
+      "date": "2001-02-03",
+      "artist-credit": credit,
+      "media": [{
+        "position": 1,
+        "track-count": self.album_tracks,
+        "tracks": [
+          {
+            "id": f"track-{release_id}-{n}",
+            "position": n,
+            "number": str(n),
+            "title": f"Track {n:02d}",
+            "length": track_length(artist, f"Track {n:02d}") * 1000,
+            "artist-credit": credit,
+            "recording": {"id": f"recording-{release_id}-{n}", "title": f"Track {n:02d}"},
+          }
+          for n in range(1, self.album_tracks + 1)
+        ],
+      }],
+    })
+
+  async def cover_art(self, request: web.Request) -> web.Response:
+    await self._delay("coverart", self.latency)
+    # A JPEG signature and some padding; enough for the tag writers
+    return web.Response(body=b"\xff\xd8\xff\xe0" + bytes(32 * 1024), content_type="image/jpeg")
+
+  async def stream(self, request: web.Request) -> web.StreamResponse:
+    await self._delay("stream", self.stream_latency)
+    if self.random.random() < self.failure_rate:
+      self.requests["stream_failures"] = self.requests.get("stream_failures", 0) + 1
+      return web.Response(status=500, text="injected failure")
+
+    start, end = 0, self.track_size - 1
+    match = RANGE_RE.match(request.headers.get("Range", ""))
+    if match:
+      start = int(match.group(1))
+      if match.group(2):
+        end = min(int(match.group(2)), end)
+    length = max(0, end - start + 1)
+
+    response = web.StreamResponse(status=206 if match else 200)
+    response.content_type = "audio/webm"
+    response.content_length = length
+    if match:
+      response.headers["Content-Range"] = f"bytes {start}-{end}/{self.track_size}"
+    await response.prepare(request)
+    remaining = length
+    while remaining > 0:
+      chunk = self.payload[:min(CHUNK_SIZE, remaining)]
+      await response.write(chunk)
+      remaining -= len(chunk)
+      if self.bandwidth:
+        await asyncio.sleep(len(chunk) / self.bandwidth)
+    await response.write_eof()
+    return response
+
+  async def stats(self, request: web.Request) -> web.Response:
+    return web.json_response(self.requests)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+  parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every API response")
+  parser.add_argument("--stream-latency", type=float, default=0.05, help="Seconds added before every stream response")
+  parser.add_argument("--bandwidth", type=int, default=0, help="Stream bytes/second per request (0 for unlimited)")
+  parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of stream requests that fail")
+  parser.add_argument("--track-size", type=int, default=512 * 1024, help="Bytes per audio stream")
+  parser.add_argument("--album-tracks", type=int, default=12, help="Tracks on every fake release")
+  parser.add_argument("--ambiguous-rate", type=float, default=0.5, help="Fraction of queries left to the LLM")
+
+
+async def serve(args: argparse.Namespace) -> None:
+  services = FakeServices(
+    latency=args.latency,
+    stream_latency=args.stream_latency,
+    bandwidth=args.bandwidth,
+    failure_rate=args.failure_rate,
+    track_size=args.track_size,
+    album_tracks=args.album_tracks,
+    ambiguous_rate=args.ambiguous_rate,
+  )
+  runner = web.AppRunner(services.app(), access_log=None)
+  await runner.setup()
+  site = web.TCPSite(runner, "127.0.0.1", args.port)
+  await site.start()
+  port = runner.addresses[0][1]
+  print(port, flush=True)
+  try:
+    await asyncio.Event().wait()
+  finally:
+    await runner.cleanup()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Serve fake YouTube, OpenAI and MusicBrainz endpoints")
+  parser.add_argument("--port", type=int, default=0, help="Port to listen on (0 picks a free one)")
+  add_arguments(parser)
+  try:
+    asyncio.run(serve(parser.parse_args()))
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,299 @@
+# run.py
+"""
+Offline throughput benchmarks.
+
+Each scenario starts the fake services in a subprocess, points the
+downloader's endpoints (and FFMPEG_PATH) at them through the environment,
+then drives a TrackPipeline over the scenario's entries and reports
+tracks/minute, exact p50/p95 per-track latency and the peak RSS of the
+benchmark process.
+
+  python -m benchmarks.run songs-1000
+  python -m benchmarks.run all --json results.json
+  python -m benchmarks.run flaky-30 --failure-rate 0.5 --bandwidth 2000000
+
+Scenarios run in a fresh interpreter each when several are requested, so
+peak RSS and module-level state don't leak from one into the next.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+try:
+  import resource
+except ImportError:  # Windows
+  resource = None
+
+from benchmarks.fake_services import add_arguments
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_FFMPEG = os.path.join(ROOT, "benchmarks", "fake_ffmpeg.py")
+
+SCENARIOS = {
+  "album-50": {
+    "description": "One 50-track album expanded through MusicBrainz",
+    "entries": lambda: [{"type": "album", "album": "Benchmark Album", "artist": "Benchmark Artist"}],
+    "services": {"album_tracks": 50},
+  },
+  "songs-1000": {
+    "description": "A 1000-song list, half of it left to the LLM",
+    "entries": lambda: [
+      {"type": "song", "song": f"Artist {i % 97:02d} - Song {i:04d}"} for i in range(1000)
+    ],
+    "services": {},
+  },
+  "flaky-30": {
+    "description": "200 songs with 30% of stream requests failing, using segmented downloads",
+    "entries": lambda: [
+      {"type": "song", "song": f"Flaky Artist {i % 13:02d} - Song {i:04d}"} for i in range(200)
+    ],
+    "services": {"failure_rate": 0.3, "track_size": 4 * 1024 * 1024},
+    "streaming": False,
+  },
+}
+
+
+def percentile(values: List[float], q: float) -> float:
+  """
+  Nearest-rank percentile of the raw samples.
+  """
+  if not values:
+    return 0.0
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))]
+
+
+def peak_rss_mb() -> Optional[float]:
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS bytes
+  return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def start_services(options: Dict) -> Tuple[subprocess.Popen, int]:
+  command = [sys.executable, "-m", "benchmarks.fake_services", "--port", "0"]
+  for key, value in options.items():
+    command += [f"--{key.replace('_', '-')}", str(value)]
+  server = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+  port = server.stdout.readline().strip()
+  if not port:
+    server.kill()
+    raise RuntimeError("Fake services failed to start")
+  return server, int(port)
+
+
+def ffmpeg_launcher(directory: str) -> str:
+  """
+  Write an executable that runs fake_ffmpeg.py with this interpreter, for FFMPEG_PATH.
+  """
+  if os.name == "nt":
+    path = os.path.join(directory, "ffmpeg.cmd")
+    with open(path, "w") as f:
+      f.write(f'@"{sys.executable}" "{FAKE_FFMPEG}" %*\n')
+  else:
+    path = os.path.join(directory, "ffmpeg")
+    with open(path, "w") as f:
+      f.write(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_FFMPEG}" "$@"\n')
+    os.chmod(path, 0o755)
+  return path
+
+
+async def drive(entries: List[Dict], output_path: str, concurrent_downloads: int, streaming: bool, base_url: str, track_size: int) -> Dict:
+  # Imported late so config picks up the environment set by run_scenario
+  import audio_download
+  from database import Manifest, cache
+  from http_client import close_session
+  from metrics import metrics
+  from pipeline import StageLimits, TrackPipeline
+  from transcode import transcoder
+
+  # Per-track log lines (and the expected retry warnings) would drown the report
+  logging.getLogger().setLevel(logging.ERROR)
+
+  def resolve_stream(url: str, format: str = "mp3"):
+    # pytube scrapes watch pages and player JavaScript, which has no sensible
+    # local stand-in; hand back a stream pointing at the fake byte server instead
+    video_id = url.rsplit("v=", 1)[-1]
+    stream = SimpleNamespace(
+      url=f"{base_url}/stream/{video_id}",
+      filesize=track_size,
+      subtype="webm",
+      abr="160kbps",
+    )
+    # Length unknown: durations are checked against videos.list at search time instead
+    return stream, 0
+
+  audio_download._resolve_stream = resolve_stream
+
+  class TimedPipeline(TrackPipeline):
+    latencies: List[float] = []
+
+    async def process_entry(self, entry: Dict) -> Optional[str]:
+      started = time.perf_counter()
+      try:
+        return await super().process_entry(entry)
+      finally:
+        self.latencies.append(time.perf_counter() - started)
+
+  async def stream_entries():
+    for entry in entries:
+      yield entry
+
+  manifest = Manifest(os.path.join(output_path, "manifest.sqlite3"))
+  limits = StageLimits(tracks=concurrent_downloads * 2, download=concurrent_downloads)
+  pipeline = TimedPipeline(output_path, limits, {"format": "mp3", "streaming": streaming}, manifest)
+  started = time.perf_counter()
+  try:
+    downloaded, total = await pipeline.run_entries(stream_entries())
+  finally:
+    elapsed = time.perf_counter() - started
+    await close_session()
+    await transcoder.close()
+    cache.close()
+    manifest.close()
+
+  counters = metrics.summary()["counters"]
+  return {
+    "tracks": total,
+    "downloaded": downloaded,
+    "seconds": round(elapsed, 2),
+    "tracks_per_minute": round(downloaded / elapsed * 60, 1) if elapsed else 0.0,
+    "p50_seconds": round(percentile(pipeline.latencies, 0.5), 3),
+    "p95_seconds": round(percentile(pipeline.latencies, 0.95), 3),
+    "counters": counters,
+  }
+
+
+def run_scenario(name: str, args: argparse.Namespace) -> Dict:
+  scenario = SCENARIOS[name]
+  services = {
+    "latency": 0.05,
+    "stream_latency": 0.05,
+    "bandwidth": 0,
+    "failure_rate": 0.0,
+    "track_size": 512 * 1024,
+    **scenario["services"],
+  }
+  for key in list(services) + ["album_tracks", "ambiguous_rate"]:
+    if getattr(args, key, None) is not None:
+      services[key] = getattr(args, key)
+  streaming = scenario.get("streaming", True) and not args.no_stream
+
+  server, port = start_services(services)
+  base_url = f"http://127.0.0.1:{port}"
+  try:
+    with tempfile.TemporaryDirectory(prefix="music-downloader-bench-") as directory:
+      os.environ.update({
+        "YOUTUBE_API_URL": f"{base_url}/youtube/v3",
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "MUSICBRAINZ_API_URL": f"{base_url}/ws/2",
+        "COVER_ART_URL": f"{base_url}/coverart",
+        "COVER_ART_DIR": os.path.join(directory, "covers"),
+        "YOUTUBE_API_KEY": "benchmark",
+        "OPENAI_API_KEY": "benchmark",
+        "FFMPEG_PATH": ffmpeg_launcher(directory),
+        "CACHE_ENABLED": "0",
+        "MB_INDEX_DIR": "",
+        "TQDM_DISABLE": "1",
+        # Quota units are still counted, but a run never waits on them
+        "YOUTUBE_DAILY_QUOTA": str(10 ** 9),
+        "YOUTUBE_QUOTA_PATH": os.path.join(directory, "youtube_quota.json"),
+      })
+      output_path = os.path.join(directory, "downloads")
+      os.makedirs(output_path)
+      result = asyncio.run(
+        drive(
+          scenario["entries"](), output_path, args.concurrent_downloads, streaming, base_url, services["track_size"]
+        )
+      )
+    with urllib.request.urlopen(f"{base_url}/stats") as response:
+      result["upstream_requests"] = json.load(response)
+  finally:
+    server.terminate()
+    server.wait()
+
+  return {
+    "scenario": name,
+    "description": scenario["description"],
+    "streaming": streaming,
+    "concurrent_downloads": args.concurrent_downloads,
+    "services": services,
+    **result,
+    "peak_rss_mb": peak_rss_mb(),
+  }
+
+
+def run_isolated(name: str, argv: List[str]) -> Dict:
+  output = subprocess.run(
+    [sys.executable, "-m", "benchmarks.run", name, "--json", "-", *argv],
+    cwd=ROOT,
+    stdout=subprocess.PIPE,
+    check=True,
+    text=True,
+  ).stdout
+  return json.loads(output)[0]
+
+
+def print_table(results: List[Dict]) -> None:
+  print(f"{'scenario':<12} {'tracks':>7} {'ok':>6} {'seconds':>8} {'tracks/min':>11} {'p50 s':>7} {'p95 s':>7} {'peak RSS MB':>12}")
+  for result in results:
+    print(
+      f"{result['scenario']:<12} {result['tracks']:>7} {result['downloaded']:>6} {result['seconds']:>8} "
+      f"{result['tracks_per_minute']:>11} {result['p50_seconds']:>7} {result['p95_seconds']:>7} {str(result['peak_rss_mb']):>12}"
+    )
+
+
+def parse_arguments(argv: Optional[List[str]] = None) -> Tuple[argparse.Namespace, List[str]]:
+  parser = argparse.ArgumentParser(description="Benchmark the download pipeline against local fake services")
+  parser.add_argument("scenario", choices=[*SCENARIOS, "all"], help="Scenario to run")
+  parser.add_argument("-c", "--concurrent-downloads", type=int, default=3, help="Concurrent downloads, as in main.py")
+  parser.add_argument("--no-stream", action="store_true", help="Use segmented downloads plus a separate transcode")
+  parser.add_argument("--json", metavar="PATH", help="Write results as JSON to PATH ('-' for stdout)")
+  add_arguments(parser)
+  # Fake service options only override a scenario's settings when given explicitly
+  parser.set_defaults(**{
+    key: None
+    for key in ("latency", "stream_latency", "bandwidth", "failure_rate", "track_size", "album_tracks", "ambiguous_rate")
+  })
+  argv = sys.argv[1:] if argv is None else argv
+  args = parser.parse_args(argv)
+  # Everything but the scenario and --json is forwarded to isolated runs
+  forwarded, skip = [], False
+  for arg in argv:
+    if skip:
+      skip = False
+    elif arg == "--json":
+      skip = True
+    elif arg != args.scenario and not arg.startswith("--json="):
+      forwarded.append(arg)
+  return args, forwarded
+
+
+def main():
+  args, forwarded = parse_arguments()
+  if args.scenario == "all":
+    results = [run_isolated(name, forwarded) for name in SCENARIOS]
+  else:
+    results = [run_scenario(args.scenario, args)]
+
+  if args.json == "-":
+    print(json.dumps(results, indent=2))
+    return
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(results, f, indent=2)
+  print_table(results)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,103 @@
+# startup.py
+"""
+Startup-time budget for the CLI.
+
+Times `main.py --help` and the interactive prompt (answered with 'exit')
+in fresh interpreters and fails when the median exceeds the budget, so a
+heavy import sneaking back onto the startup path shows up immediately.
+
+  python -m benchmarks.startup
+  python -m benchmarks.startup --runs 10 --help-budget 0.3 --importtime
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, "main.py")
+
+HELP_BUDGET = 0.4
+PROMPT_BUDGET = 0.5
+
+
+def time_command(args: List[str], stdin: Optional[str], env: Dict[str, str]) -> float:
+  started = time.perf_counter()
+  subprocess.run(
+    [sys.executable, *args],
+    cwd=ROOT,
+    input=stdin,
+    env=env,
+    stdout=subprocess.DEVNULL,
+    stderr=subprocess.DEVNULL,
+    text=True,
+    check=True,
+  )
+  return time.perf_counter() - started
+
+
+def slowest_imports(args: List[str], stdin: Optional[str], env: Dict[str, str], count: int = 10) -> List[str]:
+  """
+  Top-level imports ranked by cumulative time, from -X importtime.
+  """
+  output = subprocess.run(
+    [sys.executable, "-X", "importtime", *args],
+    cwd=ROOT,
+    input=stdin,
+    env=env,
+    stdout=subprocess.DEVNULL,
+    stderr=subprocess.PIPE,
+    text=True,
+  ).stderr
+  imports = []
+  for line in output.splitlines():
+    if not line.startswith("import time:") or "|" not in line:
+      continue
+    _, cumulative, name = line.split("|")
+    # Top-level imports are the ones indented by a single space
+    if name.startswith(" ") and not name.startswith("  ") and cumulative.strip().isdigit():
+      imports.append((int(cumulative), name.strip()))
+  return [f"{usec / 1000:8.1f} ms  {name}" for usec, name in sorted(imports, reverse=True)[:count]]
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Check CLI startup time against a budget")
+  parser.add_argument("--runs", type=int, default=5, help="Runs per command; the median is compared to the budget")
+  parser.add_argument("--help-budget", type=float, default=HELP_BUDGET, help="Seconds allowed for --help")
+  parser.add_argument("--prompt-budget", type=float, default=PROMPT_BUDGET, help="Seconds allowed to reach the interactive prompt and exit")
+  parser.add_argument("--importtime", action="store_true", help="Also list the slowest top-level imports")
+  args = parser.parse_args()
+
+  failed = False
+  with tempfile.TemporaryDirectory(prefix="music-downloader-startup-") as directory:
+    env = {
+      **os.environ,
+      "YOUTUBE_API_KEY": os.getenv("YOUTUBE_API_KEY") or "startup",
+      "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY") or "startup",
+      "CACHE_PATH": os.path.join(directory, "cache.sqlite3"),
+    }
+    commands = [
+      ("--help", [MAIN, "--help"], None, args.help_budget),
+      ("prompt", [MAIN, "-d", directory], "exit\n", args.prompt_budget),
+    ]
+    for label, command, stdin, budget in commands:
+      # One untimed run so the first measurement doesn't pay for cold bytecode caches
+      time_command(command, stdin, env)
+      timings = [time_command(command, stdin, env) for _ in range(args.runs)]
+      median = statistics.median(timings)
+      verdict = "ok" if median <= budget else "OVER BUDGET"
+      failed = failed or median > budget
+      print(f"{label:<7} median {median:.3f}s  min {min(timings):.3f}s  budget {budget:.2f}s  {verdict}")
+      if args.importtime:
+        for line in slowest_imports(command, stdin, env):
+          print(f"          {line}")
+
+  sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+  main()
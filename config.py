@@ -6,7 +6,116 @@ load_dotenv()
 
 YOUTUBE_API_KEY = os.getenv('YOUTUBE_API_KEY')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+# Service endpoints; overridable so the benchmarks can point at local stand-ins
+YOUTUBE_API_URL = os.getenv('YOUTUBE_API_URL', 'https://www.googleapis.com/youtube/v3')
+MUSICBRAINZ_API_URL = os.getenv('MUSICBRAINZ_API_URL', 'https://musicbrainz.org/ws/2')
+COVER_ART_URL = os.getenv('COVER_ART_URL', 'https://coverartarchive.org')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL') or None
 FFMPEG_PATH = os.getenv('FFMPEG_PATH', r"C:\Program Files\ffmpeg\bin\ffmpeg.exe")
 DEFAULT_DOWNLOAD_DIR = os.getenv('DEFAULT_DOWNLOAD_DIR', 'downloads')
+DEFAULT_FORMAT = os.getenv('DEFAULT_FORMAT', 'mp3')
+
+# Logging: level, 'text' or 'json' lines, and the size and sample rate of API payloads logged at DEBUG
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv('LOG_PAYLOAD_MAX_CHARS', '2000'))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '1.0'))
+
+# Job manifest kept inside the download directory
+MANIFEST_FILENAME = os.getenv('MANIFEST_FILENAME', '.music_downloader_manifest.sqlite3')
 MAX_RETRIES = int(os.getenv('MAX_RETRIES', '3'))
-CONCURRENT_DOWNLOADS = int(os.getenv('CONCURRENT_DOWNLOADS', '3'))
\ No newline at end of file
+CONCURRENT_DOWNLOADS = int(os.getenv('CONCURRENT_DOWNLOADS', '3'))
+
+# Per-stage concurrency limits for the track pipeline
+TRACKS_IN_FLIGHT = int(os.getenv('TRACKS_IN_FLIGHT', str(CONCURRENT_DOWNLOADS * 2)))
+SEARCH_CONCURRENCY = int(os.getenv('SEARCH_CONCURRENCY', '4'))
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '4'))
+ALBUM_CONCURRENCY = int(os.getenv('ALBUM_CONCURRENCY', '4'))
+TRANSCODE_CONCURRENCY = int(os.getenv('TRANSCODE_CONCURRENCY', str(os.cpu_count() or 1)))
+
+# Persistent cache for search results, LLM selections and MusicBrainz lookups
+CACHE_ENABLED = os.getenv('CACHE_ENABLED', '1') not in ('0', 'false', 'False')
+CACHE_PATH = os.getenv('CACHE_PATH', os.path.join('.cache', 'music_downloader.sqlite3'))
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+CACHE_TTLS = {
+  'default': int(os.getenv('CACHE_TTL_DEFAULT', str(7 * 86400))),
+  'search': int(os.getenv('CACHE_TTL_SEARCH', str(7 * 86400))),
+  'llm': int(os.getenv('CACHE_TTL_LLM', str(90 * 86400))),
+  'musicbrainz': int(os.getenv('CACHE_TTL_MUSICBRAINZ', str(30 * 86400))),
+}
+
+# Batched LLM selection: queries arriving within LLM_BATCH_DELAY seconds share one model call
+LLM_BATCH_SIZE = int(os.getenv('LLM_BATCH_SIZE', '10'))
+LLM_BATCH_DELAY = float(os.getenv('LLM_BATCH_DELAY', '0.5'))
+LLM_BATCH_TOKEN_BUDGET = int(os.getenv('LLM_BATCH_TOKEN_BUDGET', '12000'))
+# Prompt size: candidates shown per query (0 shows all) and title length
+LLM_TOP_K = int(os.getenv('LLM_TOP_K', '5'))
+LLM_TITLE_MAX_CHARS = int(os.getenv('LLM_TITLE_MAX_CHARS', '80'))
+# Model tiers: queries whose top candidate already matches this closely go to the cheaper model
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-4o')
+LLM_EASY_MODEL = os.getenv('LLM_EASY_MODEL', 'gpt-4o-mini')  # empty to always use LLM_MODEL
+LLM_EASY_MIN_SIMILARITY = float(os.getenv('LLM_EASY_MIN_SIMILARITY', '0.75'))
+
+# Local pre-ranker: skip the LLM when one candidate clearly beats the rest
+RANKER_ENABLED = os.getenv('RANKER_ENABLED', '1') not in ('0', 'false', 'False')
+RANKER_CONFIDENCE_MARGIN = float(os.getenv('RANKER_CONFIDENCE_MARGIN', '0.15'))
+RANKER_MIN_SIMILARITY = float(os.getenv('RANKER_MIN_SIMILARITY', '0.85'))
+
+# Duration check: drop candidates whose length is off from the MusicBrainz track length
+# by more than DURATION_TOLERANCE seconds or DURATION_TOLERANCE_RATIO of it, whichever is larger
+DURATION_CHECK_ENABLED = os.getenv('DURATION_CHECK_ENABLED', '1') not in ('0', 'false', 'False')
+DURATION_TOLERANCE = int(os.getenv('DURATION_TOLERANCE', '20'))
+DURATION_TOLERANCE_RATIO = float(os.getenv('DURATION_TOLERANCE_RATIO', '0.15'))
+# Longest upload accepted for a track of unknown length, e.g. to skip 10-hour loops (0 disables)
+MAX_TRACK_SECONDS = int(os.getenv('MAX_TRACK_SECONDS', '1800'))
+
+# Pipe downloads straight into ffmpeg instead of writing a temporary source file
+STREAMING_DOWNLOADS = os.getenv('STREAMING_DOWNLOADS', '1') not in ('0', 'false', 'False')
+
+# Segmented downloads used when not streaming into ffmpeg
+SEGMENT_SIZE = int(os.getenv('SEGMENT_SIZE', str(1024 * 1024)))
+SEGMENT_CONCURRENCY = int(os.getenv('SEGMENT_CONCURRENCY', '4'))
+
+# Shared HTTP connection pool and per-host request rates: (requests per second, burst)
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '100'))
+RATE_LIMITS = {
+  # MusicBrainz allows one request per second per client
+  'musicbrainz.org': (float(os.getenv('MUSICBRAINZ_RATE_LIMIT', '1')), 1),
+  'www.googleapis.com': (float(os.getenv('YOUTUBE_RATE_LIMIT', '10')), 10),
+  'api.openai.com': (float(os.getenv('OPENAI_RATE_LIMIT', '5')), 5),
+}
+
+# Adaptive concurrency per upstream (AIMD): each starts at its maximum, is cut by
+# UPSTREAM_DECREASE on errors, throttling or a latency spike, and regains about one slot per round of successes
+UPSTREAM_CONCURRENCY = {
+  'youtube': int(os.getenv('YOUTUBE_CONCURRENCY', '8')),
+  'stream': int(os.getenv('STREAM_CONCURRENCY', str(CONCURRENT_DOWNLOADS * SEGMENT_CONCURRENCY))),
+  'openai': LLM_CONCURRENCY,
+  'musicbrainz': int(os.getenv('MUSICBRAINZ_CONCURRENCY', '2')),
+}
+UPSTREAM_DECREASE = float(os.getenv('UPSTREAM_DECREASE', '0.5'))
+# Errors only count as congestion once this share of recent requests failed; throttling always does
+UPSTREAM_ERROR_RATE = float(os.getenv('UPSTREAM_ERROR_RATE', '0.5'))
+# A request this many times slower than the upstream's running average counts as congestion (0 disables)
+UPSTREAM_LATENCY_FACTOR = float(os.getenv('UPSTREAM_LATENCY_FACTOR', '4'))
+# Retry backoff shared by every task using an upstream: jittered, doubling per consecutive failure
+BACKOFF_BASE = float(os.getenv('BACKOFF_BASE', '1'))
+BACKOFF_MAX = float(os.getenv('BACKOFF_MAX', '60'))
+
+# YouTube Data API daily quota in units (search.list costs 100, videos.list 1; 0 disables tracking).
+# YOUTUBE_QUOTA_BURST of it can be spent right away, the rest accrues until the midnight Pacific reset
+YOUTUBE_DAILY_QUOTA = int(os.getenv('YOUTUBE_DAILY_QUOTA', '10000'))
+YOUTUBE_QUOTA_BURST = float(os.getenv('YOUTUBE_QUOTA_BURST', '1.0'))
+YOUTUBE_QUOTA_PATH = os.getenv('YOUTUBE_QUOTA_PATH', os.path.join('.cache', 'youtube_quota.json'))
+
+# Offline MusicBrainz release index (see mb_index.py); empty disables it
+MB_INDEX_DIR = os.getenv('MB_INDEX_DIR', '')
+
+# Server mode (--serve)
+SERVER_HOST = os.getenv('SERVER_HOST', '127.0.0.1')
+SERVER_PORT = int(os.getenv('SERVER_PORT', '8765'))
+
+# Album cover art from the Cover Art Archive, embedded in tracks of known releases
+COVER_ART_ENABLED = os.getenv('COVER_ART_ENABLED', '1') not in ('0', 'false', 'False')
+COVER_ART_SIZE = os.getenv('COVER_ART_SIZE', '500')  # 250, 500 or 1200 pixels
+COVER_ART_DIR = os.getenv('COVER_ART_DIR', os.path.join('.cache', 'covers'))
\ No newline at end of file
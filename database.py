@@ -0,0 +1,290 @@
+# database.py
+import json
+import os
+import re
+import sqlite3
+import time
+from typing import Any, List, Optional, Tuple
+
+from config import CACHE_ENABLED, CACHE_MAX_BYTES, CACHE_PATH, CACHE_TTLS
+from utils import setup_logging
+from metadata import clean_filename
+from metrics import metrics
+
+logger = setup_logging(__name__)
+
+# How many writes happen between size checks; summing the table on every
+# write would make large batches quadratic.
+EVICTION_INTERVAL = 100
+
+
+def normalize_key(text: str) -> str:
+  """
+  Normalize a query so trivially different spellings share a cache entry.
+  """
+  return re.sub(r'\s+', ' ', text or '').strip().lower()
+
+
+class Cache:
+  """
+  SQLite-backed key/value cache for remote lookups.
+
+  Entries are namespaced by source ('search', 'llm', 'musicbrainz', ...)
+  with a per-source TTL from config.CACHE_TTLS. Once the stored payloads
+  exceed max_bytes the least recently used entries are evicted.
+  """
+
+  def __init__(self, path: str = CACHE_PATH, max_bytes: int = CACHE_MAX_BYTES, enabled: bool = CACHE_ENABLED):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.enabled = enabled
+    self._conn = None
+    self._writes = 0
+
+  def _connect(self) -> sqlite3.Connection:
+    if self._conn is None:
+      directory = os.path.dirname(self.path)
+      if directory:
+        os.makedirs(directory, exist_ok=True)
+      self._conn = sqlite3.connect(self.path, check_same_thread=False)
+      self._conn.execute("PRAGMA journal_mode=WAL")
+      self._conn.execute("PRAGMA synchronous=NORMAL")
+      self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache (
+          source TEXT NOT NULL,
+          key TEXT NOT NULL,
+          value TEXT NOT NULL,
+          size INTEGER NOT NULL,
+          expires_at REAL NOT NULL,
+          accessed_at REAL NOT NULL,
+          PRIMARY KEY (source, key)
+        )
+      """)
+      self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+    return self._conn
+
+  def get(self, source: str, key: str) -> Optional[Any]:
+    """
+    Return the cached value for (source, key), or None if missing or expired.
+    """
+    if not self.enabled:
+      return None
+    try:
+      conn = self._connect()
+      key = normalize_key(key)
+      row = conn.execute(
+        "SELECT value, expires_at FROM cache WHERE source = ? AND key = ?", (source, key)
+      ).fetchone()
+      if row is None:
+        metrics.inc("cache_misses", source=source)
+        return None
+      now = time.time()
+      if row[1] < now:
+        conn.execute("DELETE FROM cache WHERE source = ? AND key = ?", (source, key))
+        conn.commit()
+        metrics.inc("cache_misses", source=source)
+        return None
+      conn.execute(
+        "UPDATE cache SET accessed_at = ? WHERE source = ? AND key = ?", (now, source, key)
+      )
+      conn.commit()
+      metrics.inc("cache_hits", source=source)
+      return json.loads(row[0])
+    except (sqlite3.Error, ValueError) as e:
+      logger.warning(f"Cache read failed for {source}: {e}")
+      return None
+
+  def set(self, source: str, key: str, value: Any, ttl: Optional[float] = None) -> None:
+    """
+    Store a JSON-serializable value under (source, key).
+    """
+    if not self.enabled:
+      return
+    if ttl is None:
+      ttl = CACHE_TTLS.get(source, CACHE_TTLS['default'])
+    try:
+      conn = self._connect()
+      payload = json.dumps(value, separators=(',', ':'))
+      now = time.time()
+      conn.execute(
+        "INSERT OR REPLACE INTO cache (source, key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (source, normalize_key(key), payload, len(payload), now + ttl, now)
+      )
+      conn.commit()
+      self._writes += 1
+      if self._writes % EVICTION_INTERVAL == 0:
+        self.evict()
+    except (sqlite3.Error, TypeError, ValueError) as e:
+      logger.warning(f"Cache write failed for {source}: {e}")
+
+  def evict(self) -> None:
+    """
+    Drop expired entries, then the least recently used ones until under max_bytes.
+    """
+    conn = self._connect()
+    conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+    if total > self.max_bytes:
+      excess = total - self.max_bytes
+      freed = 0
+      stale = []
+      for source, key, size in conn.execute("SELECT source, key, size FROM cache ORDER BY accessed_at"):
+        stale.append((source, key))
+        freed += size
+        if freed >= excess:
+          break
+      conn.executemany("DELETE FROM cache WHERE source = ? AND key = ?", stale)
+      logger.info(f"Evicted {len(stale)} cache entries ({freed} bytes)")
+    conn.commit()
+
+  def close(self) -> None:
+    if self._conn is not None:
+      self._conn.close()
+      self._conn = None
+
+
+cache = Cache()
+
+
+# Pipeline stages a job moves through, in order; 'failed' records the error instead
+JOB_STATES = ['pending', 'searched', 'selected', 'downloaded', 'transcoded', 'tagged', 'done', 'failed']
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.opus')
+
+
+class Manifest:
+  """
+  Durable record of every track a run has been asked for and how far it got.
+
+  Stored as SQLite next to the downloads so a crashed or interrupted batch
+  can be resumed with --resume: finished tracks are skipped and unfinished
+  ones restart from their last completed stage.
+  """
+
+  def __init__(self, path: str):
+    self.path = path
+    directory = os.path.dirname(path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    self._conn.execute("PRAGMA journal_mode=WAL")
+    self._conn.execute("""
+      CREATE TABLE IF NOT EXISTS jobs (
+        key TEXT PRIMARY KEY,
+        query TEXT NOT NULL,
+        state TEXT NOT NULL,
+        video_id TEXT,
+        selection TEXT,
+        output_file TEXT,
+        error TEXT,
+        updated_at REAL NOT NULL
+      )
+    """)
+    self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_video_id ON jobs (video_id)")
+    self._conn.commit()
+
+  def get(self, query: str) -> Optional[dict]:
+    """
+    Return the job for a query, with its stored selection decoded.
+    """
+    row = self._conn.execute(
+      "SELECT query, state, video_id, selection, output_file, error FROM jobs WHERE key = ?",
+      (normalize_key(query),)
+    ).fetchone()
+    if row is None:
+      return None
+    return {
+      'query': row[0],
+      'state': row[1],
+      'video_id': row[2],
+      'selection': json.loads(row[3]) if row[3] else None,
+      'output_file': row[4],
+      'error': row[5],
+    }
+
+  def record(self, query: str, state: str, selection: Optional[dict] = None, output_file: Optional[str] = None, error: Optional[str] = None) -> None:
+    """
+    Move a job to a new state, keeping previously recorded fields not given here.
+    """
+    if state not in JOB_STATES:
+      raise ValueError(f"Unknown job state: {state}")
+    self._conn.execute(
+      """
+      INSERT INTO jobs (key, query, state, video_id, selection, output_file, error, updated_at)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+      ON CONFLICT (key) DO UPDATE SET
+        state = excluded.state,
+        video_id = COALESCE(excluded.video_id, jobs.video_id),
+        selection = COALESCE(excluded.selection, jobs.selection),
+        output_file = COALESCE(excluded.output_file, jobs.output_file),
+        error = excluded.error,
+        updated_at = excluded.updated_at
+      """,
+      (
+        normalize_key(query),
+        query,
+        state,
+        selection['videoId'] if selection else None,
+        json.dumps(selection) if selection else None,
+        output_file,
+        error,
+        time.time(),
+      )
+    )
+    self._conn.commit()
+
+  def unfinished(self) -> List[str]:
+    """
+    Queries whose jobs never reached 'done', oldest first.
+    """
+    rows = self._conn.execute(
+      "SELECT query FROM jobs WHERE state != 'done' ORDER BY updated_at"
+    ).fetchall()
+    return [row[0] for row in rows]
+
+  def completed(self) -> List[Tuple[str, str]]:
+    """
+    (video id, output file) for every finished job.
+    """
+    return self._conn.execute(
+      "SELECT video_id, output_file FROM jobs WHERE state = 'done' AND video_id IS NOT NULL AND output_file IS NOT NULL"
+    ).fetchall()
+
+  def close(self) -> None:
+    self._conn.close()
+
+
+class LibraryIndex:
+  """
+  In-memory index of tracks already in the download directory.
+
+  Keyed by the clean_filename form of "Artist - Title" (case-insensitive)
+  and by YouTube video id, so finished tracks are skipped before any
+  search, LLM or download request is made.
+  """
+
+  def __init__(self, output_path: str, manifest: Optional[Manifest] = None):
+    self._by_name = {}
+    self._by_video_id = {}
+    if os.path.isdir(output_path):
+      for entry in os.scandir(output_path):
+        stem, extension = os.path.splitext(entry.name)
+        if extension.lower() in AUDIO_EXTENSIONS and entry.is_file():
+          self._by_name[stem.lower()] = entry.path
+    if manifest is not None:
+      for video_id, output_file in manifest.completed():
+        if os.path.exists(output_file):
+          self._by_video_id[video_id] = output_file
+
+  def find(self, title: str) -> Optional[str]:
+    """
+    Return the existing file for an "Artist - Title" string, if any.
+    """
+    return self._by_name.get(clean_filename(title).lower())
+
+  def find_video(self, video_id: str) -> Optional[str]:
+    return self._by_video_id.get(video_id)
+
+  def add(self, output_file: str, video_id: Optional[str] = None) -> None:
+    self._by_name[os.path.splitext(os.path.basename(output_file))[0].lower()] = output_file
+    if video_id:
+      self._by_video_id[video_id] = output_file
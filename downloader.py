@@ -0,0 +1,124 @@
+# downloader.py
+import asyncio
+import json
+import os
+from typing import Callable, Optional
+
+from config import MAX_RETRIES, SEGMENT_CONCURRENCY, SEGMENT_SIZE
+from utils import setup_logging
+from http_client import request
+from metrics import metrics
+from upstreams import get_upstream
+
+logger = setup_logging(__name__)
+
+SIDECAR_SUFFIX = ".progress.json"
+
+
+def _load_progress(sidecar: str, size: int, segment_size: int) -> set:
+  """
+  Return the segments already written by an earlier attempt, if the sidecar
+  describes the same file layout.
+  """
+  try:
+    with open(sidecar) as f:
+      progress = json.load(f)
+  except (OSError, ValueError):
+    return set()
+  if progress.get("size") != size or progress.get("segment_size") != segment_size:
+    return set()
+  return set(progress.get("done", []))
+
+
+def _save_progress(sidecar: str, size: int, segment_size: int, done: set) -> None:
+  tmp = sidecar + ".tmp"
+  with open(tmp, "w") as f:
+    json.dump({"size": size, "segment_size": segment_size, "done": sorted(done)}, f)
+  os.replace(tmp, sidecar)
+
+
+async def download_ranges(
+  url: str,
+  dest: str,
+  size: int,
+  segment_size: int = SEGMENT_SIZE,
+  parallel: int = SEGMENT_CONCURRENCY,
+  retries: int = MAX_RETRIES,
+  on_progress: Optional[Callable[[int], None]] = None,
+) -> str:
+  """
+  Download a file as parallel byte-range segments, resuming an earlier attempt.
+
+  The destination is preallocated and each segment is written in place.
+  Completed segments are recorded in a small sidecar next to the file, so
+  after an error or a killed process only the missing segments are fetched.
+  Each segment is retried on its own, so a dropped connection costs one
+  segment rather than the whole file.
+
+  :param url: Stream URL that honors HTTP Range requests
+  :param dest: Path of the file to write
+  :param size: Total size in bytes
+  :param on_progress: Called with the byte count of every completed segment
+  :return: dest, once every segment is on disk
+  """
+  from aiohttp import ClientError
+
+  sidecar = dest + SIDECAR_SUFFIX
+  segments = (size + segment_size - 1) // segment_size
+  done = _load_progress(sidecar, size, segment_size) if os.path.exists(dest) else set()
+  if done:
+    logger.info(f"Resuming {dest}: {len(done)}/{segments} segments already downloaded")
+    if on_progress:
+      on_progress(sum(min(segment_size, size - i * segment_size) for i in done))
+
+  directory = os.path.dirname(dest)
+  if directory:
+    os.makedirs(directory, exist_ok=True)
+  mode = "r+b" if done else "wb"
+  with open(dest, mode) as f:
+    f.truncate(size)
+
+    limit = asyncio.Semaphore(max(1, parallel))
+
+    async def fetch_segment(index: int) -> None:
+      start = index * segment_size
+      end = min(start + segment_size, size) - 1
+      async with limit:
+        for attempt in range(retries):
+          try:
+            async with get_upstream("stream").slot(), await request(
+              "GET", url, headers={"Range": f"bytes={start}-{end}"}, upstream="stream"
+            ) as response:
+              response.raise_for_status()
+              data = await response.read()
+            if len(data) != end - start + 1:
+              raise IOError(f"short read for bytes {start}-{end}: got {len(data)}")
+            break
+          except (ClientError, asyncio.TimeoutError, IOError) as e:
+            if attempt == retries - 1:
+              raise
+            logger.warning(f"Segment {index} of {dest} failed (attempt {attempt + 1}): {e}")
+            metrics.inc("retries", stage="segment")
+            await get_upstream("stream").backoff(attempt)
+
+      # No await between seek and write, so concurrent segments can't interleave
+      f.seek(start)
+      f.write(data)
+      done.add(index)
+      metrics.inc("bytes_downloaded", len(data))
+      _save_progress(sidecar, size, segment_size, done)
+      if on_progress:
+        on_progress(len(data))
+
+    pending = [index for index in range(segments) if index not in done]
+    # Let every segment settle before the file is closed, then surface the first failure
+    results = await asyncio.gather(
+      *(fetch_segment(index) for index in pending), return_exceptions=True
+    )
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+      raise errors[0]
+
+  if os.path.exists(sidecar):
+    os.remove(sidecar)
+  return dest
@@ -0,0 +1,177 @@
+# http_client.py
+import asyncio
+import email.utils
+import time
+from typing import TYPE_CHECKING, Any, Optional
+from urllib.parse import urlsplit
+
+from config import HTTP_POOL_SIZE, MAX_RETRIES, RATE_LIMITS
+from utils import setup_logging
+from metrics import metrics
+from upstreams import get_upstream
+
+if TYPE_CHECKING:
+  import aiohttp
+
+logger = setup_logging(__name__)
+
+# Statuses that mean "slow down" rather than "this request is wrong"
+THROTTLE_STATUSES = (429, 503)
+
+
+class TokenBucket:
+  """
+  Token-bucket rate limiter shared by every request to one host.
+
+  Allows `rate` requests per second with bursts of up to `capacity`.
+  A Retry-After from the server pauses the whole bucket, so every task
+  talking to that host backs off together instead of hammering it.
+  """
+
+  def __init__(self, rate: float, capacity: float = 1):
+    self.rate = rate
+    self.capacity = max(1.0, capacity)
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+    self.paused_until = 0.0
+    self._lock = None
+
+  async def acquire(self) -> None:
+    if self._lock is None:
+      self._lock = asyncio.Lock()
+    # Waiters queue on the lock, so tokens are handed out in arrival order
+    async with self._lock:
+      while True:
+        now = time.monotonic()
+        if now < self.paused_until:
+          await asyncio.sleep(self.paused_until - now)
+          continue
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        await asyncio.sleep((1 - self.tokens) / self.rate)
+
+  def pause(self, seconds: float) -> None:
+    self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    self.tokens = 0
+
+
+_session = None
+_buckets = {}
+
+
+def get_session() -> "aiohttp.ClientSession":
+  """
+  Return the process-wide session, creating it on first use.
+
+  Every module shares this keep-alive connection pool, so repeated calls
+  to the same host skip DNS and TLS setup.
+  """
+  global _session
+  if _session is None or _session.closed:
+    import aiohttp
+    _session = aiohttp.ClientSession(
+      connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=300),
+      timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60),
+    )
+  return _session
+
+
+async def close_session() -> None:
+  """
+  Close the process-wide session.
+  """
+  global _session
+  if _session is not None and not _session.closed:
+    await _session.close()
+  _session = None
+
+
+def get_bucket(host: str) -> Optional[TokenBucket]:
+  """
+  Return the rate limiter for a host, or None if it isn't rate limited.
+  """
+  if host not in _buckets:
+    limit = RATE_LIMITS.get(host)
+    _buckets[host] = TokenBucket(*limit) if limit else None
+  return _buckets[host]
+
+
+async def throttle(host: str) -> None:
+  """
+  Wait for a request slot on a host whose client isn't built on this module (e.g. the OpenAI SDK).
+  """
+  bucket = get_bucket(host)
+  if bucket is not None:
+    await bucket.acquire()
+
+
+def _retry_after(response: "aiohttp.ClientResponse") -> Optional[float]:
+  value = response.headers.get("Retry-After")
+  if not value:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  try:
+    return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+  except (TypeError, ValueError):
+    return None
+
+
+async def request(
+  method: str, url: str, retries: int = MAX_RETRIES, upstream: Optional[str] = None, **kwargs
+) -> "aiohttp.ClientResponse":
+  """
+  Send a rate-limited request on the shared session.
+
+  429 and 503 responses are retried after the server's Retry-After (or an
+  exponential delay), pausing the host's bucket for every other caller too.
+  With an upstream named, the throttling is also reported to its controller
+  (see upstreams.py), which cuts its concurrency and applies the wait to
+  every task using it, with jitter when the server gave no Retry-After.
+  The caller owns the returned response: `async with await request(...) as response:`.
+
+  :param method: HTTP method
+  :param url: Absolute URL
+  :param retries: Attempts before a throttled response is returned as-is
+  :param upstream: 'youtube', 'stream', 'openai' or 'musicbrainz'
+  :param kwargs: Passed through to aiohttp (params, headers, timeout, ...)
+  """
+  host = urlsplit(url).hostname
+  bucket = get_bucket(host)
+  retries = max(1, retries)
+  for attempt in range(retries):
+    if bucket is not None:
+      await bucket.acquire()
+    metrics.inc("http_requests", host=host)
+    response = await get_session().request(method, url, **kwargs)
+    if response.status not in THROTTLE_STATUSES or attempt == retries - 1:
+      return response
+
+    delay = _retry_after(response)
+    if upstream is not None:
+      delay = get_upstream(upstream).failed(delay, throttled=True)
+    elif delay is None:
+      delay = 2 ** attempt
+    response.release()
+    metrics.inc("http_throttled", host=host)
+    logger.warning(f"{host} responded {response.status}; retrying in {delay:.1f}s")
+    if bucket is not None:
+      bucket.pause(delay)
+    else:
+      await asyncio.sleep(delay)
+
+
+async def request_json(method: str, url: str, **kwargs) -> Any:
+  """
+  Send a rate-limited request and return the decoded JSON body.
+
+  :raises aiohttp.ClientResponseError: On a non-2xx status
+  """
+  async with await request(method, url, **kwargs) as response:
+    response.raise_for_status()
+    return await response.json()
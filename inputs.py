@@ -0,0 +1,157 @@
+# inputs.py
+import asyncio
+import csv
+import json
+import os
+import re
+import sys
+from typing import AsyncIterator, Dict, Iterable, Iterator, Optional
+
+from utils import setup_logging
+
+logger = setup_logging(__name__)
+
+INPUT_FORMATS = ["text", "csv", "jsonl"]
+FORMAT_EXTENSIONS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+YOUTUBE_URL_RE = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/)|youtu\.be/)([A-Za-z0-9_-]{11})')
+VIDEO_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+
+def parse_video_id(value: str) -> Optional[str]:
+  """
+  Extract a video id from a YouTube URL or a bare 11-character id.
+  """
+  value = (value or "").strip()
+  match = YOUTUBE_URL_RE.search(value)
+  if match:
+    return match.group(1)
+  return value if VIDEO_ID_RE.match(value) else None
+
+
+def make_entry(song: str = "", album: str = "", artist: str = "", video_id: str = "") -> Optional[Dict]:
+  """
+  Build a work entry from whichever fields an input row provides.
+
+  :return: {'type': 'video', 'video_id', 'song'}, {'type': 'album', 'album', 'artist'}
+    or {'type': 'song', 'song'}; None for an empty row
+  """
+  song, album, artist = (song or "").strip(), (album or "").strip(), (artist or "").strip()
+  if video_id:
+    parsed = parse_video_id(video_id)
+    if parsed:
+      return {"type": "video", "video_id": parsed, "song": song or None}
+    logger.warning(f"Ignoring invalid YouTube id: {video_id}")
+    return None
+  if album:
+    return {"type": "album", "album": album, "artist": artist}
+  if song:
+    if artist and " - " not in song:
+      song = f"{artist} - {song}"
+    return {"type": "song", "song": song}
+  return None
+
+
+def _text_entries(lines: Iterable[str]) -> Iterator[Dict]:
+  for line in lines:
+    line = line.strip()
+    if not line or line.startswith("#"):
+      continue
+    if YOUTUBE_URL_RE.search(line):
+      entry = make_entry(video_id=line)
+    else:
+      entry = make_entry(song=line)
+    if entry:
+      yield entry
+
+
+def _csv_entries(lines: Iterable[str]) -> Iterator[Dict]:
+  for row in csv.DictReader(lines):
+    row = {(key or "").strip().lower(): value for key, value in row.items()}
+    entry = make_entry(
+      song=row.get("song", "") or row.get("title", ""),
+      album=row.get("album", ""),
+      artist=row.get("artist", ""),
+      video_id=row.get("video_id", "") or row.get("url", ""),
+    )
+    if entry:
+      yield entry
+
+
+def _jsonl_entries(lines: Iterable[str]) -> Iterator[Dict]:
+  for number, line in enumerate(lines, 1):
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      row = json.loads(line)
+    except ValueError as e:
+      logger.warning(f"Skipping invalid JSON on line {number}: {e}")
+      continue
+    if isinstance(row, str):
+      row = {"song": row}
+    elif not isinstance(row, dict):
+      logger.warning(f"Skipping line {number}: expected a JSON object or string, got {type(row).__name__}")
+      continue
+    entry = make_entry(
+      song=row.get("song", "") or row.get("title", ""),
+      album=row.get("album", ""),
+      artist=row.get("artist", ""),
+      video_id=row.get("video_id", "") or row.get("url", ""),
+    )
+    if entry:
+      yield entry
+
+
+def _decoded_lines(stream: Iterable) -> Iterator[str]:
+  """
+  Decode raw input lines as UTF-8, skipping any that aren't instead of
+  failing the whole run partway through.
+  """
+  for number, line in enumerate(stream, 1):
+    if isinstance(line, str):
+      yield line
+      continue
+    try:
+      yield line.decode("utf-8")
+    except UnicodeDecodeError as e:
+      logger.warning(f"Skipping line {number}: not valid UTF-8 ({e.reason} at byte {e.start})")
+
+
+def iter_entries(lines: Iterable[str], format: str = "text") -> Iterator[Dict]:
+  """
+  Lazily parse input lines into work entries, one row at a time.
+  """
+  parsers = {"text": _text_entries, "csv": _csv_entries, "jsonl": _jsonl_entries}
+  return parsers[format](lines)
+
+
+def detect_format(path: str) -> str:
+  return FORMAT_EXTENSIONS.get(os.path.splitext(path)[1].lower(), "text")
+
+
+async def read_entries(path: str, format: Optional[str] = None) -> AsyncIterator[Dict]:
+  """
+  Stream work entries from a file, or from stdin when path is '-'.
+
+  Rows are read in a worker thread one at a time, so work on the first
+  entries starts before the rest of the input has arrived and a slow pipe
+  never blocks the event loop.
+
+  :param path: Input file path, or '-' for stdin
+  :param format: One of INPUT_FORMATS; detected from the file extension when omitted
+  """
+  format = format or ("text" if path == "-" else detect_format(path))
+  # Read as bytes and decoded line by line, so one badly encoded row is skipped on its own
+  stream = getattr(sys.stdin, "buffer", sys.stdin) if path == "-" else open(path, "rb")
+  loop = asyncio.get_event_loop()
+  entries = iter_entries(_decoded_lines(stream), format)
+  try:
+    while True:
+      entry = await loop.run_in_executor(None, next, entries, None)
+      if entry is None:
+        break
+      yield entry
+  finally:
+    if path != "-":
+      stream.close()
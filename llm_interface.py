@@ -1,27 +1,44 @@
 # llm_interface.py
+import asyncio
+import html
 import json
 import logging
-from typing import List, Dict, Optional
-import openai
+import re
+import textwrap
+from typing import List, Dict, Optional, Tuple
 
-from config import OPENAI_API_KEY
-from utils import setup_logging
+from config import (
+  OPENAI_API_KEY,
+  OPENAI_BASE_URL,
+  LLM_BATCH_SIZE,
+  LLM_BATCH_DELAY,
+  LLM_BATCH_TOKEN_BUDGET,
+  LLM_CONCURRENCY,
+  LLM_EASY_MIN_SIMILARITY,
+  LLM_EASY_MODEL,
+  LLM_MODEL,
+  LLM_TITLE_MAX_CHARS,
+  LLM_TOP_K,
+  RANKER_ENABLED,
+)
+from utils import setup_logging, MicroBatcher
+from database import cache
+from ranking import pick_confident_match, score_candidates
+from http_client import throttle
+from metrics import metrics
+from upstreams import get_upstream
 
-logger = setup_logging()
-client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
+logger = setup_logging(__name__)
+# The SDK keeps its own connection pool and retries 429s using Retry-After;
+# throttle() only paces our request rate against the shared per-host limit.
+OPENAI_HOST = "api.openai.com"
+# Routes every selection call to the same prompt cache
+PROMPT_CACHE_KEY = "music-downloader-selection"
 
-async def get_best_match(query: str, search_results: List[Dict]) -> Optional[Dict]:
-  """
-  Use OpenAI's GPT to determine the best match for a song from search results.
-  
-  :param song: Original song query
-  :param search_results: List of YouTube search results
-  :return: Dictionary with best matching video info, or None if no match found
-  """
-  if not search_results:
-    return None
-    
-  system_prompt = """
+# Every call sends the same system prompt and the same tool list, so the
+# provider's prompt-prefix cache can serve that part; only the user message
+# (queries and candidates) varies.
+SYSTEM_PROMPT = textwrap.dedent("""
     YouTube Audio Selection System
 
     Task: Review YouTube search results and identify the best video for downloading audio based on a given query.
@@ -36,7 +53,7 @@ async def get_best_match(query: str, search_results: List[Dict]) -> Optional[Dic
     - Favor audio-only versions or lyric videos over music videos.
     - Do not select instrumental-only videos unless specified.
     - Consider official sources (e.g., VEVO, official artist channel) over random YouTube users.
-    - Refer to view count, likes/dislikes, and upload date for decision making.
+    - Refer to view count, likes, and upload year for decision making.
     - Avoid live performances unless requested.
 
     Prioritize videos that:
@@ -46,56 +63,237 @@ async def get_best_match(query: str, search_results: List[Dict]) -> Optional[Dic
     4. Are more recent uploads, unless an older version is required.
 
     Aim to select the highest quality audio source matching the user's query and intent. Use the proper JSON structure for responses.
-  """
 
-  user_prompt = f"Query: {query}\n\nSearch Results:\n"
-  for i, result in enumerate(search_results, 1):
-    user_prompt += f"{i}. Title: {result['title']}, Channel: {result['channelTitle']}, Views: {result['viewCount']}, Likes: {result['likeCount']}, Dislikes: {result['dislikeCount']}, Published: {result['publishedAt']}\n"
-
-  tools = [{
-    "type": "function",
-    "function": {
-      "name": "select_best_match",
-      "description": "Select the best matching video for the given query",
-      "parameters": {
-        "type": "object",
-        "properties": {
-          "best_match_index": {
-            "type": "integer",
-            "description": "The index of the best matching video (1-based)"
-          },
-          "correct_title": {
-            "type": "string",
-            "description": "The correct title in the format 'Artist - Song Title (Optional Version Description)'. Omit the version description when moot such as (audio) or (lyric video)."
-          },
-          "explanation": {
-            "type": "string",
-            "description": "A brief explanation of why this video was selected"
+    Each candidate is listed as: index. title | channel | views | likes | upload year.
+    A message with several numbered queries is a batch: make an independent selection for every query and return one entry per query.
+""").strip()
+
+SELECTION_PROPERTIES = {
+  "best_match_index": {
+    "type": "integer",
+    "description": "The index of the best matching video (1-based)"
+  },
+  "correct_title": {
+    "type": "string",
+    "description": "The correct title in the format 'Artist - Song Title (Optional Version Description)'. Omit the version description when moot such as (audio) or (lyric video)."
+  },
+  "explanation": {
+    "type": "string",
+    "description": "A brief explanation of why this video was selected"
+  }
+}
+
+TOOLS = [{
+  "type": "function",
+  "function": {
+    "name": "select_best_match",
+    "description": "Select the best matching video for the given query",
+    "parameters": {
+      "type": "object",
+      "properties": SELECTION_PROPERTIES,
+      "required": ["best_match_index", "correct_title", "explanation"]
+    }
+  }
+}]
+
+BATCH_TOOLS = [{
+  "type": "function",
+  "function": {
+    "name": "select_best_matches",
+    "description": "Select the best matching video for each of the given queries",
+    "parameters": {
+      "type": "object",
+      "properties": {
+        "selections": {
+          "type": "array",
+          "items": {
+            "type": "object",
+            "properties": {
+              "query_index": {
+                "type": "integer",
+                "description": "The number of the query this selection answers (1-based)"
+              },
+              **SELECTION_PROPERTIES
+            },
+            "required": ["query_index", "best_match_index", "correct_title", "explanation"]
           }
-        },
-        "required": ["best_match_index", "correct_title", "explanation"]
-      }
+        }
+      },
+      "required": ["selections"]
     }
-  }]
+  }
+}]
+
+# Both tools go out on every call (tool_choice picks one) to keep the cached prefix identical
+SELECTION_TOOLS = TOOLS + BATCH_TOOLS
+
+_client = None
+_batcher = None
+
+
+def _estimate_tokens(text: str) -> int:
+  # Roughly four characters per token for English text; close enough for budgeting
+  return len(text) // 4 + 1
+
+
+def _compact_count(count: int) -> str:
+  for threshold, suffix in ((1e9, "B"), (1e6, "M"), (1e3, "K")):
+    if count >= threshold:
+      return f"{count / threshold:.1f}".rstrip("0").rstrip(".") + suffix
+  return str(count)
+
+
+def _compact_text(text: str, max_chars: int = LLM_TITLE_MAX_CHARS) -> str:
+  text = re.sub(r"\s+", " ", html.unescape(text)).strip()
+  if len(text) > max_chars:
+    text = text[:max_chars - 1].rstrip() + "\u2026"
+  return text
+
+
+def _format_results(search_results: List[Dict]) -> str:
+  lines = ""
+  for i, result in enumerate(search_results, 1):
+    lines += (
+      f"{i}. {_compact_text(result['title'])} | {_compact_text(result['channelTitle'], 40)}"
+      f" | {_compact_count(result['viewCount'])} views | {_compact_count(result['likeCount'])} likes"
+      f" | {result['publishedAt'][:4]}\n"
+    )
+  return lines
+
+
+def _shortlist(query: str, search_results: List[Dict]) -> Tuple[List[Dict], str]:
+  """
+  Trim search results to the LLM_TOP_K best by the local ranker and pick a model tier.
+
+  Penalized uploads (live, karaoke, ... when not asked for) and poor title
+  matches are the ones dropped, so the model sees the same realistic
+  choices in fewer tokens. Queries whose top candidate already matches
+  closely go to LLM_EASY_MODEL.
+
+  :return: (candidates, model)
+  """
+  scored = score_candidates(query, search_results)
+  if LLM_TOP_K > 0:
+    scored = scored[:LLM_TOP_K]
+  model = LLM_MODEL
+  if LLM_EASY_MODEL and scored and scored[0][1] >= LLM_EASY_MIN_SIMILARITY:
+    model = LLM_EASY_MODEL
+  return [result for _, _, result in scored], model
+
+
+def _cache_key(query: str, search_results: List[Dict]) -> str:
+  # Selections depend on the candidates offered, so key on their ids as well
+  return f"{query}|{','.join(result['videoId'] for result in search_results)}"
+
+
+def _get_client():
+  """
+  Return the OpenAI client, importing the SDK and creating it on first use.
+  """
+  global _client
+  if _client is None:
+    import openai
+    _client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+  return _client
+
+
+def _local_pick(query: str, search_results: List[Dict]) -> Optional[Dict]:
+  """
+  Return the pre-ranker's pick when it is confident enough to skip the LLM.
+  """
+  if not RANKER_ENABLED:
+    return None
+  best_match = pick_confident_match(query, search_results)
+  if best_match:
+    metrics.inc('llm_skipped')
+    logger.info(f"[{query}] Selected locally without LLM: {best_match['correct_title']}")
+  return best_match
+
+
+def _record_usage(response, mode: str, model: str) -> None:
+  metrics.inc('api_calls', service='openai', mode=mode, model=model)
+  usage = getattr(response, 'usage', None)
+  if usage:
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = (getattr(details, 'cached_tokens', 0) or 0) if details else 0
+    metrics.inc('llm_tokens', usage.prompt_tokens, kind='prompt', model=model)
+    metrics.inc('llm_tokens', usage.completion_tokens, kind='completion', model=model)
+    metrics.inc('llm_tokens', cached, kind='cached', model=model)
+    logger.info(
+      f"LLM {mode} call on {model}: {usage.prompt_tokens} prompt tokens ({cached} cached), "
+      f"{usage.completion_tokens} completion tokens"
+    )
+
+
+async def _complete(user_prompt: str, tool_name: str, mode: str, model: str):
+  """
+  One selection request, paced against the shared OpenAI rate limit and
+  the adaptive OpenAI concurrency limit (at most LLM_CONCURRENCY).
+  """
+  async with get_upstream('openai').slot():
+    await throttle(OPENAI_HOST)
+    with metrics.timer('llm', mode=mode):
+      response = await _get_client().chat.completions.create(
+        model=model,
+        messages=[
+          {"role": "system", "content": SYSTEM_PROMPT},
+          {"role": "user", "content": user_prompt}
+        ],
+        tools=SELECTION_TOOLS,
+        tool_choice={"type": "function", "function": {"name": tool_name}},
+        # Passed as a raw body field so older SDK versions send it too
+        extra_body={"prompt_cache_key": PROMPT_CACHE_KEY},
+      )
+  _record_usage(response, mode, model)
+  return response
 
+
+def _resolve_selection(query: str, search_results: List[Dict], selection: Dict) -> Optional[Dict]:
+  """
+  Turn a tool-call selection into a best match dictionary and cache it.
+  """
+  best_match_index = selection['best_match_index'] - 1  # Convert to 0-based index
+  if 0 <= best_match_index < len(search_results):
+    best_match = {**search_results[best_match_index], 'correct_title': selection['correct_title']}
+    cache.set('llm', _cache_key(query, search_results), best_match)
+    return best_match
+  return None
+
+
+async def get_best_match(query: str, search_results: List[Dict]) -> Optional[Dict]:
+  """
+  Use OpenAI's GPT to determine the best match for a song from search results.
+  
+  :param song: Original song query
+  :param search_results: List of YouTube search results
+  :return: Dictionary with best matching video info, or None if no match found
+  """
+  if not search_results:
+    return None
+
+  best_match = _local_pick(query, search_results)
+  if best_match:
+    return best_match
+
+  search_results, model = _shortlist(query, search_results)
+  cached = cache.get('llm', _cache_key(query, search_results))
+  if cached:
+    logger.info(f"[{query}] Using cached LLM decision")
+    return cached
+
+  user_prompt = f"Query: {query}\n" + _format_results(search_results)
+
+  function_args = {}
   try:
     logger.info(f"[{query}] Requesting LLM decision from OpenAI")
-    response = await client.chat.completions.create(
-      model="gpt-4o",
-      messages=[
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt}
-      ],
-      tools=tools,
-      tool_choice={"type": "function", "function": {"name": "select_best_match"}}
-    )
+    response = await _complete(user_prompt, "select_best_match", 'single', model)
 
     tool_calls = response.choices[0].message.tool_calls
     if tool_calls:
       function_args = json.loads(tool_calls[0].function.arguments)
-      best_match_index = function_args['best_match_index'] - 1  # Convert to 0-based index
-      if 0 <= best_match_index < len(search_results):
-        return {**search_results[best_match_index], 'correct_title': function_args['correct_title']}
+      best_match = _resolve_selection(query, search_results, function_args)
+      if best_match:
+        return best_match
 
     logger.error(f"[{query}] No suitable match found: {function_args.get('explanation', 'No explanation provided')}")
 
@@ -103,3 +301,132 @@ async def get_best_match(query: str, search_results: List[Dict]) -> Optional[Dic
     logger.error(f"[{query}] Error in LLM decision: {e}")
     
   return None
+
+
+def _split_batches(items: List[Tuple[str, List[Dict]]]) -> List[List[int]]:
+  """
+  Group item indexes into batches that fit the configured token budget.
+  """
+  budget = LLM_BATCH_TOKEN_BUDGET - _estimate_tokens(SYSTEM_PROMPT)
+  batches = []
+  current, used = [], 0
+  for index, (query, search_results) in enumerate(items):
+    cost = _estimate_tokens(query + _format_results(search_results))
+    if current and (used + cost > budget or len(current) >= LLM_BATCH_SIZE):
+      batches.append(current)
+      current, used = [], 0
+    current.append(index)
+    used += cost
+  if current:
+    batches.append(current)
+  return batches
+
+
+async def _select_batch(items: List[Tuple[str, List[Dict]]], model: str = LLM_MODEL) -> List[Optional[Dict]]:
+  """
+  Resolve several queries with a single chat completion.
+
+  :param items: (query, candidates) pairs, already shortlisted
+  :return: One entry per item; None where the model gave no usable selection
+  """
+  user_prompt = ""
+  for i, (query, search_results) in enumerate(items, 1):
+    user_prompt += f"Query {i}: {query}\n{_format_results(search_results)}\n"
+
+  results = [None] * len(items)
+  try:
+    logger.info(f"Requesting batched LLM decision for {len(items)} queries from OpenAI")
+    response = await _complete(user_prompt, "select_best_matches", 'batch', model)
+
+    tool_calls = response.choices[0].message.tool_calls
+    if tool_calls:
+      function_args = json.loads(tool_calls[0].function.arguments)
+      for selection in function_args.get('selections', []):
+        query_index = selection.get('query_index', 0) - 1
+        if 0 <= query_index < len(items) and results[query_index] is None:
+          query, search_results = items[query_index]
+          try:
+            results[query_index] = _resolve_selection(query, search_results, selection)
+          except (KeyError, TypeError) as e:
+            logger.warning(f"[{query}] Malformed batched selection: {e}")
+  except Exception as e:
+    logger.error(f"Error in batched LLM decision for {len(items)} queries: {e}")
+
+  return results
+
+
+async def get_best_matches(items: List[Tuple[str, List[Dict]]]) -> List[Optional[Dict]]:
+  """
+  Determine the best match for several queries, batching them into as few
+  model calls as the token budget allows.
+
+  Cached selections are reused, and any query the batch failed to resolve
+  falls back to an individual get_best_match call.
+
+  :param items: (query, search_results) pairs
+  :return: Best match dictionaries (or None) in the same order as items
+  """
+  results = [None] * len(items)
+  # Pending item indexes grouped by model tier, with their shortlisted candidates
+  tiers: Dict[str, List[int]] = {}
+  shortlisted = {}
+  for index, (query, search_results) in enumerate(items):
+    if not search_results:
+      continue
+    local = _local_pick(query, search_results)
+    if local:
+      results[index] = local
+      continue
+    candidates, model = _shortlist(query, search_results)
+    cached = cache.get('llm', _cache_key(query, candidates))
+    if cached:
+      logger.info(f"[{query}] Using cached LLM decision")
+      results[index] = cached
+    else:
+      shortlisted[index] = (query, candidates)
+      tiers.setdefault(model, []).append(index)
+
+  if len(shortlisted) == 1:
+    index = next(iter(shortlisted))
+    results[index] = await get_best_match(*items[index])
+    return results
+
+  calls = []
+  for model, pending in tiers.items():
+    for batch in _split_batches([shortlisted[index] for index in pending]):
+      calls.append(([pending[i] for i in batch], model))
+  batch_results = await asyncio.gather(
+    *(_select_batch([shortlisted[index] for index in batch], model) for batch, model in calls)
+  )
+
+  fallback = []
+  for (batch, _), selections in zip(calls, batch_results):
+    for index, selection in zip(batch, selections):
+      if selection:
+        results[index] = selection
+      else:
+        fallback.append(index)
+
+  if fallback:
+    logger.warning(f"Batched LLM selection left {len(fallback)} queries unresolved; retrying individually")
+    retried = await asyncio.gather(*(get_best_match(*items[index]) for index in fallback))
+    for index, best_match in zip(fallback, retried):
+      results[index] = best_match
+
+  return results
+
+
+async def select_best_match(query: str, search_results: List[Dict]) -> Optional[Dict]:
+  """
+  Determine the best match for one query, sharing a model call with other
+  queries submitted around the same time when batching is enabled.
+  """
+  global _batcher
+  best_match = _local_pick(query, search_results)
+  if best_match:
+    return best_match
+  if LLM_BATCH_SIZE <= 1:
+    return await get_best_match(query, search_results)
+  if _batcher is None:
+    _batcher = MicroBatcher(get_best_matches, LLM_BATCH_SIZE * LLM_CONCURRENCY, LLM_BATCH_DELAY)
+  return await _batcher.submit((query, search_results))
@@ -2,17 +2,30 @@
 import argparse
 import asyncio
 import logging
+import os
 import sys
-from typing import List
-
-from config import DEFAULT_DOWNLOAD_DIR, OPENAI_API_KEY, YOUTUBE_API_KEY
-from youtube_search import search_youtube
-from audio_download import download_audio
-from llm_interface import get_best_match
-from utils import setup_logging
-from album_query import query_album_tracks
-
-logger = setup_logging()
+from typing import AsyncIterator, Dict, List
+
+from config import (
+  CONCURRENT_DOWNLOADS,
+  DEFAULT_DOWNLOAD_DIR,
+  DEFAULT_FORMAT,
+  MANIFEST_FILENAME,
+  OPENAI_API_KEY,
+  SERVER_HOST,
+  SERVER_PORT,
+  STREAMING_DOWNLOADS,
+  YOUTUBE_API_KEY,
+)
+from pipeline import StageLimits, TrackPipeline
+from http_client import close_session
+from database import Manifest, cache
+from transcode import transcoder
+from metrics import metrics
+from utils import progress_logging, setup_logging
+from inputs import INPUT_FORMATS, make_entry, read_entries
+
+logger = setup_logging(__name__)
 
 
 def check_environment_variables():
@@ -39,6 +52,16 @@ def parse_arguments():
   )
   parser.add_argument("-s", "--songs", nargs="+", help="List of songs to download")
   parser.add_argument("-a", "--albums", nargs="+", help="List of albums to download")
+  parser.add_argument(
+    "-i",
+    "--input",
+    help="File of songs, albums or YouTube links to download ('-' for stdin); plain text, CSV or JSONL",
+  )
+  parser.add_argument(
+    "--input-format",
+    choices=INPUT_FORMATS,
+    help="Format of --input (default: detected from the file extension, text for stdin)",
+  )
   parser.add_argument(
     "--artist", help="Artist name (optional, improves album search accuracy)"
   )
@@ -48,47 +71,130 @@ def parse_arguments():
     default=DEFAULT_DOWNLOAD_DIR,
     help="Directory to save downloaded songs",
   )
+  parser.add_argument(
+    "-f",
+    "--format",
+    choices=["mp3", "m4a", "opus", "native"],
+    default=DEFAULT_FORMAT,
+    help="Output format; m4a, opus and native remux the YouTube audio without re-encoding",
+  )
+  parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Resume unfinished tracks from the download directory's manifest, reusing recorded selections",
+  )
+  parser.add_argument(
+    "--metrics-json",
+    help="Write a JSON report of per-stage timings and counters at the end of the run ('-' for stdout)",
+  )
+  parser.add_argument(
+    "--metrics-prom",
+    help="Write the same metrics as a Prometheus text file",
+  )
   parser.add_argument(
     "--batch", action="store_true", help="Run in batch mode (non-interactive)"
   )
-  return parser.parse_args()
-
-
-async def download_songs(songs: List[str], output_path: str) -> None:
-  for song in songs:
-    search_results = await search_youtube(song)
-    if not search_results:
-      logger.error(f"[{song}] No search results found")
-      continue
-
-    best_match = await get_best_match(song, search_results)
-    if not best_match:
-      logger.error(f"[{song}] Couldn't determine best match")
-      continue
-
-    await download_audio(song, best_match, output_path)
-
-
-async def download_album(album: str, artist: str, output_path: str) -> None:
-  tracks = await query_album_tracks(album, artist)
-  if not tracks:
-    logger.error(f"No tracks found for album: {album}")
-    return
-
-  logger.info(f"Found {len(tracks)} tracks for album: {album}")
-  await download_songs(tracks, output_path)
-
-
-async def main():
-  args = parse_arguments()
+  parser.add_argument(
+    "-c",
+    "--concurrent-downloads",
+    type=int,
+    help=f"Maximum number of simultaneous downloads, with twice as many tracks in flight "
+    f"(default: {CONCURRENT_DOWNLOADS}, and TRACKS_IN_FLIGHT tracks)",
+  )
+  parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="Bypass the local cache of search results, LLM selections and album lookups",
+  )
+  parser.add_argument(
+    "--no-stream",
+    dest="stream",
+    action="store_false",
+    default=STREAMING_DOWNLOADS,
+    help="Download to a temporary file before converting instead of piping into ffmpeg",
+  )
+  parser.add_argument(
+    "--serve",
+    action="store_true",
+    help="Run as a long-lived service accepting song, album and video jobs over HTTP",
+  )
+  parser.add_argument("--host", default=SERVER_HOST, help="Address to listen on with --serve")
+  parser.add_argument("--port", type=int, default=SERVER_PORT, help="Port to listen on with --serve")
+  parser.add_argument("--socket", help="Listen on this Unix socket instead of --host/--port")
+  args = parser.parse_args()
+  # Checked up front so a mistyped path is a usage error rather than a traceback mid-run
+  if args.input and args.input != "-" and not (os.path.isfile(args.input) and os.access(args.input, os.R_OK)):
+    parser.error(f"can't read input file '{args.input}'")
+  return args
+
+
+async def download_songs(songs: List[str], pipeline: TrackPipeline) -> None:
+  with progress_logging():
+    results = await pipeline.run(songs)
+
+  downloaded = sum(1 for result in results if result)
+  if len(songs) > 1:
+    logger.info(f"Downloaded {downloaded}/{len(songs)} songs")
+
+
+async def download_album(album: str, artist: str, pipeline: TrackPipeline) -> None:
+  async def entries() -> AsyncIterator[Dict]:
+    # Expanded by the pipeline, which keeps each track's album info for tagging
+    yield make_entry(album=album, artist=artist)
+
+  await download_entries(entries(), pipeline)
+
+
+async def requested_entries(args: argparse.Namespace) -> AsyncIterator[Dict]:
+  """
+  Yield work entries for the albums, songs and input file given on the command line.
+  """
+  for album in args.albums or []:
+    yield make_entry(album=album, artist=args.artist or "")
+  for song in args.songs or []:
+    yield make_entry(song=song)
+  if args.input:
+    async for entry in read_entries(args.input, args.input_format):
+      yield entry
+
+
+async def download_entries(entries: AsyncIterator[Dict], pipeline: TrackPipeline) -> None:
+  with progress_logging():
+    downloaded, total = await pipeline.run_entries(entries)
+  logger.info(f"Downloaded {downloaded}/{total} songs")
+
+
+async def run(args: argparse.Namespace, manifest: Manifest) -> None:
+  if args.no_cache:
+    cache.enabled = False
+  if args.concurrent_downloads:
+    limits = StageLimits(
+      tracks=args.concurrent_downloads * 2, download=args.concurrent_downloads
+    )
+  else:
+    # Left to CONCURRENT_DOWNLOADS and TRACKS_IN_FLIGHT
+    limits = StageLimits()
+  download_options = {"format": args.format, "streaming": args.stream}
+  pipeline = TrackPipeline(
+    args.directory, limits, download_options, manifest, resume=args.resume
+  )
 
-  if args.albums:
-    await download_album(args.albums, args.artist, args.directory)
-  elif args.songs:
-    await download_songs(args.songs, args.directory)
+  if args.serve:
+    from server import serve
+
+    await serve(pipeline, args.host, args.port, args.socket)
+  elif args.albums or args.songs or args.input:
+    await download_entries(requested_entries(args), pipeline)
+  elif args.resume:
+    unfinished = manifest.unfinished()
+    if unfinished:
+      logger.info(f"Resuming {len(unfinished)} unfinished songs")
+      await download_songs(unfinished, pipeline)
+    else:
+      logger.info("Nothing to resume")
   elif args.batch:
     print(
-      "Error: Batch mode requires a list of songs or an album. Use -s/--songs or -a/--albums to specify."
+      "Error: Batch mode requires a list of songs or an album. Use -s/--songs, -a/--albums or -i/--input to specify."
     )
   else:
     # Interactive mode
@@ -101,9 +207,36 @@ async def main():
       elif user_input.lower() == "album":
         album = input("Enter album name: ").strip()
         artist = input("Enter artist name (optional): ").strip()
-        await download_album(album, artist, args.directory)
+        await download_album(album, artist, pipeline)
       elif user_input:
-        await download_songs([user_input], args.directory)
+        await download_songs([user_input], pipeline)
+
+
+def report_metrics(args: argparse.Namespace) -> None:
+  stages = metrics.summary()["histograms"]
+  for name, summary in stages.items():
+    if name.startswith("stage_seconds"):
+      logger.info(
+        f"{name}: {summary['count']} calls, {summary['total']}s total, p50 {summary['p50']}s, p95 {summary['p95']}s"
+      )
+  if args.metrics_json:
+    metrics.write_json(args.metrics_json)
+  if args.metrics_prom:
+    metrics.write_prometheus(args.metrics_prom)
+
+
+async def main():
+  args = parse_arguments()
+  check_environment_variables()
+  manifest = Manifest(os.path.join(args.directory, MANIFEST_FILENAME))
+  try:
+    await run(args, manifest)
+  finally:
+    await close_session()
+    await transcoder.close()
+    cache.close()
+    manifest.close()
+    report_metrics(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,332 @@
+# mb_index.py
+import argparse
+import bz2
+import gzip
+import heapq
+import json
+import lzma
+import mmap
+import os
+import re
+import tarfile
+import tempfile
+from difflib import SequenceMatcher
+from typing import Dict, IO, Iterator, List, Optional, Tuple
+
+from config import MB_INDEX_DIR
+from ranking import normalize
+from utils import setup_logging
+
+logger = setup_logging(__name__)
+
+RECORDS_FILE = "releases.dat"
+INDEX_FILE = "releases.idx"
+JOURNAL_FILE = "journal.jsonl"
+KEY_SEPARATOR = "\x1f"
+# Index entries sorted in memory at a time while building; bounds importer memory
+SORT_CHUNK_SIZE = 200_000
+# Fuzzy lookups score at most this many neighbours of the title's position
+FUZZY_SCAN_LIMIT = 2000
+MIN_MATCH_SCORE = 0.75
+DUMP_MEMBER = "mbdump/release"
+
+
+LEADING_ARTICLE_RE = re.compile(r'^(the|a|an) ')
+
+
+def _title_key(title: str) -> str:
+  # "The Dark Side of the Moon" and "Dark Side of the Moon" should sort together
+  return LEADING_ARTICLE_RE.sub('', normalize(title))
+
+
+def _key(title: str, artist: str) -> str:
+  return f"{_title_key(title)}{KEY_SEPARATOR}{normalize(artist)}"
+
+
+def _credit_name(credits: List[Dict]) -> str:
+  return "".join(
+    credit.get("name", "") + credit.get("joinphrase", "") for credit in credits or []
+  ).strip()
+
+
+def _credit_id(credits: List[Dict]) -> str:
+  for credit in credits or []:
+    return (credit.get("artist") or {}).get("id", "")
+  return ""
+
+
+def compact_release(release: Dict) -> Dict:
+  """
+  Reduce a MusicBrainz release document to the fields album expansion and tagging need,
+  in the same shape as the web service's release lookup.
+  """
+  artist = _credit_name(release.get("artist-credit"))
+  artist_id = _credit_id(release.get("artist-credit"))
+  media = []
+  for medium in release.get("media", []):
+    tracks = []
+    for track in medium.get("tracks", []):
+      entry = {"title": track.get("title", "")}
+      for key in ("id", "position"):
+        if track.get(key):
+          entry[key] = track[key]
+      recording = track.get("recording") or {}
+      length = track.get("length") or recording.get("length")
+      if length:
+        entry["length"] = length
+      recording_id = recording.get("id")
+      if recording_id:
+        entry["recording"] = {"id": recording_id}
+      track_artist = _credit_name(track.get("artist-credit"))
+      if track_artist and track_artist != artist:
+        entry["artist-credit"] = [{"name": track_artist, "artist": {"id": _credit_id(track.get("artist-credit"))}}]
+      tracks.append(entry)
+    media.append({"position": medium.get("position"), "tracks": tracks})
+  return {
+    "id": release.get("id"),
+    "title": release.get("title", ""),
+    "status": release.get("status"),
+    "date": release.get("date", ""),
+    "artist-credit": [{"name": artist, "artist": {"id": artist_id}}],
+    "media": media,
+  }
+
+
+def open_dump(path: str) -> IO[bytes]:
+  """
+  Open a release dump for streaming: plain JSON lines, .gz/.bz2/.xz, or the
+  official mbdump tarball (read member by member, never extracted).
+  """
+  if ".tar" in os.path.basename(path):
+    archive = tarfile.open(path, "r|*")
+    for member in archive:
+      if member.name.endswith(DUMP_MEMBER):
+        return archive.extractfile(member)
+    raise ValueError(f"No {DUMP_MEMBER} member in {path}")
+  if path.endswith(".gz"):
+    return gzip.open(path, "rb")
+  if path.endswith(".bz2"):
+    return bz2.open(path, "rb")
+  if path.endswith(".xz"):
+    return lzma.open(path, "rb")
+  return open(path, "rb")
+
+
+def _write_sorted_chunk(entries: List[Tuple[str, str]], directory: str) -> str:
+  entries.sort()
+  fd, path = tempfile.mkstemp(suffix=".idx", dir=directory)
+  with os.fdopen(fd, "w", encoding="utf-8") as f:
+    for key, value in entries:
+      f.write(f"{key}\t{value}\n")
+  return path
+
+
+def _read_chunk(path: str) -> Iterator[Tuple[str, str]]:
+  with open(path, encoding="utf-8") as f:
+    for line in f:
+      key, value = line.rstrip("\n").split("\t", 1)
+      yield key, value
+
+
+def build_index(dump_path: str, index_dir: str = MB_INDEX_DIR) -> int:
+  """
+  Stream a MusicBrainz release dump into a compact on-disk index.
+
+  Each release is written once as a compact JSON line to releases.dat.
+  releases.idx holds one sorted "title<US>artist<TAB>status<TAB>offset<TAB>length"
+  line per release, built by an external merge sort so memory stays bounded
+  however large the dump is.
+
+  :param dump_path: Path to the release dump
+  :param index_dir: Directory to write the index into
+  :return: Number of releases indexed
+  """
+  os.makedirs(index_dir, exist_ok=True)
+  records_path = os.path.join(index_dir, RECORDS_FILE)
+  chunks, entries, count = [], [], 0
+
+  with open_dump(dump_path) as dump, open(records_path + ".tmp", "wb") as records:
+    for line in dump:
+      if not line.strip():
+        continue
+      try:
+        release = compact_release(json.loads(line))
+      except ValueError as e:
+        logger.warning(f"Skipping malformed release: {e}")
+        continue
+      if not release["id"] or not release["media"]:
+        continue
+      record = json.dumps(release, separators=(",", ":"), ensure_ascii=False).encode("utf-8") + b"\n"
+      offset = records.tell()
+      records.write(record)
+      artist = release["artist-credit"][0]["name"]
+      status = "1" if release["status"] == "Official" else "0"
+      entries.append((_key(release["title"], artist), f"{status}\t{offset}\t{len(record)}"))
+      count += 1
+      if len(entries) >= SORT_CHUNK_SIZE:
+        chunks.append(_write_sorted_chunk(entries, index_dir))
+        entries = []
+        logger.info(f"Indexed {count} releases")
+    if entries:
+      chunks.append(_write_sorted_chunk(entries, index_dir))
+
+  index_path = os.path.join(index_dir, INDEX_FILE)
+  with open(index_path + ".tmp", "w", encoding="utf-8") as index:
+    for key, value in heapq.merge(*(_read_chunk(chunk) for chunk in chunks)):
+      index.write(f"{key}\t{value}\n")
+  for chunk in chunks:
+    os.remove(chunk)
+
+  os.replace(records_path + ".tmp", records_path)
+  os.replace(index_path + ".tmp", index_path)
+  logger.info(f"Built MusicBrainz index with {count} releases in {index_dir}")
+  return count
+
+
+class ReleaseIndex:
+  """
+  Read-only, memory-mapped view of an index built by build_index, plus a
+  small journal of releases fetched online since the last build.
+
+  Lookups binary-search the sorted index for the normalized album title and
+  score nearby entries on title and artist similarity, so no part of the
+  index is loaded into memory up front.
+  """
+
+  def __init__(self, index_dir: str = MB_INDEX_DIR):
+    self.index_dir = index_dir
+    self._index = self._map(os.path.join(index_dir, INDEX_FILE))
+    self._records = self._map(os.path.join(index_dir, RECORDS_FILE))
+    self._journal = {}
+    journal_path = os.path.join(index_dir, JOURNAL_FILE)
+    if os.path.exists(journal_path):
+      with open(journal_path, encoding="utf-8") as f:
+        for line in f:
+          release = json.loads(line)
+          self._journal[_key(release["title"], release["artist-credit"][0]["name"])] = release
+
+  @staticmethod
+  def _map(path: str) -> Optional[mmap.mmap]:
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+      return None
+    with open(path, "rb") as f:
+      return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  @property
+  def available(self) -> bool:
+    return self._index is not None or bool(self._journal)
+
+  def _line_start(self, position: int) -> int:
+    return self._index.rfind(b"\n", 0, position) + 1
+
+  def _seek(self, prefix: bytes) -> int:
+    """
+    Offset of the first index line whose key is >= prefix.
+    """
+    low, high = 0, len(self._index)
+    while low < high:
+      middle = self._line_start((low + high) // 2)
+      end = self._index.find(b"\n", middle)
+      if self._index[middle:end] < prefix:
+        low = end + 1
+      else:
+        high = middle
+    return self._line_start(low)
+
+  def _entries(self, start: int, limit: int) -> Iterator[Tuple[str, bool, int, int]]:
+    position = start
+    for _ in range(limit):
+      end = self._index.find(b"\n", position)
+      if end == -1:
+        return
+      key, status, offset, length = self._index[position:end].decode("utf-8").split("\t")
+      yield key, status == "1", int(offset), int(length)
+      position = end + 1
+
+  def _record(self, offset: int, length: int) -> Dict:
+    return json.loads(self._records[offset:offset + length])
+
+  def lookup(self, album: str, artist: str = "") -> Optional[Dict]:
+    """
+    Find the release best matching an album title and optional artist.
+
+    :return: Release document in the web service's shape, or None
+    """
+    title, wanted_artist = _title_key(album), normalize(artist)
+
+    def score(key: str, official: bool) -> float:
+      key_title, key_artist = key.split(KEY_SEPARATOR, 1)
+      value = SequenceMatcher(None, title, key_title).ratio()
+      if wanted_artist:
+        value = (value + SequenceMatcher(None, wanted_artist, key_artist).ratio()) / 2
+      return value + (0.01 if official else 0)
+
+    best, best_score = None, MIN_MATCH_SCORE
+    for key, release in self._journal.items():
+      value = score(key, True)
+      if value > best_score:
+        best, best_score = release, value
+
+    if self._index is not None:
+      # Exact titles sort together; shorter prefixes widen the net for near misses
+      for prefix in (title + KEY_SEPARATOR, title[:max(3, len(title) // 2)], title[:3]):
+        start = self._seek(prefix.encode("utf-8"))
+        for key, official, offset, length in self._entries(start, FUZZY_SCAN_LIMIT):
+          if not key.startswith(prefix):
+            break
+          value = score(key, official)
+          if value > best_score:
+            best, best_score = (offset, length), value
+        if best is not None and best_score >= 0.99:
+          break
+
+    if isinstance(best, tuple):
+      return self._record(*best)
+    return best
+
+  def add(self, release: Dict) -> None:
+    """
+    Journal a release fetched from the web service so later lookups find it offline.
+    """
+    release = compact_release(release)
+    if not release["id"] or not release["media"]:
+      return
+    os.makedirs(self.index_dir, exist_ok=True)
+    with open(os.path.join(self.index_dir, JOURNAL_FILE), "a", encoding="utf-8") as f:
+      f.write(json.dumps(release, separators=(",", ":"), ensure_ascii=False) + "\n")
+    self._journal[_key(release["title"], release["artist-credit"][0]["name"])] = release
+
+
+_index = None
+
+
+def get_index() -> Optional[ReleaseIndex]:
+  """
+  Return the shared release index, or None when MB_INDEX_DIR isn't configured.
+  """
+  global _index
+  if _index is None and MB_INDEX_DIR:
+    _index = ReleaseIndex(MB_INDEX_DIR)
+  return _index
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Build or query the offline MusicBrainz release index.")
+  parser.add_argument("--index-dir", default=MB_INDEX_DIR or "mb_index", help="Index directory")
+  subparsers = parser.add_subparsers(dest="command", required=True)
+  build = subparsers.add_parser("build", help="Import a MusicBrainz release JSON dump")
+  build.add_argument("dump", help="Release dump (JSON lines, optionally .gz/.bz2/.xz or the mbdump .tar.xz)")
+  lookup = subparsers.add_parser("lookup", help="Look up an album")
+  lookup.add_argument("album")
+  lookup.add_argument("artist", nargs="?", default="")
+  args = parser.parse_args()
+
+  if args.command == "build":
+    build_index(args.dump, args.index_dir)
+  else:
+    release = ReleaseIndex(args.index_dir).lookup(args.album, args.artist)
+    print(json.dumps(release, indent=2, ensure_ascii=False) if release else "No matching release")
+
+
+if __name__ == "__main__":
+  main()
@@ -1,8 +1,19 @@
 # metadata.py
+import base64
 import re
-import mutagen
-from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3, TIT2, TPE1, TALB, TDRC, WXXX
+from typing import Dict, Optional
+
+from metrics import metrics
+
+# Picard's names for the MusicBrainz ids: ID3 TXXX / MP4 freeform description, Vorbis comment
+MUSICBRAINZ_TAGS = {
+  'musicbrainz_albumid': ('MusicBrainz Album Id', 'MUSICBRAINZ_ALBUMID'),
+  'musicbrainz_artistid': ('MusicBrainz Artist Id', 'MUSICBRAINZ_ARTISTID'),
+  'musicbrainz_albumartistid': ('MusicBrainz Album Artist Id', 'MUSICBRAINZ_ALBUMARTISTID'),
+  'musicbrainz_releasetrackid': ('MusicBrainz Release Track Id', 'MUSICBRAINZ_RELEASETRACKID'),
+  'musicbrainz_trackid': ('MusicBrainz Track Id', 'MUSICBRAINZ_TRACKID'),
+}
+MUSICBRAINZ_UFID_OWNER = 'http://musicbrainz.org'
 
 def clean_filename(filename: str) -> str:
   """
@@ -14,32 +25,124 @@ def clean_filename(filename: str) -> str:
   cleaned = re.sub(r'\s+', ' ', cleaned).strip()
   return cleaned
 
-def set_metadata(file_path: str, title: str, artist: str, album: str = "", year: str = "", url: str = ""):
+def set_metadata(file_path: str, title: str, artist: str, album: str = "", year: str = "", url: str = "", track_info: Optional[Dict] = None, cover: Optional[bytes] = None):
   """
-  Set metadata for the MP3 file.
+  Set metadata for the audio file (MP3, M4A or Opus) in a single read and write.
+
+  :param year: Release year or full YYYY-MM-DD date
+  :param track_info: Track dictionary from album_query.parse_album_tracks; supplies
+    album artist, track/disc numbers and MusicBrainz ids
+  :param cover: Front cover image (JPEG or PNG) to embed
   """
+  with metrics.timer("tagging"):
+    _set_metadata(file_path, title, artist, album, year, url, track_info or {}, cover)
+
+def _number(info: Dict, key: str) -> str:
+  # "3/12" style, or just "3" when the total is unknown
+  if not info.get(key):
+    return ""
+  total = info.get(key + 's')
+  return f"{info[key]}/{total}" if total else str(info[key])
+
+def _cover_mime(cover: bytes) -> str:
+  return 'image/png' if cover.startswith(b'\x89PNG') else 'image/jpeg'
+
+def _tag_id3(file_path: str, fields: Dict, info: Dict, url: str, cover: Optional[bytes]):
+  from mutagen.id3 import (
+    APIC, ID3, ID3NoHeaderError, TALB, TDRC, TIT2, TPE1, TPE2, TPOS, TRCK, TXXX, UFID, WXXX,
+  )
   try:
-    audio = EasyID3(file_path)
-  except mutagen.id3.ID3NoHeaderError:
-    audio = mutagen.File(file_path, easy=True)
+    tags = ID3(file_path)
+  except ID3NoHeaderError:
+    tags = ID3()
+
+  frames = {'title': TIT2, 'artist': TPE1, 'album': TALB, 'date': TDRC, 'album_artist': TPE2, 'track': TRCK, 'disc': TPOS}
+  for name, value in fields.items():
+    tags.add(frames[name](encoding=3, text=value))
+  for key, (description, _) in MUSICBRAINZ_TAGS.items():
+    # ID3 keeps the recording id in a UFID frame instead of a TXXX
+    if info.get(key) and key != 'musicbrainz_trackid':
+      tags.add(TXXX(encoding=3, desc=description, text=info[key]))
+  if info.get('musicbrainz_trackid'):
+    tags.add(UFID(owner=MUSICBRAINZ_UFID_OWNER, data=info['musicbrainz_trackid'].encode()))
+  if url:
+    tags.add(WXXX(encoding=3, url=url))
+  if cover:
+    tags.add(APIC(encoding=3, mime=_cover_mime(cover), type=3, desc='Cover', data=cover))
+  tags.save(file_path, v2_version=4)
+
+def _tag_mp4(file_path: str, fields: Dict, info: Dict, url: str, cover: Optional[bytes]):
+  from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+
+  audio = MP4(file_path)
+  if audio.tags is None:
     audio.add_tags()
+  keys = {'title': '\xa9nam', 'artist': '\xa9ART', 'album': '\xa9alb', 'date': '\xa9day', 'album_artist': 'aART'}
+  for name, value in fields.items():
+    if name in keys:
+      audio.tags[keys[name]] = [value]
+  if info.get('track'):
+    audio.tags['trkn'] = [(int(info['track']), int(info.get('tracks', 0)))]
+  if info.get('disc'):
+    audio.tags['disk'] = [(int(info['disc']), int(info.get('discs', 0)))]
+  freeform = {description: info.get(key) for key, (description, _) in MUSICBRAINZ_TAGS.items()}
+  freeform['WEBSITE'] = url
+  for description, value in freeform.items():
+    if value:
+      audio.tags[f'----:com.apple.iTunes:{description}'] = [MP4FreeForm(value.encode())]
+  if cover:
+    image_format = MP4Cover.FORMAT_PNG if _cover_mime(cover) == 'image/png' else MP4Cover.FORMAT_JPEG
+    audio.tags['covr'] = [MP4Cover(cover, imageformat=image_format)]
+  audio.save()
+
+def _tag_vorbis(file_path: str, fields: Dict, info: Dict, url: str, cover: Optional[bytes]):
+  import mutagen
+  from mutagen.flac import Picture
 
-  audio['title'] = title
-  audio['artist'] = artist
-  if album:
-    audio['album'] = album
-  if year:
-    audio['date'] = year
+  audio = mutagen.File(file_path)
+  if audio.tags is None:
+    audio.add_tags()
+  keys = {'title': 'TITLE', 'artist': 'ARTIST', 'album': 'ALBUM', 'date': 'DATE', 'album_artist': 'ALBUMARTIST'}
+  for name, value in fields.items():
+    if name in keys:
+      audio[keys[name]] = value
+  comments = {
+    'TRACKNUMBER': info.get('track'),
+    'TRACKTOTAL': info.get('tracks'),
+    'DISCNUMBER': info.get('disc'),
+    'DISCTOTAL': info.get('discs'),
+    'WEBSITE': url,
+  }
+  comments.update({comment: info.get(key) for key, (_, comment) in MUSICBRAINZ_TAGS.items()})
+  for comment, value in comments.items():
+    if value:
+      audio[comment] = str(value)
+  if cover:
+    picture = Picture()
+    picture.type = 3
+    picture.mime = _cover_mime(cover)
+    picture.desc = 'Cover'
+    picture.data = cover
+    audio['METADATA_BLOCK_PICTURE'] = base64.b64encode(picture.write()).decode('ascii')
   audio.save()
 
-  # Set ID3v2.4 tags
-  audio = ID3(file_path)
-  audio.add(TIT2(encoding=3, text=title))
-  audio.add(TPE1(encoding=3, text=artist))
-  if album:
-    audio.add(TALB(encoding=3, text=album))
-  if year:
-    audio.add(TDRC(encoding=3, text=year))
-  if url:
-    audio.add(WXXX(encoding=3, url=url))
-  audio.save(v2_version=4)
+def _set_metadata(file_path: str, title: str, artist: str, album: str, year: str, url: str, info: Dict, cover: Optional[bytes]):
+  # mutagen is only needed once a file is ready to tag, so it's imported by the writers
+  fields = {
+    'title': title,
+    'artist': artist,
+    'album': album,
+    'date': year,
+    'album_artist': info.get('album_artist', ''),
+    'track': _number(info, 'track'),
+    'disc': _number(info, 'disc'),
+  }
+  fields = {name: value for name, value in fields.items() if value}
+
+  extension = file_path.lower().rsplit('.', 1)[-1]
+  if extension == 'mp3':
+    _tag_id3(file_path, fields, info, url, cover)
+  elif extension in ('m4a', 'mp4'):
+    _tag_mp4(file_path, fields, info, url, cover)
+  else:
+    _tag_vorbis(file_path, fields, info, url, cover)
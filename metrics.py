@@ -0,0 +1,159 @@
+# metrics.py
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+# Upper bounds in seconds; wide enough for a cache hit through a long transcode
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+PROMETHEUS_PREFIX = "music_downloader"
+
+
+class Histogram:
+  """
+  Fixed-bucket latency histogram.
+  """
+
+  def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def observe(self, value: float) -> None:
+    self.count += 1
+    self.sum += value
+    self.max = max(self.max, value)
+    for i, bound in enumerate(self.buckets):
+      if value <= bound:
+        self.counts[i] += 1
+        return
+    self.counts[-1] += 1
+
+  def quantile(self, q: float) -> float:
+    """
+    Estimate a quantile as the upper bound of the bucket it falls in.
+    """
+    if not self.count:
+      return 0.0
+    rank, seen = q * self.count, 0
+    for i, count in enumerate(self.counts[:-1]):
+      seen += count
+      if seen >= rank:
+        return min(self.buckets[i], self.max)
+    return self.max
+
+  def summary(self) -> Dict:
+    return {
+      "count": self.count,
+      "total": round(self.sum, 3),
+      "mean": round(self.sum / self.count, 4) if self.count else 0.0,
+      "p50": self.quantile(0.5),
+      "p95": self.quantile(0.95),
+      "max": round(self.max, 4),
+    }
+
+
+def _label_key(labels: Dict) -> Tuple:
+  return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Metrics:
+  """
+  Process-wide counters and latency histograms for every pipeline stage.
+
+  Counters cover API calls, tokens, bytes, cache hits and retries; the
+  `stage_seconds` histogram is labelled by stage. Everything is reported at
+  the end of a run as JSON and optionally as a Prometheus text file.
+  """
+
+  def __init__(self):
+    self.started = time.time()
+    self.counters = {}
+    self.histograms = {}
+
+  def inc(self, name: str, value: float = 1, **labels) -> None:
+    key = (name, _label_key(labels))
+    self.counters[key] = self.counters.get(key, 0) + value
+
+  def observe(self, name: str, value: float, **labels) -> None:
+    key = (name, _label_key(labels))
+    if key not in self.histograms:
+      self.histograms[key] = Histogram()
+    self.histograms[key].observe(value)
+
+  @contextmanager
+  def timer(self, stage: str, **labels):
+    """
+    Record how long the block takes under stage_seconds{stage=...}.
+    """
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe("stage_seconds", time.perf_counter() - started, stage=stage, **labels)
+
+  def summary(self) -> Dict:
+    """
+    JSON-serializable run report.
+    """
+    def name(metric: str, labels: Tuple) -> str:
+      if not labels:
+        return metric
+      return metric + "{" + ",".join(f"{key}={value}" for key, value in labels) + "}"
+
+    return {
+      "started": self.started,
+      "elapsed_seconds": round(time.time() - self.started, 3),
+      "counters": {name(*key): value for key, value in sorted(self.counters.items())},
+      "histograms": {name(*key): histogram.summary() for key, histogram in sorted(self.histograms.items())},
+    }
+
+  def write_json(self, path: str) -> None:
+    """
+    Write the run report to a file, or to stdout when path is '-'.
+    """
+    report = json.dumps(self.summary(), indent=2)
+    if path == "-":
+      print(report, file=sys.stdout)
+      return
+    with open(path, "w") as f:
+      f.write(report + "\n")
+
+  def write_prometheus(self, path: str) -> None:
+    """
+    Write the metrics in the Prometheus text exposition format (e.g. for the node_exporter textfile collector).
+    """
+    def labels_text(labels: Tuple, extra: Tuple = ()) -> str:
+      pairs = [f'{key}="{value}"' for key, value in labels + extra]
+      return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    lines = []
+    for name in sorted({key[0] for key in self.counters}):
+      lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name}_total counter")
+      for (metric, labels), value in sorted(self.counters.items()):
+        if metric == name:
+          lines.append(f"{PROMETHEUS_PREFIX}_{name}_total{labels_text(labels)} {value}")
+    for name in sorted({key[0] for key in self.histograms}):
+      lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} histogram")
+      for (metric, labels), histogram in sorted(self.histograms.items()):
+        if metric != name:
+          continue
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+          cumulative += count
+          lines.append(f"{PROMETHEUS_PREFIX}_{name}_bucket{labels_text(labels, (('le', bound),))} {cumulative}")
+        lines.append(f"{PROMETHEUS_PREFIX}_{name}_sum{labels_text(labels)} {histogram.sum}")
+        lines.append(f"{PROMETHEUS_PREFIX}_{name}_count{labels_text(labels)} {histogram.count}")
+
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+      f.write("\n".join(lines) + "\n")
+    # Rename into place so a scraper never reads a half-written file
+    os.replace(tmp, path)
+
+
+metrics = Metrics()
@@ -0,0 +1,348 @@
+# pipeline.py
+import asyncio
+import html
+import re
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from config import (
+  ALBUM_CONCURRENCY,
+  CONCURRENT_DOWNLOADS,
+  DEFAULT_FORMAT,
+  SEARCH_CONCURRENCY,
+  TRACKS_IN_FLIGHT,
+  TRANSCODE_CONCURRENCY,
+)
+from youtube_search import get_video, search_youtube
+from llm_interface import select_best_match
+from audio_download import download_audio, duplicate_output, resume_audio
+from album_query import query_album
+from database import LibraryIndex, Manifest, normalize_key
+from ranking import DECORATION_RE, candidate_label, split_title
+from metrics import metrics
+from verification import filter_by_duration
+from utils import SingleFlight, setup_logging, track_context
+
+logger = setup_logging(__name__)
+
+NO_RESULTS = "No search results found"
+# Manifest states --resume finishes from the files on disk instead of downloading again
+RESUMABLE_STATES = ("downloaded", "transcoded")
+
+# Process-wide, so concurrent requests for one track share the work even
+# across pipelines: search and selection by normalized query and expected
+# track length (which decides the results that survive the duration check),
+# download and transcode by video id and format
+_selections = SingleFlight()
+_downloads = SingleFlight()
+
+
+class StageLimits:
+  """
+  Concurrency limits for each stage of the track pipeline.
+
+  Each stage gets its own semaphore so a slow ffmpeg encode never holds up
+  the search or LLM stages of the tracks queued behind it. LLM requests are
+  bounded inside llm_interface (LLM_CONCURRENCY), since several tracks can
+  share one batched request.
+  """
+
+  def __init__(
+    self,
+    tracks: int = TRACKS_IN_FLIGHT,
+    search: int = SEARCH_CONCURRENCY,
+    download: int = CONCURRENT_DOWNLOADS,
+    transcode: int = TRANSCODE_CONCURRENCY,
+  ):
+    self.size = max(1, tracks)
+    self.tracks = asyncio.Semaphore(self.size)
+    self.search = asyncio.Semaphore(max(1, search))
+    self.download = asyncio.Semaphore(max(1, download))
+    self.transcode = asyncio.Semaphore(max(1, transcode))
+
+
+class TrackPipeline:
+  """
+  Run songs through search -> duration check -> LLM selection -> download -> transcode with
+  up to `limits.tracks` songs in flight at once.
+  """
+
+  def __init__(
+    self,
+    output_path: str,
+    limits: Optional[StageLimits] = None,
+    download_options: Optional[Dict] = None,
+    manifest: Optional[Manifest] = None,
+    resume: bool = False,
+  ):
+    self.output_path = output_path
+    self.limits = limits or StageLimits()
+    # Extra keyword arguments for download_audio (format, quality, streaming, ...)
+    self.download_options = download_options or {}
+    self.manifest = manifest
+    # Reuse selections recorded by an interrupted run instead of searching again
+    self.resume = resume
+    self.library = LibraryIndex(output_path, manifest)
+    # Progress bar lines, one per in-flight track so bars never overwrite each other
+    self._positions = list(range(self.limits.size))
+
+  async def process(self, song: str, track_info: Optional[Dict] = None) -> Optional[str]:
+    """
+    Process a single song through every stage.
+
+    :param song: Song query
+    :param track_info: Album track dictionary from album_query.query_album, used for tagging
+    :return: Path to the downloaded file, or None if any stage failed
+    """
+    return await self._in_slot(song, self._process, song, track_info)
+
+  async def process_video(self, video_id: str, song: Optional[str] = None) -> Optional[str]:
+    """
+    Download a specific YouTube video, skipping search and selection.
+
+    :param video_id: YouTube video id
+    :param song: "Artist - Title" to save it as; derived from the video when omitted
+    :return: Path to the downloaded file, or None if any stage failed
+    """
+    return await self._in_slot(song or video_id, self._process_video, video_id, song)
+
+  async def _in_slot(self, label: str, handler, *args) -> Optional[str]:
+    async with self.limits.tracks:
+      position = self._positions.pop(0)
+      result = None
+      try:
+        with metrics.timer("track"), track_context(label):
+          result = await handler(*args, position)
+        return result
+      except Exception as e:
+        logger.error(f"[{label}] Unexpected pipeline error: {e}")
+        return None
+      finally:
+        metrics.inc("tracks", outcome="completed" if result else "failed")
+        self._positions.append(position)
+
+  def _record(self, song: str, state: str, **fields) -> None:
+    if self.manifest is not None:
+      self.manifest.record(song, state, **fields)
+
+  def _skip_existing(self, song: str, existing: str) -> str:
+    logger.info(f"[{song}] Already downloaded: {existing}")
+    metrics.inc("tracks_skipped")
+    self._record(song, "done", output_file=existing)
+    return existing
+
+  async def _process(self, song: str, track_info: Optional[Dict], position: int) -> Optional[str]:
+    job = self.manifest.get(song) if self.manifest is not None else None
+    if self.resume and job and job["selection"] and job["state"] in RESUMABLE_STATES:
+      # Checked before the library, which would take an untagged output file for a finished one
+      output_file = await self._resume(song, job)
+      if output_file:
+        return output_file
+
+    existing = self.library.find(song)
+    if existing:
+      return self._skip_existing(song, existing)
+
+    best_match = job["selection"] if self.resume and job else None
+    if best_match:
+      logger.info(f"[{song}] Resuming from recorded selection: {best_match['correct_title']}")
+    else:
+      self._record(song, "pending")
+      expected = (track_info or {}).get("length", 0)
+      (best_match, error), shared = await _selections.do(
+        f"{normalize_key(song)}|{expected}", lambda: self._select(song, expected)
+      )
+      if shared:
+        logger.info(f"[{song}] Shared the selection of an identical request in flight")
+        metrics.inc("singleflight_shared", stage="select")
+      if error != NO_RESULTS:
+        self._record(song, "searched")
+      if error:
+        logger.error(f"[{song}] {error}")
+        self._record(song, "failed", error=error)
+        return None
+      if track_info:
+        # Recorded with the selection so a resumed track is tagged the same way
+        best_match = {**best_match, "track_info": track_info}
+      self._record(song, "selected", selection=best_match)
+
+    return await self._download(song, best_match, position)
+
+  async def _resume(self, song: str, job: Dict) -> Optional[str]:
+    """
+    Pick a track up from the downloaded or transcoded state an interrupted run recorded.
+
+    :return: Path to the finished file, or None to start the track over
+    """
+    best_match = job["selection"]
+    options = {key: value for key, value in self.download_options.items() if key in ("format", "quality")}
+    output_file = await resume_audio(
+      song,
+      best_match,
+      self.output_path,
+      job["state"],
+      on_stage=lambda stage: self._record(song, stage),
+      **options,
+    )
+    if output_file:
+      self.library.add(output_file, best_match["videoId"])
+      self._record(song, "done", output_file=output_file)
+    return output_file
+
+  async def _select(self, song: str, expected: int = 0) -> Tuple[Optional[Dict], Optional[str]]:
+    """
+    Search for a song, drop results of the wrong length and pick the best of the rest.
+
+    :param expected: MusicBrainz track length in seconds, 0 when unknown
+    :return: (best match, None), or (None, reason) when either stage came up empty
+    """
+    async with self.limits.search:
+      with metrics.timer("search"):
+        search_results = await search_youtube(song)
+    if not search_results:
+      return None, NO_RESULTS
+
+    search_results, enforced = filter_by_duration(song, search_results, expected)
+
+    with metrics.timer("select"):
+      best_match = await select_best_match(song, search_results)
+    if not best_match:
+      return None, "Couldn't determine best match"
+    if not enforced:
+      # Recorded with the selection, so the download stage doesn't reject what search let through
+      best_match = {**best_match, "duration_waived": True}
+    return best_match, None
+
+  async def _process_video(self, video_id: str, song: Optional[str], position: int) -> Optional[str]:
+    existing = self.library.find_video(video_id) or (song and self.library.find(song))
+    if existing:
+      return self._skip_existing(song or video_id, existing)
+
+    async with self.limits.search:
+      video = await get_video(video_id)
+    if not video:
+      self._record(song or video_id, "failed", error="Video not found")
+      return None
+
+    if song and " - " in song:
+      correct_title = song
+    else:
+      artist, title = split_title(DECORATION_RE.sub("", candidate_label(video)))
+      if not artist:
+        # Fall back to the uploader, minus YouTube's channel decorations
+        artist = re.sub(r"(?i)( - Topic|VEVO)$", "", html.unescape(video["channelTitle"]))
+      correct_title = re.sub(r"\s+", " ", f"{artist.strip()} - {song or title}").strip()
+
+    song = song or correct_title
+    # The user asked for this video, so a long one (a DJ set, a full album) isn't a wrong pick
+    best_match = {**video, "correct_title": correct_title, "duration_waived": True}
+    self._record(song, "selected", selection=best_match)
+    return await self._download(song, best_match, position)
+
+  async def _download(self, song: str, best_match: Dict, position: int) -> Optional[str]:
+    existing = self.library.find_video(best_match["videoId"]) or self.library.find(
+      best_match["correct_title"]
+    )
+    if existing:
+      return self._skip_existing(song, existing)
+
+    async def fetch() -> Tuple[Optional[str], Dict]:
+      output_file = await download_audio(
+        song,
+        best_match,
+        self.output_path,
+        download_limit=self.limits.download,
+        transcode_limit=self.limits.transcode,
+        position=position,
+        on_stage=lambda stage: self._record(song, stage),
+        **self.download_options,
+      )
+      # Handed to requests sharing the download, which need to know whose tags the file has
+      return output_file, best_match
+
+    key = f"{best_match['videoId']}|{self.download_options.get('format', DEFAULT_FORMAT)}"
+    (output_file, source_match), shared = await _downloads.do(key, fetch)
+    if shared and output_file:
+      metrics.inc("singleflight_shared", stage="download")
+      output_file = await duplicate_output(
+        song, output_file, best_match, self.output_path, source_match
+      )
+    if output_file:
+      self.library.add(output_file, best_match["videoId"])
+      self._record(song, "done", output_file=output_file)
+    else:
+      self._record(song, "failed", error="Download failed")
+    return output_file
+
+  async def process_entry(self, entry: Dict) -> Optional[str]:
+    """
+    Process a 'song' or 'video' entry as produced by inputs.make_entry.
+    """
+    if entry["type"] == "video":
+      return await self.process_video(entry["video_id"], entry.get("song"))
+    return await self.process(entry["song"], entry.get("track_info"))
+
+  async def run(self, songs: List[str]) -> List[Optional[str]]:
+    """
+    Process songs concurrently, returning results in input order.
+    """
+    return await asyncio.gather(*(self.process(song) for song in songs))
+
+  async def run_entries(self, entries: AsyncIterator[Dict]) -> Tuple[int, int]:
+    """
+    Drain a stream of song, video and album entries.
+
+    Entries are pulled only as fast as workers free up, so memory stays flat
+    however long the input is, and the first tracks start while the rest is
+    still being read. Albums are expanded concurrently (ALBUM_CONCURRENCY at
+    a time) and their tracks join the same queue.
+
+    :param entries: Async iterator of entries from inputs.read_entries or inputs.make_entry
+    :return: (tracks downloaded, tracks attempted)
+    """
+    queue = asyncio.Queue(maxsize=self.limits.size)
+    album_limit = asyncio.Semaphore(max(1, ALBUM_CONCURRENCY))
+    counts = {"downloaded": 0, "total": 0}
+
+    async def worker() -> None:
+      while True:
+        entry = await queue.get()
+        if entry is None:
+          return
+        counts["total"] += 1
+        if await self.process_entry(entry):
+          counts["downloaded"] += 1
+
+    async def expand(album: str, artist: str) -> None:
+      try:
+        with metrics.timer("album_lookup"):
+          tracks = await query_album(album, artist)
+        if not tracks:
+          logger.error(f"No tracks found for album: {album}")
+          return
+        logger.info(f"Found {len(tracks)} tracks for album: {album}")
+        for track in tracks:
+          await queue.put({"type": "song", "song": track["song"], "track_info": track})
+      except Exception as e:
+        logger.error(f"Error expanding album {album}: {e}")
+      finally:
+        album_limit.release()
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(self.limits.size)]
+    expansions = []
+    try:
+      async for entry in entries:
+        if entry["type"] == "album":
+          await album_limit.acquire()
+          expansions = [task for task in expansions if not task.done()]
+          expansions.append(asyncio.ensure_future(expand(entry["album"], entry["artist"])))
+        else:
+          await queue.put(entry)
+      await asyncio.gather(*expansions)
+      for _ in workers:
+        await queue.put(None)
+      await asyncio.gather(*workers)
+    finally:
+      for task in workers + expansions:
+        task.cancel()
+
+    return counts["downloaded"], counts["total"]
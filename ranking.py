@@ -0,0 +1,162 @@
+# ranking.py
+import html
+import math
+import re
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional, Tuple
+
+from config import RANKER_CONFIDENCE_MARGIN, RANKER_MIN_SIMILARITY
+
+# Bracketed decorations such as "(Official Audio)" or "[HD]"
+DECORATION_RE = re.compile(r'[\(\[][^\)\]]*[\)\]]')
+NON_WORD_RE = re.compile(r'[^\w]+')
+
+# Version keywords that disqualify a candidate unless the query asks for them
+PENALTY_KEYWORDS = [
+  'live', 'cover', 'instrumental', 'karaoke', 'remix', 'acoustic', 'sped up',
+  'slowed', 'reverb', 'nightcore', '8d', 'reaction', 'tutorial', 'lesson',
+  'piano version', 'hour', 'loop', 'extended', 'mashup',
+]
+PENALTY = 0.4
+
+TOPIC_SUFFIX = ' - Topic'
+TOPIC_BONUS = 0.15
+VEVO_BONUS = 0.1
+ARTIST_CHANNEL_BONUS = 0.1
+OFFICIAL_AUDIO_BONUS = 0.05
+POPULARITY_WEIGHT = 0.2
+SIMILARITY_WEIGHT = 0.6
+
+
+def normalize(text: str) -> str:
+  """
+  Lowercase, strip bracketed decorations and punctuation for fuzzy comparison.
+  """
+  text = DECORATION_RE.sub(' ', html.unescape(text or '').lower())
+  return NON_WORD_RE.sub(' ', text).strip()
+
+
+def split_title(text: str) -> Tuple[Optional[str], str]:
+  """
+  Split "Artist - Title" into its parts; the artist is None when absent.
+  """
+  if ' - ' in text:
+    artist, title = text.split(' - ', 1)
+    return artist.strip(), title.strip()
+  return None, text.strip()
+
+
+def candidate_label(result: Dict) -> str:
+  """
+  "Artist - Title" as best it can be read from a search result.
+
+  Auto-generated "Artist - Topic" channels upload bare song titles, so the
+  artist comes from the channel name for those.
+  """
+  title = html.unescape(result['title'])
+  channel = html.unescape(result['channelTitle'])
+  if channel.endswith(TOPIC_SUFFIX) and ' - ' not in title:
+    return f"{channel[:-len(TOPIC_SUFFIX)]} - {title}"
+  return title
+
+
+def _similarity(a: str, b: str) -> float:
+  return SequenceMatcher(None, normalize(a), normalize(b)).ratio()
+
+
+def _penalized(query: str, result: Dict) -> bool:
+  wanted = query.lower()
+  title = html.unescape(result['title']).lower()
+  return any(
+    re.search(rf'\b{re.escape(keyword)}', title) and keyword not in wanted
+    for keyword in PENALTY_KEYWORDS
+  )
+
+
+def score_candidates(query: str, search_results: List[Dict]) -> List[Tuple[float, float, Dict]]:
+  """
+  Score every search result against the query.
+
+  :param query: Song query, ideally "Artist - Title"
+  :param search_results: List of YouTube search results
+  :return: (score, title similarity, result) tuples, best first
+  """
+  query_artist, query_title = split_title(query)
+  max_views = max((math.log10(result['viewCount'] + 1) for result in search_results), default=0)
+
+  scored = []
+  for result in search_results:
+    label = candidate_label(result)
+    label_artist, label_title = split_title(label)
+    similarity = _similarity(query, label)
+    if query_artist is None:
+      similarity = max(similarity, _similarity(query_title, label_title))
+
+    score = SIMILARITY_WEIGHT * similarity
+    channel = html.unescape(result['channelTitle'])
+    artist = query_artist or label_artist
+    if channel.endswith(TOPIC_SUFFIX):
+      score += TOPIC_BONUS
+    elif 'vevo' in channel.lower():
+      score += VEVO_BONUS
+    elif artist and normalize(channel).replace(' ', '').startswith(normalize(artist).replace(' ', '')):
+      score += ARTIST_CHANNEL_BONUS
+    if 'official audio' in result['title'].lower():
+      score += OFFICIAL_AUDIO_BONUS
+    if max_views:
+      score += POPULARITY_WEIGHT * math.log10(result['viewCount'] + 1) / max_views
+    if _penalized(query, result):
+      score -= PENALTY
+
+    scored.append((score, similarity, result))
+
+  scored.sort(key=lambda entry: entry[0], reverse=True)
+  return scored
+
+
+def pick_confident_match(
+  query: str,
+  search_results: List[Dict],
+  margin: float = RANKER_CONFIDENCE_MARGIN,
+  min_similarity: float = RANKER_MIN_SIMILARITY,
+) -> Optional[Dict]:
+  """
+  Pick the best match locally when the top candidate is an obvious winner.
+
+  Uploads equivalent to the top pick (same normalized "Artist - Title",
+  no penalty keywords) don't count against its margin, since either would
+  be an acceptable download.
+
+  :return: Best match dictionary with 'correct_title', or None to escalate to the LLM
+  """
+  if not search_results:
+    return None
+
+  scored = score_candidates(query, search_results)
+  top_score, top_similarity, top = scored[0]
+  if top_similarity < min_similarity or _penalized(query, top):
+    return None
+
+  top_label = normalize(candidate_label(top))
+  for score, _, result in scored[1:]:
+    if normalize(candidate_label(result)) == top_label and not _penalized(query, result):
+      continue
+    if top_score - score < margin:
+      return None
+    break
+
+  # The upload's own spelling and capitalization, once its decorations are stripped
+  label_artist, label_title = split_title(DECORATION_RE.sub('', candidate_label(top)))
+  query_artist, query_title = split_title(query)
+  if query_artist:
+    # Only trusted when it names the same track the user asked for
+    if label_artist and normalize(f"{label_artist} - {label_title}") == normalize(query):
+      correct_title = f"{label_artist} - {label_title}"
+    else:
+      correct_title = f"{query_artist} - {query_title}"
+  elif label_artist:
+    correct_title = f"{label_artist} - {label_title}"
+  else:
+    return None
+
+  return {**top, 'correct_title': re.sub(r'\s+', ' ', correct_title).strip()}
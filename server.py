@@ -0,0 +1,284 @@
+# server.py
+import asyncio
+import itertools
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+from album_query import query_album
+from database import normalize_key
+from inputs import make_entry
+from metrics import metrics
+from pipeline import TrackPipeline
+from utils import setup_logging
+
+logger = setup_logging(__name__)
+
+JOB_STATES = ("queued", "running", "done", "failed")
+# Finished jobs kept for status lookups before the oldest are forgotten
+JOB_HISTORY = 1000
+
+
+class Job:
+  """
+  One submitted song, video or album and the tracks it expanded into.
+  """
+
+  def __init__(self, entry: Dict, priority: int = 0):
+    self.id = uuid.uuid4().hex[:12]
+    self.entry = entry
+    self.priority = priority
+    self.state = "queued"
+    self.error = None
+    self.created = time.time()
+    self.started = None
+    self.finished = None
+    self.tracks: List[Dict] = []
+    self.track_info: List[Dict] = []
+    self.pending = 0
+
+  def to_dict(self) -> Dict:
+    return {
+      "id": self.id,
+      "entry": self.entry,
+      "priority": self.priority,
+      "state": self.state,
+      "error": self.error,
+      "created": self.created,
+      "started": self.started,
+      "finished": self.finished,
+      "tracks": self.tracks,
+    }
+
+
+def job_key(entry: Dict) -> str:
+  """
+  Identity of a request, so resubmitting work that is already queued or running joins the existing job.
+  """
+  if entry["type"] == "video":
+    return f"video:{entry['video_id']}"
+  if entry["type"] == "album":
+    return f"album:{normalize_key(entry['album'])}|{normalize_key(entry['artist'])}"
+  return f"song:{normalize_key(entry['song'])}"
+
+
+class JobQueue:
+  """
+  Prioritized queue of download jobs drained by a long-lived TrackPipeline.
+
+  Higher priorities run first, ties in submission order. Albums are expanded
+  when they reach the front of the queue and their tracks re-enter it at the
+  album's priority, so a large album doesn't hold back urgent single songs.
+  Submitting a request identical to an unfinished job returns that job.
+  """
+
+  def __init__(self, pipeline: TrackPipeline, workers: Optional[int] = None, history: int = JOB_HISTORY):
+    self.pipeline = pipeline
+    self.workers = workers or pipeline.limits.size
+    self.history = history
+    self.jobs: Dict[str, Job] = {}
+    self._active: Dict[str, Job] = {}
+    self._queue = asyncio.PriorityQueue()
+    self._order = itertools.count()
+    self._tasks: List[asyncio.Task] = []
+
+  def submit(self, entry: Dict, priority: int = 0) -> Tuple[Job, bool]:
+    """
+    Queue a song, video or album entry as produced by inputs.make_entry.
+
+    :return: (job, created); created is False when an identical job was already in flight
+    """
+    key = job_key(entry)
+    existing = self._active.get(key)
+    if existing is not None:
+      metrics.inc("jobs_deduplicated")
+      return existing, False
+
+    job = Job(entry, priority)
+    self.jobs[job.id] = job
+    self._active[key] = job
+    if entry["type"] == "album":
+      self._put(job, None)
+    else:
+      job.tracks = [{"song": entry.get("song") or entry.get("video_id"), "state": "queued", "output_file": None}]
+      job.pending = 1
+      self._put(job, 0)
+    metrics.inc("jobs_submitted", type=entry["type"])
+    self._prune()
+    return job, True
+
+  def counts(self) -> Dict[str, int]:
+    counts = dict.fromkeys(JOB_STATES, 0)
+    for job in self.jobs.values():
+      counts[job.state] += 1
+    return counts
+
+  def _put(self, job: Job, track: Optional[int]) -> None:
+    self._queue.put_nowait((-job.priority, next(self._order), job, track))
+
+  def _prune(self) -> None:
+    finished = [job_id for job_id, job in self.jobs.items() if job.finished is not None]
+    for job_id in finished[:max(0, len(finished) - self.history)]:
+      del self.jobs[job_id]
+
+  def _finish(self, job: Job, error: Optional[str] = None) -> None:
+    job.finished = time.time()
+    downloaded = any(track["output_file"] for track in job.tracks)
+    job.state = "done" if downloaded and not error else "failed"
+    job.error = error or (None if downloaded else "No tracks downloaded")
+    self._active.pop(job_key(job.entry), None)
+    metrics.inc("jobs", outcome=job.state)
+    logger.info(f"Job {job.id} {job.state}: {sum(1 for track in job.tracks if track['output_file'])}/{len(job.tracks)} tracks")
+
+  async def _expand(self, job: Job) -> None:
+    tracks = await query_album(job.entry["album"], job.entry["artist"])
+    if not tracks:
+      self._finish(job, f"No tracks found for album: {job.entry['album']}")
+      return
+    job.tracks = [{"song": track["song"], "state": "queued", "output_file": None} for track in tracks]
+    job.track_info = tracks
+    job.pending = len(tracks)
+    for index in range(len(tracks)):
+      self._put(job, index)
+
+  async def _process(self, job: Job, index: int) -> None:
+    track = job.tracks[index]
+    track["state"] = "running"
+    if job.entry["type"] == "album":
+      entry = {"type": "song", "song": track["song"], "track_info": job.track_info[index]}
+    else:
+      entry = job.entry
+    output_file = await self.pipeline.process_entry(entry)
+    track["state"] = "done" if output_file else "failed"
+    track["output_file"] = output_file
+    job.pending -= 1
+    if job.pending == 0:
+      self._finish(job)
+
+  async def _worker(self) -> None:
+    while True:
+      _, _, job, index = await self._queue.get()
+      if job.state == "queued":
+        job.state = "running"
+        job.started = time.time()
+      try:
+        if index is None:
+          await self._expand(job)
+        else:
+          await self._process(job, index)
+      except Exception as e:
+        logger.error(f"Job {job.id} failed: {e}")
+        if job.finished is None:
+          self._finish(job, str(e))
+      finally:
+        self._queue.task_done()
+
+  def start(self) -> None:
+    self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+  async def close(self) -> None:
+    for task in self._tasks:
+      task.cancel()
+    await asyncio.gather(*self._tasks, return_exceptions=True)
+    self._tasks = []
+
+
+def _parse_job(body: Dict) -> Tuple[Optional[Dict], int]:
+  entry = make_entry(
+    song=body.get("song", "") or body.get("title", ""),
+    album=body.get("album", ""),
+    artist=body.get("artist", ""),
+    video_id=body.get("video_id", "") or body.get("url", ""),
+  )
+  return entry, int(body.get("priority", 0))
+
+
+def create_app(queue: JobQueue) -> web.Application:
+  """
+  HTTP API over a JobQueue:
+
+    POST /jobs         {"song"|"album"[, "artist"]|"video_id"|"url", "priority"}, or a list of them
+    GET  /jobs         every known job (?state=queued|running|done|failed to filter)
+    GET  /jobs/{id}    one job with per-track state and output files
+    GET  /health       queue counts
+    GET  /metrics      the run's counters and stage timings
+  """
+  async def submit(request: web.Request) -> web.Response:
+    try:
+      body = await request.json()
+    except ValueError:
+      raise web.HTTPBadRequest(text="Expected a JSON body")
+    requests = body if isinstance(body, list) else [body]
+
+    parsed = []
+    for item in requests:
+      try:
+        entry, priority = _parse_job(item) if isinstance(item, dict) else (None, 0)
+      except (TypeError, ValueError):
+        entry, priority = None, 0
+      if entry is None:
+        raise web.HTTPBadRequest(text=f"Not a song, album or video job: {item}")
+      parsed.append((entry, priority))
+
+    results = []
+    for entry, priority in parsed:
+      job, created = queue.submit(entry, priority)
+      results.append({**job.to_dict(), "duplicate": not created})
+    return web.json_response(results if isinstance(body, list) else results[0], status=202)
+
+  async def list_jobs(request: web.Request) -> web.Response:
+    state = request.query.get("state")
+    return web.json_response(
+      [job.to_dict() for job in queue.jobs.values() if not state or job.state == state]
+    )
+
+  async def get_job(request: web.Request) -> web.Response:
+    job = queue.jobs.get(request.match_info["job_id"])
+    if job is None:
+      raise web.HTTPNotFound(text="Unknown job")
+    return web.json_response(job.to_dict())
+
+  async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok", "jobs": queue.counts()})
+
+  async def report(request: web.Request) -> web.Response:
+    return web.json_response(metrics.summary())
+
+  app = web.Application()
+  app.router.add_post("/jobs", submit)
+  app.router.add_get("/jobs", list_jobs)
+  app.router.add_get("/jobs/{job_id}", get_job)
+  app.router.add_get("/health", health)
+  app.router.add_get("/metrics", report)
+  return app
+
+
+async def serve(pipeline: TrackPipeline, host: str, port: int, socket_path: Optional[str] = None) -> None:
+  """
+  Accept jobs over HTTP until cancelled, keeping the pipeline, its API
+  clients, connection pool and caches warm between requests.
+
+  :param socket_path: Listen on this Unix socket instead of host:port
+  """
+  queue = JobQueue(pipeline)
+  queue.start()
+  runner = web.AppRunner(create_app(queue), access_log=None)
+  await runner.setup()
+  if socket_path:
+    if os.path.exists(socket_path):
+      os.remove(socket_path)
+    site = web.UnixSite(runner, socket_path)
+    address = socket_path
+  else:
+    site = web.TCPSite(runner, host, port)
+    address = f"http://{host}:{port}"
+  await site.start()
+  logger.info(f"Serving download jobs on {address}")
+  try:
+    await asyncio.Event().wait()
+  finally:
+    await queue.close()
+    await runner.cleanup()
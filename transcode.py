@@ -0,0 +1,88 @@
+# transcode.py
+import asyncio
+import subprocess
+import time
+from typing import List
+
+from config import FFMPEG_PATH, TRANSCODE_CONCURRENCY
+from utils import setup_logging
+from metrics import metrics
+
+logger = setup_logging(__name__)
+
+
+class Transcoder:
+  """
+  Pool of ffmpeg workers fed from a queue.
+
+  Downloads enqueue conversions and return to fetching the next track while
+  up to `workers` ffmpeg processes (default: CPU count) run in parallel.
+  Each job's queue wait and run time go to the stage_seconds metrics.
+  """
+
+  def __init__(self, workers: int = TRANSCODE_CONCURRENCY):
+    self.workers = max(1, workers)
+    self._queue = None
+    self._tasks = []
+
+  def _start(self) -> None:
+    self._queue = asyncio.Queue()
+    self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+  async def transcode(self, song: str, args: List[str]) -> float:
+    """
+    Queue an ffmpeg invocation and wait for it to finish.
+
+    :param song: Song the job belongs to, for logging
+    :param args: ffmpeg arguments (without the executable)
+    :return: Seconds ffmpeg spent running
+    :raises subprocess.CalledProcessError: If ffmpeg exits with an error
+    """
+    if self._queue is None:
+      self._start()
+    future = asyncio.get_event_loop().create_future()
+    await self._queue.put((song, args, future, time.monotonic()))
+    return await future
+
+  async def _worker(self) -> None:
+    while True:
+      song, args, future, queued_at = await self._queue.get()
+      started = time.monotonic()
+      try:
+        process = await asyncio.create_subprocess_exec(
+          FFMPEG_PATH,
+          *args,
+          stdout=asyncio.subprocess.DEVNULL,
+          stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await process.communicate()
+        elapsed = time.monotonic() - started
+        metrics.observe("stage_seconds", started - queued_at, stage="transcode_queue")
+        metrics.observe("stage_seconds", elapsed, stage="transcode")
+        if process.returncode != 0:
+          raise subprocess.CalledProcessError(
+            process.returncode, [FFMPEG_PATH, *args], stderr=stderr
+          )
+        logger.info(
+          f"[{song}] Transcoded in {elapsed:.2f}s (queued {started - queued_at:.2f}s)"
+        )
+        if not future.done():
+          future.set_result(elapsed)
+      except Exception as e:
+        if not future.done():
+          future.set_exception(e)
+      finally:
+        self._queue.task_done()
+
+  async def close(self) -> None:
+    """
+    Stop the workers. Jobs still queued are abandoned.
+    """
+    for task in self._tasks:
+      task.cancel()
+    await asyncio.gather(*self._tasks, return_exceptions=True)
+    self._tasks = []
+    self._queue = None
+
+
+transcoder = Transcoder()
@@ -0,0 +1,327 @@
+# upstreams.py
+import asyncio
+import atexit
+import json
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from config import (
+  BACKOFF_BASE,
+  BACKOFF_MAX,
+  UPSTREAM_CONCURRENCY,
+  UPSTREAM_DECREASE,
+  UPSTREAM_ERROR_RATE,
+  UPSTREAM_LATENCY_FACTOR,
+  YOUTUBE_DAILY_QUOTA,
+  YOUTUBE_QUOTA_BURST,
+  YOUTUBE_QUOTA_PATH,
+)
+from metrics import metrics
+from utils import setup_logging
+
+logger = setup_logging(__name__)
+
+# Weight of the newest sample in the running latency average
+EWMA_WEIGHT = 0.2
+# The error-rate average moves slower (about the last 20 requests), so a
+# couple of unlucky failures in a row don't read as an outage
+ERROR_WEIGHT = 0.05
+# Samples needed before a slow request can count as congestion
+LATENCY_WARMUP = 10
+
+# YouTube Data API cost of each resource, in quota units
+YOUTUBE_QUOTA_COSTS = {'search': 100, 'videos': 1}
+QUOTA_SAVE_INTERVAL = 5.0
+
+
+class Upstream:
+  """
+  Adaptive concurrency limit and shared retry backoff for one upstream service.
+
+  The limit follows AIMD: every success adds 1/limit (about one slot per
+  round of requests), while congestion multiplies it by UPSTREAM_DECREASE,
+  at most once per typical request time so a burst of failures from one
+  round counts once. Congestion is a throttled response, a request far
+  slower than usual, or errors once they make up UPSTREAM_ERROR_RATE of
+  recent requests; isolated errors (a dropped connection) only cost the
+  failing task its own retry delay. Throttling and error bursts also push
+  back a backoff deadline that every task using the upstream waits out, so
+  a struggling service sees the whole program slow down rather than each
+  task retrying on its own schedule.
+  """
+
+  def __init__(self, name: str, max_limit: int):
+    self.name = name
+    self.max_limit = max(1, max_limit)
+    self.limit = float(self.max_limit)
+    self.in_flight = 0
+    self.failures = 0
+    self.latency = 0.0
+    self.error_rate = 0.0
+    self.samples = 0
+    self.backoff_until = 0.0
+    self._decreased = 0.0
+    self._waiters = deque()
+
+  @asynccontextmanager
+  async def slot(self):
+    """
+    Hold one of the upstream's request slots for the duration of the block.
+
+    The block's outcome feeds the controller: an exception counts as a
+    failure, anything else as a success with the block's duration as latency.
+    """
+    await self._acquire()
+    started = time.monotonic()
+    try:
+      yield
+    except Exception:
+      self._release()
+      self.failed()
+      raise
+    except BaseException:
+      self._release()
+      raise
+    self._release()
+    self.succeeded(time.monotonic() - started)
+
+  async def _acquire(self) -> None:
+    loop = asyncio.get_event_loop()
+    while True:
+      wait = self.backoff_until - time.monotonic()
+      if wait > 0:
+        await asyncio.sleep(wait)
+        continue
+      if self.in_flight < int(self.limit):
+        self.in_flight += 1
+        return
+      waiter = loop.create_future()
+      self._waiters.append(waiter)
+      try:
+        await waiter
+      except asyncio.CancelledError:
+        # Pass a wake-up we were handed on to the next waiter
+        if waiter.done() and not waiter.cancelled():
+          self._wake()
+        raise
+      finally:
+        if waiter in self._waiters:
+          self._waiters.remove(waiter)
+
+  def _release(self) -> None:
+    self.in_flight -= 1
+    self._wake()
+
+  def _wake(self) -> None:
+    free = int(self.limit) - self.in_flight
+    while free > 0 and self._waiters:
+      waiter = self._waiters.popleft()
+      if not waiter.done():
+        waiter.set_result(None)
+        free -= 1
+
+  def succeeded(self, latency: float) -> None:
+    self.failures = 0
+    self.error_rate *= 1 - ERROR_WEIGHT
+    congested = (
+      UPSTREAM_LATENCY_FACTOR
+      and self.samples >= LATENCY_WARMUP
+      and latency > self.latency * UPSTREAM_LATENCY_FACTOR
+    )
+    self.latency = latency if not self.samples else self.latency + EWMA_WEIGHT * (latency - self.latency)
+    self.samples += 1
+    if congested:
+      self._decrease(f"a {latency:.1f}s request against {self.latency:.1f}s on average")
+    elif self.limit < self.max_limit:
+      self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+      self._wake()
+
+  def failed(self, delay: Optional[float] = None, throttled: bool = False) -> float:
+    """
+    Record a failed request; when it signals congestion, cut the limit and
+    push back the shared backoff deadline.
+
+    :param delay: Server-requested wait (Retry-After); a jittered exponential delay otherwise
+    :param throttled: The upstream asked us to slow down (429/503)
+    :return: The delay before this request should be retried
+    """
+    self.failures += 1
+    self.error_rate += ERROR_WEIGHT * (1 - self.error_rate)
+    if delay is None:
+      delay = self._jittered(self.failures - 1)
+    if throttled or self.error_rate >= UPSTREAM_ERROR_RATE:
+      self.backoff_until = max(self.backoff_until, time.monotonic() + delay)
+      self._decrease("throttling" if throttled else f"{self.error_rate:.0%} recent errors")
+    return delay
+
+  def _decrease(self, reason: str) -> None:
+    now = time.monotonic()
+    if now - self._decreased < max(self.latency, 0.1):
+      return
+    self._decreased = now
+    previous = int(self.limit)
+    self.limit = max(1.0, self.limit * UPSTREAM_DECREASE)
+    if int(self.limit) < previous:
+      metrics.inc('concurrency_decreases', upstream=self.name)
+      logger.warning(f"{self.name}: concurrency cut to {int(self.limit)} after {reason}")
+
+  def _jittered(self, attempt: int) -> float:
+    # "Equal jitter": at least half the exponential delay, so retries still spread out
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+  async def backoff(self, attempt: int) -> None:
+    """
+    Wait before retry number `attempt` (0-based): until the shared backoff
+    deadline if one is pending, or a jittered delay of our own otherwise.
+    """
+    wait = self.backoff_until - time.monotonic()
+    await asyncio.sleep(wait if wait > 0 else self._jittered(attempt))
+
+
+_upstreams: Dict[str, Upstream] = {}
+
+
+def get_upstream(name: str) -> Upstream:
+  """
+  Return the process-wide controller for 'youtube', 'stream', 'openai' or 'musicbrainz'.
+  """
+  if name not in _upstreams:
+    _upstreams[name] = Upstream(name, UPSTREAM_CONCURRENCY.get(name, 4))
+  return _upstreams[name]
+
+
+def _pacific():
+  try:
+    from zoneinfo import ZoneInfo
+    return ZoneInfo('America/Los_Angeles')
+  except Exception:
+    # No tz database (e.g. Windows without tzdata); standard time is close enough
+    return timezone(timedelta(hours=-8))
+
+
+class YouTubeQuota:
+  """
+  Daily YouTube Data API quota, spent before each call and persisted across runs.
+
+  Units reset at midnight Pacific time, like Google's own counter. A call
+  that would go over what is available waits for it instead of failing with
+  quotaExceeded partway through a batch. The usage file is merged rather
+  than overwritten, so concurrent runs add up their spending.
+
+  :param daily: Units per day; 0 disables tracking
+  :param burst: Fraction of the day's units usable immediately; the rest
+    becomes available evenly over the day
+  """
+
+  def __init__(self, daily: int = YOUTUBE_DAILY_QUOTA, burst: float = YOUTUBE_QUOTA_BURST, path: str = YOUTUBE_QUOTA_PATH):
+    self.daily = daily
+    self.burst = min(1.0, max(0.0, burst))
+    self.path = path
+    self.day = None
+    self.used = 0
+    self._unsaved = 0
+    self._saved = 0.0
+    self._tz = None
+    atexit.register(self.save)
+
+  def _now(self) -> datetime:
+    if self._tz is None:
+      self._tz = _pacific()
+    return datetime.now(self._tz)
+
+  def _roll(self, now: datetime) -> None:
+    day = now.date().isoformat()
+    if day != self.day:
+      if self.day is not None:
+        self.save()
+      self.day, self.used, self._unsaved = day, self._load(day), 0
+
+  def _elapsed(self, now: datetime) -> float:
+    # Seconds since today's midnight
+    return (now - now.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+
+  def _available(self, now: datetime) -> float:
+    return self.daily * min(1.0, self.burst + (1 - self.burst) * self._elapsed(now) / 86400)
+
+  async def spend(self, units: int, endpoint: str) -> None:
+    """
+    Reserve units for one call, waiting until the quota allows it.
+    """
+    if not self.daily:
+      return
+    warned = False
+    while True:
+      now = self._now()
+      self._roll(now)
+      if self.used + units <= self._available(now):
+        break
+      if self.used + units > self.daily:
+        # Nothing left today; wait for the reset
+        wait = 86400 - self._elapsed(now)
+      else:
+        # Time of day at which the accrued allowance covers this call
+        needed = ((self.used + units) / self.daily - self.burst) / (1 - self.burst)
+        wait = needed * 86400 - self._elapsed(now)
+      if not warned:
+        logger.warning(
+          f"YouTube quota: {self.used}/{self.daily} units used today; pausing {endpoint} calls for {wait / 60:.0f} min"
+        )
+        metrics.inc('quota_waits', service='youtube')
+        warned = True
+      # Re-checked periodically in case another run's usage or the day rolls over
+      await asyncio.sleep(min(max(wait, 1.0), 300))
+
+    self.used += units
+    self._unsaved += units
+    metrics.inc('quota_units', units, service='youtube', endpoint=endpoint)
+    if time.monotonic() - self._saved > QUOTA_SAVE_INTERVAL:
+      self.save()
+
+  def exhaust(self) -> None:
+    """
+    Mark today's quota used up after YouTube reported quotaExceeded.
+    """
+    if not self.daily:
+      return
+    self._roll(self._now())
+    if self.used < self.daily:
+      logger.error(f"YouTube reported its quota exceeded after {self.used} tracked units; waiting for the reset")
+      self._unsaved += self.daily - self.used
+      self.used = self.daily
+      self.save()
+
+  def _load(self, day: str) -> int:
+    try:
+      with open(self.path) as f:
+        usage = json.load(f)
+    except (OSError, ValueError):
+      return 0
+    return int(usage.get('used', 0)) if usage.get('day') == day else 0
+
+  def save(self) -> None:
+    self._saved = time.monotonic()
+    if not self._unsaved or self.day is None:
+      return
+    try:
+      # Add our spending to whatever is on disk, so other runs' usage is kept
+      used = self._load(self.day) + self._unsaved
+      directory = os.path.dirname(self.path)
+      if directory:
+        os.makedirs(directory, exist_ok=True)
+      tmp = self.path + '.tmp'
+      with open(tmp, 'w') as f:
+        json.dump({'day': self.day, 'used': used}, f)
+      os.replace(tmp, self.path)
+      self.used = max(self.used, used)
+      self._unsaved = 0
+    except OSError as e:
+      logger.warning(f"Couldn't save YouTube quota usage to {self.path}: {e}")
+
+
+youtube_quota = YouTubeQuota()
@@ -1,6 +1,225 @@
-# utils.py
+import asyncio
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
+import queue
+import random
+from contextlib import contextmanager
 
-def setup_logging():
-  logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-  return logging.getLogger(__name__)
\ No newline at end of file
+from config import LOG_FORMAT, LOG_LEVEL, LOG_PAYLOAD_MAX_CHARS, LOG_PAYLOAD_SAMPLE_RATE
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Song the current task is working on; asyncio tasks inherit it from the task that created them
+current_track = contextvars.ContextVar('current_track', default=None)
+
+_console = None
+
+class _ContextFilter(logging.Filter):
+  """
+  Stamp records with the current track, in the logging thread where the context is visible.
+  """
+  def filter(self, record):
+    record.track = current_track.get()
+    return True
+
+class JsonFormatter(logging.Formatter):
+  """
+  One JSON object per line: time, level, logger, message, track and any `extra=` fields.
+  """
+  _RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'track'}
+
+  def format(self, record):
+    event = {
+      'time': self.formatTime(record),
+      'level': record.levelname,
+      'logger': record.name,
+      'message': record.getMessage(),
+    }
+    if getattr(record, 'track', None):
+      event['track'] = record.track
+    for key, value in vars(record).items():
+      if key not in self._RECORD_FIELDS and not key.startswith('_'):
+        event[key] = value
+    return json.dumps(event, default=str, ensure_ascii=False)
+
+class _ConsoleHandler(logging.StreamHandler):
+  """
+  stderr handler that goes through tqdm.write while progress bars are drawn, so lines don't tear them.
+  """
+  tqdm_write = None
+
+  def emit(self, record):
+    if self.tqdm_write is None:
+      return super().emit(record)
+    try:
+      self.tqdm_write(self.format(record), file=self.stream)
+    except Exception:
+      self.handleError(record)
+
+def setup_logging(name: str = __name__) -> logging.Logger:
+  """
+  Configure the root logger on the first call; later calls just return the named logger.
+
+  Records are handed to a queue and written by a background thread, so a
+  slow terminal or disk never stalls the event loop. The format (LOG_FORMAT
+  text or json) and level (LOG_LEVEL) come from config. An application that
+  already configured logging keeps its own handlers.
+  """
+  global _console
+  root = logging.getLogger()
+  if _console is None and not root.handlers:
+    _console = _ConsoleHandler()
+    _console.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(_ContextFilter())
+    listener = logging.handlers.QueueListener(records, _console)
+    listener.start()
+    # Flushes whatever is still queued on the way out
+    atexit.register(listener.stop)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+  return logging.getLogger(name)
+
+@contextmanager
+def track_context(song: str):
+  """
+  Tag every record logged inside the block, including by tasks it starts, with the song.
+  """
+  token = current_track.set(song)
+  try:
+    yield
+  finally:
+    current_track.reset(token)
+
+@contextmanager
+def progress_logging():
+  """
+  Keep log lines from breaking tqdm progress bars while the block runs.
+  """
+  from tqdm import tqdm
+
+  if _console is None:
+    # Someone else's handlers; let tqdm swap their console handlers out
+    from tqdm.contrib.logging import logging_redirect_tqdm
+
+    with logging_redirect_tqdm():
+      yield
+    return
+  _console.tqdm_write = tqdm.write
+  try:
+    yield
+  finally:
+    _console.tqdm_write = None
+
+def log_payload(logger: logging.Logger, payload, message: str, *args) -> None:
+  """
+  Log an API payload at DEBUG, serialized only when DEBUG is on.
+
+  Only LOG_PAYLOAD_SAMPLE_RATE of payloads are logged, and encoding stops
+  after LOG_PAYLOAD_MAX_CHARS, so a huge release never gets serialized in
+  full just to be cut short.
+
+  :param message: %-style message, followed by its args; the payload is appended
+  """
+  if not logger.isEnabledFor(logging.DEBUG) or random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+    return
+  chunks, size = [], 0
+  for chunk in json.JSONEncoder(ensure_ascii=False, default=str).iterencode(payload):
+    chunks.append(chunk)
+    size += len(chunk)
+    if size > LOG_PAYLOAD_MAX_CHARS:
+      break
+  text = ''.join(chunks)
+  if size > LOG_PAYLOAD_MAX_CHARS:
+    text = text[:LOG_PAYLOAD_MAX_CHARS] + '... (truncated)'
+  logger.debug(message + ': %s', *args, text)
+
+class no_limit:
+  """
+  Async context manager that never blocks; stands in for an absent semaphore.
+  """
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc_info):
+    return False
+
+class MicroBatcher:
+  """
+  Coalesce concurrent single-item requests into batched calls.
+
+  Items submitted within `max_delay` seconds of each other are handed to
+  `handler` together (at most `max_size` at a time). The handler receives a
+  list of items and must return a list of results in the same order.
+  """
+
+  def __init__(self, handler, max_size: int, max_delay: float = 0.01):
+    self.handler = handler
+    self.max_size = max_size
+    self.max_delay = max_delay
+    self._pending = []
+    self._timer = None
+    # Running batches, referenced until done so they can't be garbage collected mid-call
+    self._running = set()
+
+  async def submit(self, item):
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+    self._pending.append((item, future))
+    if len(self._pending) >= self.max_size:
+      self._flush()
+    elif self._timer is None:
+      self._timer = loop.call_later(self.max_delay, self._flush)
+    return await future
+
+  def _flush(self):
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    batch, self._pending = self._pending, []
+    if batch:
+      task = asyncio.ensure_future(self._run(batch))
+      self._running.add(task)
+      task.add_done_callback(self._running.discard)
+
+  async def _run(self, batch):
+    try:
+      results = await self.handler([item for item, _ in batch])
+    except Exception as e:
+      for _, future in batch:
+        if not future.done():
+          future.set_exception(e)
+      return
+    for (_, future), result in zip(batch, results):
+      if not future.done():
+        future.set_result(result)
+
+class SingleFlight:
+  """
+  Share one in-progress call among concurrent callers asking for the same key.
+
+  The first caller for a key starts `factory()`; anyone asking for that key
+  before it finishes awaits the same result (or exception) instead of
+  repeating the work. Once it finishes the key is forgotten, so later calls
+  start fresh.
+  """
+
+  def __init__(self):
+    self._calls = {}
+
+  async def do(self, key, factory):
+    """
+    :return: (result, shared); shared is True when the result came from another caller's call
+    """
+    task = self._calls.get(key)
+    shared = task is not None
+    if not shared:
+      task = asyncio.ensure_future(factory())
+      self._calls[key] = task
+      task.add_done_callback(lambda _: self._calls.pop(key, None))
+    # Shielded so one caller being cancelled doesn't cancel the work for the others
+    return await asyncio.shield(task), shared
\ No newline at end of file
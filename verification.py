@@ -0,0 +1,89 @@
+# verification.py
+from typing import Dict, List, Optional, Tuple
+
+from config import (
+  DURATION_CHECK_ENABLED,
+  DURATION_TOLERANCE,
+  DURATION_TOLERANCE_RATIO,
+  MAX_TRACK_SECONDS,
+)
+from metrics import metrics
+from utils import setup_logging
+
+logger = setup_logging(__name__)
+
+
+class DurationMismatch(Exception):
+  """
+  Raised when a video turns out to be the wrong length for the track, so the
+  download is abandoned instead of retried.
+  """
+
+
+def duration_mismatch(duration: int, expected: int = 0) -> Optional[str]:
+  """
+  Check an upload's length against the track's.
+
+  :param duration: Upload length in seconds (0 when unknown, which always passes)
+  :param expected: MusicBrainz track length in seconds (0 when unknown; only MAX_TRACK_SECONDS applies)
+  :return: Why the upload is rejected, or None if it passes
+  """
+  if not DURATION_CHECK_ENABLED or not duration:
+    return None
+  if expected:
+    tolerance = max(DURATION_TOLERANCE, expected * DURATION_TOLERANCE_RATIO)
+    if abs(duration - expected) > tolerance:
+      return f"{_clock(duration)} long, expected {_clock(expected)}"
+  elif MAX_TRACK_SECONDS and duration > MAX_TRACK_SECONDS:
+    return f"{_clock(duration)} long, over the {_clock(MAX_TRACK_SECONDS)} limit"
+  return None
+
+
+def filter_by_duration(song: str, search_results: List[Dict], expected: int = 0) -> Tuple[List[Dict], bool]:
+  """
+  Drop search results whose length rules them out before any of them is selected or downloaded.
+
+  Extended mixes, live cuts and hour-long loops usually differ from the
+  studio track by far more than the tolerance. When every result is ruled
+  out the track length itself is suspect (a single edit, a hidden track),
+  so the results are returned unfiltered and left to the selection stage.
+
+  :param expected: MusicBrainz track length in seconds, 0 when unknown
+  :return: (results, enforced); enforced is False when the check was given
+    up, so the download stage mustn't enforce it either
+  """
+  kept = []
+  for result in search_results:
+    reason = duration_mismatch(result.get('duration', 0), expected)
+    if reason:
+      logger.info(f"[{song}] Rejected '{result['title']}' ({result['videoId']}): {reason}")
+    else:
+      kept.append(result)
+
+  rejected = len(search_results) - len(kept)
+  if not rejected:
+    return search_results, True
+  if not kept:
+    logger.warning(f"[{song}] Every search result failed the duration check; keeping them all")
+    return search_results, False
+  metrics.inc('duration_rejected', rejected, stage='search')
+  return kept, True
+
+
+def verify_duration(song: str, duration: int, expected: int = 0) -> None:
+  """
+  Raise DurationMismatch if the video picked for a song is the wrong length.
+
+  :param duration: Length reported alongside the video's streams, in seconds
+  """
+  reason = duration_mismatch(duration, expected)
+  if reason:
+    metrics.inc('duration_rejected', stage='download')
+    raise DurationMismatch(f"Video is {reason}")
+
+
+def _clock(seconds: int) -> str:
+  minutes, seconds = divmod(int(seconds), 60)
+  if minutes >= 60:
+    return f"{minutes // 60}:{minutes % 60:02d}:{seconds:02d}"
+  return f"{minutes}:{seconds:02d}"
@@ -1,37 +1,156 @@
 # youtube_search.py
 import logging
-from typing import List, Dict
+import re
+from typing import List, Dict, Optional
 import asyncio
-from googleapiclient.discovery import build
 
-from config import YOUTUBE_API_KEY, MAX_RETRIES
-from utils import setup_logging
+from config import YOUTUBE_API_KEY, YOUTUBE_API_URL, MAX_RETRIES
+from utils import setup_logging, MicroBatcher
+from database import cache
+from http_client import request
+from metrics import metrics
+from upstreams import YOUTUBE_QUOTA_COSTS, get_upstream, youtube_quota
 
-logger = setup_logging()
-youtube = build('youtube', 'v3', developerKey=YOUTUBE_API_KEY)
+logger = setup_logging(__name__)
 
-async def get_video_statistics(video_id: str) -> Dict:
+REQUEST_TIMEOUT = 30
+
+STATISTICS_BATCH_SIZE = 50  # videos.list accepts up to 50 comma-separated ids
+STATISTICS_BATCH_DELAY = 0.05
+EMPTY_STATISTICS = {'viewCount': 0, 'likeCount': 0, 'dislikeCount': 0, 'duration': 0}
+DURATION_RE = re.compile(r'P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?$')
+
+_statistics_batcher = None
+
+async def _api_get(resource: str, **params) -> Dict:
+  """
+  Issue a GET against a YouTube Data API v3 resource and return the JSON body.
+
+  The call's quota units are reserved first, waiting if today's quota
+  doesn't allow it yet.
+  """
+  from aiohttp import ClientTimeout
+
+  await youtube_quota.spend(YOUTUBE_QUOTA_COSTS.get(resource, 1), resource)
+  params['key'] = YOUTUBE_API_KEY or ''
+  metrics.inc('api_calls', service='youtube', endpoint=resource)
+  with metrics.timer('youtube_api', endpoint=resource):
+    async with get_upstream('youtube').slot():
+      async with await request(
+        'GET',
+        f"{YOUTUBE_API_URL}/{resource}",
+        upstream='youtube',
+        params=params,
+        timeout=ClientTimeout(total=REQUEST_TIMEOUT)
+      ) as response:
+        if response.status == 403 and 'quotaExceeded' in await response.text():
+          youtube_quota.exhaust()
+        response.raise_for_status()
+        return await response.json()
+
+def parse_duration(duration: str) -> int:
   """
-  Get statistics for a single video.
+  Convert an ISO 8601 contentDetails duration ("PT4M13S") to seconds; 0 if unknown.
   """
+  match = DURATION_RE.match(duration or '')
+  if not match:
+    return 0
+  days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+  return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+def _parse_statistics(item: Dict) -> Dict:
+  stats = item.get('statistics', {})
+  return {
+    'viewCount': int(stats.get('viewCount', 0)),
+    'likeCount': int(stats.get('likeCount', 0)),
+    'dislikeCount': int(stats.get('dislikeCount', 0)),
+    'duration': parse_duration(item.get('contentDetails', {}).get('duration'))
+  }
+
+async def get_videos_statistics(video_ids: List[str]) -> List[Optional[Dict]]:
+  """
+  Get statistics and durations for up to 50 videos with a single videos.list call.
+
+  contentDetails rides along at no extra quota cost, so every candidate's
+  length is known before selection.
+
+  :param video_ids: Video ids to look up
+  :return: Statistics dictionaries in the same order as video_ids; None for
+    every id when the call failed, so callers can tell missing data from zeros
+  """
+  unique_ids = list(dict.fromkeys(video_ids))
   try:
-    response = youtube.videos().list(
-      part='statistics',
-      id=video_id
-    ).execute()
-
-    if response['items']:
-      stats = response['items'][0]['statistics']
-      return {
-        'viewCount': int(stats.get('viewCount', 0)),
-        'likeCount': int(stats.get('likeCount', 0)),
-        'dislikeCount': int(stats.get('dislikeCount', 0))
-      }
-    else:
-      return {'viewCount': 0, 'likeCount': 0, 'dislikeCount': 0}
+    response = await _api_get(
+      'videos',
+      part='statistics,contentDetails',
+      id=','.join(unique_ids),
+      maxResults=STATISTICS_BATCH_SIZE
+    )
+
+    statistics = {item['id']: _parse_statistics(item) for item in response['items']}
   except Exception as e:
-    logger.error(f"Error getting statistics for video {video_id}: {e}")
-    return {'viewCount': 0, 'likeCount': 0, 'dislikeCount': 0}
+    logger.error(f"Error getting statistics for {len(unique_ids)} videos: {e}")
+    return [None] * len(video_ids)
+
+  return [dict(statistics.get(video_id, EMPTY_STATISTICS)) for video_id in video_ids]
+
+async def get_video_statistics(video_id: str) -> Optional[Dict]:
+  """
+  Get statistics for a single video, or None if the lookup failed.
+
+  Lookups issued close together (e.g. every hit of a result page, or the
+  pages of several songs searched concurrently) are coalesced into one
+  batched videos.list call.
+  """
+  global _statistics_batcher
+  if _statistics_batcher is None:
+    _statistics_batcher = MicroBatcher(
+      get_videos_statistics, STATISTICS_BATCH_SIZE, STATISTICS_BATCH_DELAY
+    )
+  return await _statistics_batcher.submit(video_id)
+
+def _build_result(video_id: str, snippet: Dict, stats: Dict) -> Dict:
+  return {
+    'title': snippet['title'],
+    'description': snippet['description'],
+    'url': f"https://www.youtube.com/watch?v={video_id}",
+    'channelTitle': snippet['channelTitle'],
+    'videoId': video_id,
+    'viewCount': stats['viewCount'],
+    'likeCount': stats['likeCount'],
+    'dislikeCount': stats['dislikeCount'],
+    'duration': stats.get('duration', 0),
+    'publishedAt': snippet['publishedAt']
+  }
+
+async def get_video(video_id: str) -> Optional[Dict]:
+  """
+  Look up a single video by id, in the same shape as a search result.
+
+  :param video_id: YouTube video id
+  :return: Result dictionary, or None if the video doesn't exist or the lookup failed
+  """
+  cached = cache.get('video', video_id)
+  if cached:
+    return cached
+
+  for attempt in range(MAX_RETRIES):
+    try:
+      # One videos.list call (1 quota unit) covers the snippet, statistics and length
+      response = await _api_get('videos', part='snippet,statistics,contentDetails', id=video_id)
+      if not response['items']:
+        logger.error(f"Video not found: {video_id}")
+        return None
+      item = response['items'][0]
+      result = _build_result(video_id, item['snippet'], _parse_statistics(item))
+      cache.set('video', video_id, result)
+      return result
+    except Exception as e:
+      logger.warning(f"Attempt {attempt + 1} failed for video {video_id}: {e}")
+      if attempt == MAX_RETRIES - 1:
+        logger.error(f"All lookup attempts failed for video {video_id}: {e}")
+        return None
+      await get_upstream('youtube').backoff(attempt)
 
 async def search_youtube(query: str, max_results: int = 10) -> List[Dict]:
   """
@@ -41,36 +160,43 @@ async def search_youtube(query: str, max_results: int = 10) -> List[Dict]:
   :param max_results: Maximum number of results to return
   :return: List of search result dictionaries
   """
+  cache_key = f"{query}|{max_results}"
+  cached = cache.get('search', cache_key)
+  if cached:
+    logger.info(f"[{query}] Using cached search results")
+    return cached
+
   for attempt in range(MAX_RETRIES):
     try:
-      response = youtube.search().list(
+      response = await _api_get(
+        'search',
         q=query,
         part='snippet',
         maxResults=max_results,
         type='video'
-      ).execute()
+      )
       logger.info(f"[{query}] Search successful")
 
-      search_results = []
-      for item in response['items']:
-        video_id = item['id']['videoId']
-        stats = await get_video_statistics(video_id)
-        search_results.append({
-          'title': item['snippet']['title'],
-          'description': item['snippet']['description'],
-          'url': f"https://www.youtube.com/watch?v={video_id}",
-          'channelTitle': item['snippet']['channelTitle'],
-          'videoId': video_id,
-          'viewCount': stats['viewCount'],
-          'likeCount': stats['likeCount'],
-          'dislikeCount': stats['dislikeCount'],
-          'publishedAt': item['snippet']['publishedAt']
-        })
+      video_ids = [item['id']['videoId'] for item in response['items']]
+      statistics = await asyncio.gather(
+        *(get_video_statistics(video_id) for video_id in video_ids)
+      )
+
+      search_results = [
+        _build_result(video_id, item['snippet'], stats or EMPTY_STATISTICS)
+        for item, video_id, stats in zip(response['items'], video_ids, statistics)
+      ]
 
+      if any(stats is None for stats in statistics):
+        # Fine for this run, but cached without views or lengths they'd skip ranking and the duration check for days
+        logger.warning(f"[{query}] Statistics lookup failed; not caching these results")
+      elif search_results:
+        cache.set('search', cache_key, search_results)
       return search_results
     except Exception as e:
       logger.warning(f"[{query}] Attempt {attempt + 1} failed for search: {e}")
+      metrics.inc('retries', stage='search')
       if attempt == MAX_RETRIES - 1:
         logger.error(f"[{query}] All search attempts failed: {e}")
         return []
-      await asyncio.sleep(2 ** attempt)  # Exponential backoff
+      await get_upstream('youtube').backoff(attempt)